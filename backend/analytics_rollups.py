@@ -0,0 +1,152 @@
+"""
+Per-user daily analytics rollups.
+
+Every batch the puzzle_events ingester stores is folded into `user_rollups`,
+one document per user and UTC day:
+
+    {"user_id", "day": "YYYY-MM-DD", "attempts", "solves", "fails", "hints",
+     "stars", "time_sum", "time_sq_sum", "categories": {cat: {"attempts", "solves"}}}
+
+time_sum and time_sq_sum cover solves only, so the mean and spread of
+completion times come out of two counters. hints comes from the hints_used
+the server records on each complete event; client "hint" events report the
+same hints again, so they are not counted. The dashboard reads at most
+ROLLUP_WINDOW_DAYS documents per user instead of scanning progress.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Iterable, Optional
+import math
+import os
+
+from leaderboard_windows import day_bucket
+
+ROLLUP_WINDOW_DAYS = int(os.environ.get("ANALYTICS_ROLLUP_WINDOW_DAYS", 90))
+ROLLUP_RETENTION_DAYS = int(os.environ.get("ANALYTICS_ROLLUP_RETENTION_DAYS", 400))
+RECENT_DAYS = 7
+
+
+def rollup_operations(events: Iterable[dict]) -> List[UpdateOne]:
+    """Upserts adding a batch of events to the users' day rollups"""
+    increments: Dict[tuple, Dict[str, float]] = {}
+    for event in events:
+        ts = event["ts"]
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        inc = increments.setdefault((event["user_id"], day_bucket(ts)), {})
+
+        def add(field: str, value: float = 1) -> None:
+            inc[field] = inc.get(field, 0) + value
+
+        category = event.get("category")
+        kind = event["type"]
+        if kind == "attempt":
+            add("attempts")
+            if category:
+                add(f"categories.{category}.attempts")
+        elif kind == "complete":
+            add("solves")
+            add("stars", event.get("stars", 0))
+            seconds = event.get("time_ms", 0) / 1000
+            add("time_sum", seconds)
+            add("time_sq_sum", seconds * seconds)
+            if event.get("hints"):
+                add("hints", event["hints"])
+            if category:
+                add(f"categories.{category}.solves")
+        elif kind == "fail":
+            add("fails")
+
+    operations = []
+    for (user_id, day), inc in increments.items():
+        day_start = datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        operations.append(UpdateOne(
+            {"user_id": user_id, "day": day},
+            {"$inc": inc, "$setOnInsert": {"expires_at": day_start + timedelta(days=ROLLUP_RETENTION_DAYS)}},
+            upsert=True
+        ))
+    return operations
+
+
+async def apply_events(db: AsyncIOMotorDatabase, events: List[dict]) -> None:
+    """Fold stored events into the rollups"""
+    operations = rollup_operations(events)
+    if operations:
+        await db.user_rollups.bulk_write(operations, ordered=False)
+
+
+async def load_rollups(db: AsyncIOMotorDatabase, user_id: str, days: int = ROLLUP_WINDOW_DAYS) -> List[dict]:
+    """A user's day rollups over the last `days` days, newest first"""
+    since = day_bucket(datetime.now(timezone.utc) - timedelta(days=days - 1))
+    cursor = db.user_rollups.find(
+        {"user_id": user_id, "day": {"$gte": since}},
+        {"_id": 0, "user_id": 0, "expires_at": 0}
+    ).sort("day", DESCENDING)
+    return await cursor.to_list(length=days)
+
+
+def _tries(row: dict) -> int:
+    """Attempts, counting reported outcomes for clients that never report attempt events"""
+    return max(row.get("attempts", 0), row.get("solves", 0) + row.get("fails", 0))
+
+
+def _success_rate(solves: int, tries: int) -> float:
+    return round(100 * solves / tries, 1) if tries else 0.0
+
+
+def streak_days(rollups: List[dict], today: Optional[datetime] = None) -> int:
+    """Consecutive days with a solve, ending today (or yesterday if today has none yet)"""
+    today = today or datetime.now(timezone.utc)
+    solved_days = {row["day"] for row in rollups if row.get("solves", 0) > 0}
+    day = today
+    if day_bucket(day) not in solved_days:
+        day -= timedelta(days=1)
+    streak = 0
+    while day_bucket(day) in solved_days:
+        streak += 1
+        day -= timedelta(days=1)
+    return streak
+
+
+def summarize(rollups: List[dict], today: Optional[datetime] = None) -> Dict[str, Any]:
+    """Dashboard figures from a user's day rollups"""
+    solves = sum(row.get("solves", 0) for row in rollups)
+    tries = sum(_tries(row) for row in rollups)
+    time_sum = sum(row.get("time_sum", 0.0) for row in rollups)
+    time_sq_sum = sum(row.get("time_sq_sum", 0.0) for row in rollups)
+
+    mean = time_sum / solves if solves else 0.0
+    variance = max(0.0, time_sq_sum / solves - mean * mean) if solves else 0.0
+
+    category_solves: Dict[str, int] = {}
+    for row in rollups:
+        for category, counts in row.get("categories", {}).items():
+            category_solves[category] = category_solves.get(category, 0) + counts.get("solves", 0)
+    favorite = max(category_solves, key=category_solves.get) if any(category_solves.values()) else None
+
+    recent = [
+        _success_rate(row.get("solves", 0), _tries(row))
+        for row in reversed(rollups[:RECENT_DAYS])
+        if _tries(row)
+    ]
+
+    return {
+        "window_days": ROLLUP_WINDOW_DAYS,
+        "solves": solves,
+        "attempts": tries,
+        "hints_used": sum(row.get("hints", 0) for row in rollups),
+        "success_rate": _success_rate(solves, tries),
+        "avg_completion_time": round(mean, 2),
+        "completion_time_stddev": round(math.sqrt(variance), 2),
+        "avg_attempts": round(tries / solves, 2) if solves else 0.0,
+        "streak_days": streak_days(rollups, today),
+        "favorite_category": favorite,
+        "recent_performance": recent,
+    }
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the per-user day index and rollup expiry"""
+    await db.user_rollups.create_index([("user_id", ASCENDING), ("day", ASCENDING)], unique=True)
+    await db.user_rollups.create_index("expires_at", expireAfterSeconds=0)
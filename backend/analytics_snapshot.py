@@ -0,0 +1,385 @@
+"""
+Columnar analytics snapshots.
+
+Product analytics (DAU/WAU, D1/D7/D30 retention, progression funnel) are
+answered from NumPy arrays on disk rather than from the live database. An
+export copies users, puzzle_progress and puzzle_events into .npy columns:
+
+    users.signup_day        int32 days since the epoch, one per user
+    events.user / .day      int32 user index and event day, one per event
+    events.type             int8 index into puzzle_events.EVENT_TYPES
+    progress.user           int32 user index, one per completed puzzle_progress row
+
+Columns are filled chunk by chunk through memory-mapped files in a private
+build directory, which is renamed into place once complete; the snapshot is
+then published by atomically replacing the `current` pointer file. NumPy work
+and file writes run on the default executor, off the event loop. Queries open
+the published columns with mmap_mode="r", so they never load more than the
+pages they touch and never query MongoDB.
+
+Only events from the last EVENT_WINDOW_DAYS are exported: enough for the
+longest activity range and retention cohort the queries accept (365 days)
+plus the D30 follow-up.
+
+Exports run every ANALYTICS_SNAPSHOT_INTERVAL_SECONDS when
+ANALYTICS_SNAPSHOT_ENABLED is set, by whichever worker holds the exporter
+lease in `job_leases`, or on demand with `python analytics_snapshot.py`.
+The lease is shared by every host, so ANALYTICS_SNAPSHOT_DIR must then name a
+directory all of them mount; startup fails when it is not set.
+After publishing, the exporter deletes snapshots older than the newest
+SNAPSHOT_KEEP, never the current one; workers have already mapped the
+files of the snapshot they serve, so it stays readable until they move on.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from puzzle_events import EVENT_TYPES
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ENABLED = os.environ.get("ANALYTICS_SNAPSHOT_ENABLED", "false").lower() in ("1", "true", "yes")
+SNAPSHOT_DIR = Path(os.environ.get("ANALYTICS_SNAPSHOT_DIR", Path(tempfile.gettempdir()) / "mindspark-analytics"))
+SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get("ANALYTICS_SNAPSHOT_INTERVAL_SECONDS", 3600))
+SNAPSHOT_KEEP = 2
+EVENT_WINDOW_DAYS = 365 + 30
+EXPORT_CHUNK_SIZE = 50000
+
+if SNAPSHOT_ENABLED and not os.environ.get("ANALYTICS_SNAPSHOT_DIR"):
+    # A per-host default directory would leave every host but the lease holder without snapshots
+    raise RuntimeError("ANALYTICS_SNAPSHOT_ENABLED requires ANALYTICS_SNAPSHOT_DIR to name a directory shared by all workers")
+
+LEASE_NAME = "analytics_snapshot"
+LEASE_SECONDS = SNAPSHOT_INTERVAL_SECONDS * 2
+BUILD_PREFIX = ".build-"
+
+# Identifies this worker as a lease holder
+_worker_id = uuid.uuid4().hex
+
+RETENTION_DAYS = (1, 7, 30)
+FUNNEL_COMPLETIONS = (1, 5, 20)
+
+_EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def _days(timestamps: List[Any]) -> np.ndarray:
+    """Days since the epoch for datetimes or ISO strings, vectorized per chunk"""
+    values = [
+        datetime.fromisoformat(ts) if isinstance(ts, str) else ts
+        for ts in timestamps
+    ]
+    stamps = np.array(
+        [v.astimezone(timezone.utc).replace(tzinfo=None) if v and v.tzinfo else v for v in values],
+        dtype="datetime64[ms]"
+    )
+    return (stamps.astype("datetime64[D]") - _EPOCH).astype(np.int32)
+
+
+async def _export_column_set(
+    directory: Path,
+    name: str,
+    cursor,
+    expected: int,
+    columns: Dict[str, Any],
+    convert
+) -> int:
+    """Stream a cursor into memory-mapped columns; convert maps a chunk to column arrays"""
+    loop = asyncio.get_running_loop()
+    capacity = max(expected, 1)
+
+    def open_columns() -> Dict[str, np.ndarray]:
+        return {
+            column: np.lib.format.open_memmap(directory / f"{name}.{column}.npy", mode="w+", dtype=dtype, shape=(capacity,))
+            for column, dtype in columns.items()
+        }
+
+    def flush_chunk(documents: List[dict], start: int) -> int:
+        arrays = convert(documents)
+        size = min(len(next(iter(arrays.values()))), capacity - start)
+        for column, values in arrays.items():
+            files[column][start:start + size] = values[:size]
+        return size
+
+    def close_columns() -> None:
+        for array in files.values():
+            array.flush()
+
+    files = await loop.run_in_executor(None, open_columns)
+    written = 0
+    chunk: List[dict] = []
+
+    async for document in cursor:
+        chunk.append(document)
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            written += await loop.run_in_executor(None, flush_chunk, chunk, written)
+            chunk = []
+        if written >= capacity:
+            # Rows inserted after the count are left for the next export
+            break
+    if chunk and written < capacity:
+        written += await loop.run_in_executor(None, flush_chunk, chunk, written)
+
+    await loop.run_in_executor(None, close_columns)
+    return written
+
+
+async def export(db: AsyncIOMotorDatabase, root: Path = SNAPSHOT_DIR) -> dict:
+    """Write a new columnar snapshot and publish it, returning its manifest"""
+    started = time.perf_counter()
+    root.mkdir(parents=True, exist_ok=True)
+    generated_at = datetime.now(timezone.utc)
+    name = f"snapshot-{generated_at.strftime('%Y%m%dT%H%M%S%f')}"
+    # Built under a private name; readers only ever see complete snapshots
+    directory = Path(tempfile.mkdtemp(prefix=BUILD_PREFIX, dir=root))
+
+    # Users first: their order defines the user index used by every other column
+    user_index: Dict[str, int] = {}
+
+    def convert_users(documents: List[dict]) -> Dict[str, np.ndarray]:
+        for document in documents:
+            user_index[document["id"]] = len(user_index)
+        return {"signup_day": _days([document.get("created_at") or generated_at for document in documents])}
+
+    users = await _export_column_set(
+        directory, "users",
+        db.users.find({}, {"_id": 0, "id": 1, "created_at": 1}),
+        await db.users.count_documents({}),
+        {"signup_day": np.int32},
+        convert_users
+    )
+
+    type_codes = {name: code for code, name in enumerate(EVENT_TYPES)}
+
+    def convert_events(documents: List[dict]) -> Dict[str, np.ndarray]:
+        documents = [document for document in documents if document.get("user_id") in user_index]
+        return {
+            "user": np.array([user_index[document["user_id"]] for document in documents], dtype=np.int32),
+            "day": _days([document["ts"] for document in documents]) if documents else np.zeros(0, np.int32),
+            "type": np.array([type_codes.get(document.get("type"), -1) for document in documents], dtype=np.int8),
+        }
+
+    recent_events = {"ts": {"$gte": generated_at - timedelta(days=EVENT_WINDOW_DAYS)}}
+    events = await _export_column_set(
+        directory, "events",
+        db.puzzle_events.find(recent_events, {"_id": 0, "user_id": 1, "ts": 1, "type": 1}),
+        await db.puzzle_events.count_documents(recent_events),
+        {"user": np.int32, "day": np.int32, "type": np.int8},
+        convert_events
+    )
+
+    def convert_progress(documents: List[dict]) -> Dict[str, np.ndarray]:
+        return {"user": np.array(
+            [user_index[document["user_id"]] for document in documents if document.get("user_id") in user_index],
+            dtype=np.int32
+        )}
+
+    progress = await _export_column_set(
+        directory, "progress",
+        db.puzzle_progress.find({"completed": True}, {"_id": 0, "user_id": 1}),
+        await db.puzzle_progress.count_documents({"completed": True}),
+        {"user": np.int32},
+        convert_progress
+    )
+
+    manifest = {
+        "directory": name,
+        "generated_at": generated_at.isoformat(),
+        "snapshot_day": int((np.datetime64(generated_at.replace(tzinfo=None), "D") - _EPOCH).astype(int)),
+        "rows": {"users": users, "events": events, "progress": progress},
+        "export_seconds": round(time.perf_counter() - started, 3),
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest))
+    os.rename(directory, root / name)
+
+    pointer = root / f"current.{_worker_id}.tmp"
+    pointer.write_text(name)
+    os.replace(pointer, root / "current")
+
+    await asyncio.get_running_loop().run_in_executor(None, _remove_stale, root)
+    return manifest
+
+
+def _remove_stale(root: Path) -> None:
+    """Delete superseded snapshots and abandoned builds"""
+    current = (root / "current").read_text().strip()
+    snapshots = sorted(path for path in root.glob("snapshot-*") if path.is_dir())
+    for stale in snapshots[:-SNAPSHOT_KEEP]:
+        if stale.name != current:
+            shutil.rmtree(stale, ignore_errors=True)
+
+    # Builds left by crashed exports; a build still in progress is younger than an interval
+    cutoff = time.time() - SNAPSHOT_INTERVAL_SECONDS
+    for build in root.glob(f"{BUILD_PREFIX}*"):
+        if build.is_dir() and build.stat().st_mtime < cutoff:
+            shutil.rmtree(build, ignore_errors=True)
+
+
+class Snapshot:
+    """Read-only, memory-mapped view of a published snapshot"""
+
+    def __init__(self, directory: Path):
+        self.manifest = json.loads((directory / "manifest.json").read_text())
+        rows = self.manifest["rows"]
+
+        def column(name: str, size: int) -> np.ndarray:
+            return np.load(directory / f"{name}.npy", mmap_mode="r")[:size]
+
+        self.signup_day = column("users.signup_day", rows["users"])
+        self.event_user = column("events.user", rows["events"])
+        self.event_day = column("events.day", rows["events"])
+        self.progress_user = column("progress.user", rows["progress"])
+        self.today = self.manifest["snapshot_day"]
+        self._active_codes: Optional[np.ndarray] = None
+
+    @property
+    def user_count(self) -> int:
+        return len(self.signup_day)
+
+    def active_codes(self) -> np.ndarray:
+        """Sorted unique (day, user) pairs encoded as day * users + user"""
+        if self._active_codes is None:
+            codes = self.event_day.astype(np.int64) * max(self.user_count, 1) + self.event_user
+            self._active_codes = np.unique(codes)
+        return self._active_codes
+
+    def _day_str(self, day: int) -> str:
+        return str(_EPOCH + np.timedelta64(int(day), "D"))
+
+    def activity(self, days: int) -> List[dict]:
+        """DAU and WAU for each of the last `days` days"""
+        users = max(self.user_count, 1)
+        codes = self.active_codes()
+        active_day, active_user = codes // users, codes % users
+        first = self.today - days + 1
+
+        recent = active_day >= first - 6
+        active_day, active_user = active_day[recent], active_user[recent]
+        dau = np.bincount(active_day - (first - 6), minlength=days + 6)[6:]
+
+        rows = []
+        for offset in range(days):
+            day = first + offset
+            in_week = (active_day > day - 7) & (active_day <= day)
+            rows.append({
+                "day": self._day_str(day),
+                "dau": int(dau[offset]),
+                "wau": int(np.unique(active_user[in_week]).size),
+            })
+        return rows
+
+    def retention(self, cohort_days: int) -> dict:
+        """D1/D7/D30 retention of users who signed up in the last `cohort_days` days"""
+        users = max(self.user_count, 1)
+        codes = self.active_codes()
+        cohort = np.flatnonzero(self.signup_day > self.today - cohort_days)
+        signup = self.signup_day[cohort].astype(np.int64)
+
+        result: Dict[str, Any] = {"cohort_days": cohort_days, "cohort_size": int(cohort.size)}
+        for k in RETENTION_DAYS:
+            eligible = signup + k <= self.today
+            wanted = (signup[eligible] + k) * users + cohort[eligible]
+            returned = int(np.isin(wanted, codes, assume_unique=False).sum())
+            size = int(eligible.sum())
+            result[f"d{k}"] = {
+                "eligible": size,
+                "retained": returned,
+                "rate": round(returned / size, 4) if size else None,
+            }
+        return result
+
+    def funnel(self, cohort_days: Optional[int] = None) -> List[dict]:
+        """Users reaching each step: signed up, played, then 1/5/20 completed puzzles"""
+        in_cohort = np.ones(self.user_count, dtype=bool)
+        if cohort_days:
+            in_cohort = self.signup_day > self.today - cohort_days
+
+        played = np.zeros(self.user_count, dtype=bool)
+        played[self.event_user] = True
+        completed = np.bincount(self.progress_user, minlength=self.user_count)
+        played |= completed > 0
+
+        steps = [("signed_up", in_cohort), ("played", in_cohort & played)]
+        steps += [(f"completed_{n}", in_cohort & (completed >= n)) for n in FUNNEL_COMPLETIONS]
+
+        total = int(in_cohort.sum())
+        return [
+            {"step": name, "users": int(mask.sum()), "rate": round(int(mask.sum()) / total, 4) if total else None}
+            for name, mask in steps
+        ]
+
+
+_loaded: Optional[Snapshot] = None
+
+
+def load_current(root: Path = SNAPSHOT_DIR) -> Optional[Snapshot]:
+    """The published snapshot, reopened only when the pointer has moved"""
+    global _loaded
+    try:
+        name = (root / "current").read_text().strip()
+    except FileNotFoundError:
+        return None
+    if _loaded is None or _loaded.manifest["directory"] != name:
+        try:
+            _loaded = Snapshot(root / name)
+        except FileNotFoundError:
+            # Removed after a newer export; keep serving the one already mapped
+            if _loaded is None:
+                raise
+    return _loaded
+
+
+async def acquire_lease(db: AsyncIOMotorDatabase) -> bool:
+    """Take or renew the exporter lease, returning whether this worker holds it"""
+    now = datetime.now(timezone.utc)
+    try:
+        lease = await db.job_leases.find_one_and_update(
+            {"_id": LEASE_NAME, "$or": [{"owner": _worker_id}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": _worker_id, "expires_at": now + timedelta(seconds=LEASE_SECONDS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Held by another worker: the upsert tried to insert a second lease
+        return False
+    return lease is not None and lease.get("owner") == _worker_id
+
+
+async def run_exporter(db: AsyncIOMotorDatabase) -> None:
+    """Background task refreshing the snapshot every SNAPSHOT_INTERVAL_SECONDS while holding the lease"""
+    while True:
+        try:
+            if await acquire_lease(db):
+                manifest = await export(db)
+                logger.info(f"Analytics snapshot exported: {manifest['rows']}")
+        except Exception as e:
+            logger.warning(f"Failed to export analytics snapshot: {e}")
+        await asyncio.sleep(SNAPSHOT_INTERVAL_SECONDS)
+
+
+async def _export_main() -> None:
+    from database import get_database, close_client
+
+    manifest = await export(get_database())
+    logger.info(f"Exported analytics snapshot {manifest['directory']}: {manifest['rows']}")
+    close_client()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv(Path(__file__).parent / '.env')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(_export_main())
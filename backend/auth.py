@@ -1,12 +1,20 @@
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Dict, Optional
+from cachetools import TLRUCache, TTLCache
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from motor.motor_asyncio import AsyncIOMotorDatabase
+import asyncio
+import hashlib
+import logging
 import os
+import time
 
 from models import TokenData, User
+from database import get_database
+import hashing
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -16,7 +24,40 @@ SECRET_KEY = os.environ.get("JWT_SECRET", "your-secret-key-change-in-production"
 ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", 43200))
 
+# Version of the compact claim set embedded in access tokens. Tokens carrying an
+# older (or no) version fall back to a database lookup of the principal.
+CLAIMS_VERSION = 1
+TOKEN_REVOCATION_REFRESH_SECONDS = int(os.environ.get("TOKEN_REVOCATION_REFRESH_SECONDS", 60))
+# Accounts allowed to use admin endpoints, as a comma-separated email list
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email.strip()}
+
 security = HTTPBearer()
+logger = logging.getLogger(__name__)
+
+# Verified claims keyed by SHA-256 of the token; each entry expires at its own exp
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+_token_cache = TLRUCache(
+    maxsize=TOKEN_CACHE_SIZE,
+    ttu=lambda _key, payload, _now: payload["exp"],
+    timer=time.time,
+)
+_token_cache_stats = {"hits": 0, "misses": 0}
+
+# Authenticated principals (the user fields routes actually need) keyed by email
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = int(os.environ.get("PRINCIPAL_CACHE_TTL", 300))
+PRINCIPAL_FIELDS = ("id", "email", "name", "avatar", "premium")
+_principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+_principal_cache_stats = {"hits": 0, "misses": 0}
+
+# user_id -> unix time before which that user's tokens are rejected. Mirrors the
+# token_revocations collection and is refreshed in the background, never per request.
+_revoked_before: Dict[str, float] = {}
+# The same cutoff keyed by email, for older tokens that carry no uid
+_revoked_before_by_email: Dict[str, float] = {}
+# user_id -> unix time before which token name/avatar/premium claims are out of date;
+# such tokens are still valid but their principal is loaded instead of trusted
+_claims_stale_before: Dict[str, float] = {}
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -29,6 +70,16 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password on the hashing pool without blocking the event loop"""
+    return await hashing.run_hash_job(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """Hash a password on the hashing pool without blocking the event loop"""
+    return await hashing.run_hash_job(get_password_hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """Create a JWT access token"""
     to_encode = data.copy()
@@ -37,23 +88,55 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": time.time()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
-def decode_access_token(token: str) -> TokenData:
-    """Decode and verify a JWT token"""
+def build_token_claims(user: dict) -> dict:
+    """Compact principal claims embedded in access tokens"""
+    return {
+        "sub": user["email"],
+        "uid": user["id"],
+        "nm": user.get("name", ""),
+        "av": user.get("avatar", ""),
+        "prm": bool(user.get("premium", False)),
+        "cv": CLAIMS_VERSION,
+    }
+
+
+def _verify_token(token: str) -> dict:
+    """Verify a JWT, reusing cached claims for tokens already seen"""
+    key = hashlib.sha256(token.encode()).digest()
+    payload = _token_cache.get(key)
+    if payload is not None:
+        _token_cache_stats["hits"] += 1
+        return payload
+
+    _token_cache_stats["misses"] += 1
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    if isinstance(payload.get("exp"), (int, float)):
+        _token_cache[key] = payload
+    return payload
+
+
+def get_token_cache_metrics() -> dict:
+    """Hit/miss counters for the verified-token cache"""
+    hits = _token_cache_stats["hits"]
+    lookups = hits + _token_cache_stats["misses"]
+    return {
+        "size": len(_token_cache),
+        "capacity": TOKEN_CACHE_SIZE,
+        "hits": hits,
+        "misses": _token_cache_stats["misses"],
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+    }
+
+
+def _decode_payload(token: str) -> dict:
+    """Verify a JWT and return its claims, rejecting revoked or subject-less tokens"""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        return TokenData(email=email)
+        payload = _verify_token(token)
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -61,6 +144,91 @@ def decode_access_token(token: str) -> TokenData:
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+    if payload.get("uid"):
+        revoked_before = _revoked_before.get(payload["uid"])
+    else:
+        revoked_before = _revoked_before_by_email.get(payload.get("sub"))
+    if payload.get("sub") is None or (revoked_before and payload.get("iat", 0) < revoked_before):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return payload
+
+
+def decode_access_token(token: str) -> TokenData:
+    """Decode and verify a JWT token"""
+    payload = _decode_payload(token)
+    return TokenData(email=payload["sub"])
+
+
+def _revocation_expiry() -> datetime:
+    """When a cutoff written now stops mattering: every token it affects has expired by then"""
+    return datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+
+
+async def refresh_token_revocations() -> None:
+    """Reload the revocation tables from the token_revocations collection"""
+    # Tokens issued before this have expired anyway, so older cutoffs are skipped
+    horizon = time.time() - ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    db = get_database()
+    docs = await db.token_revocations.find(
+        {"$or": [{"revoked_before": {"$gt": horizon}}, {"claims_before": {"$gt": horizon}}]},
+        {"_id": 0, "user_id": 1, "email": 1, "revoked_before": 1, "claims_before": 1}
+    ).to_list(None)
+    revoked = {doc["user_id"]: doc["revoked_before"] for doc in docs if doc.get("revoked_before", 0) > horizon}
+    revoked_by_email = {
+        doc["email"]: doc["revoked_before"] for doc in docs if doc.get("revoked_before", 0) > horizon and doc.get("email")
+    }
+    stale = {doc["user_id"]: doc["claims_before"] for doc in docs if doc.get("claims_before", 0) > horizon}
+    _revoked_before.clear()
+    _revoked_before.update(revoked)
+    _revoked_before_by_email.clear()
+    _revoked_before_by_email.update(revoked_by_email)
+    _claims_stale_before.clear()
+    _claims_stale_before.update(stale)
+
+
+async def run_revocation_refresher() -> None:
+    """Background task keeping the revocation table current"""
+    while True:
+        try:
+            await refresh_token_revocations()
+        except Exception as e:
+            logger.warning(f"Failed to refresh token revocations: {e}")
+        await asyncio.sleep(TOKEN_REVOCATION_REFRESH_SECONDS)
+
+
+async def revoke_user_tokens(user_id: str, email: str) -> None:
+    """Reject every token issued to a user before now"""
+    revoked_before = time.time()
+    db = get_database()
+    await db.token_revocations.update_one(
+        {"user_id": user_id},
+        {"$set": {"email": email, "revoked_before": revoked_before, "expires_at": _revocation_expiry()}},
+        upsert=True
+    )
+    _revoked_before[user_id] = revoked_before
+    _revoked_before_by_email[email] = revoked_before
+
+
+async def expire_token_claims(user_id: str, email: str) -> None:
+    """Stop trusting identity claims in tokens issued before now, after the user's profile changed"""
+    claims_before = time.time()
+    db = get_database()
+    await db.token_revocations.update_one(
+        {"user_id": user_id},
+        {"$set": {"email": email, "claims_before": claims_before, "expires_at": _revocation_expiry()}},
+        upsert=True
+    )
+    _claims_stale_before[user_id] = claims_before
+
+
+async def ensure_revocation_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the TTL index that drops revocation rows once every token they cover has expired"""
+    await db.token_revocations.create_index("expires_at", expireAfterSeconds=0)
+
 
 async def get_current_user_email(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
     """Get the current user's email from the JWT token"""
@@ -75,10 +243,63 @@ async def get_current_user_email(credentials: HTTPAuthorizationCredentials = Dep
     return token_data.email
 
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
-    """Get the current user's data from the JWT token"""
-    from motor.motor_asyncio import AsyncIOMotorClient
-    
+def _request_principals(request: Optional[Request]) -> dict:
+    """Per-request memo of principals already loaded while serving it"""
+    if request is None:
+        return {}
+    memo = getattr(request.state, "principals", None)
+    if memo is None:
+        memo = {}
+        request.state.principals = memo
+    return memo
+
+
+async def load_principal(email: str, request: Optional[Request] = None) -> Optional[dict]:
+    """Load a user's principal record, checking the request memo and process cache first"""
+    memo = _request_principals(request)
+    principal = memo.get(email)
+    if principal is not None:
+        return principal
+
+    principal = _principal_cache.get(email)
+    if principal is not None:
+        _principal_cache_stats["hits"] += 1
+    else:
+        _principal_cache_stats["misses"] += 1
+        db = get_database()
+        projection = {"_id": 0, **{field: 1 for field in PRINCIPAL_FIELDS}}
+        user = await db.users.find_one({"email": email}, projection)
+        if not user:
+            return None
+        principal = {field: user.get(field) for field in PRINCIPAL_FIELDS}
+        principal["premium"] = bool(principal["premium"])
+        _principal_cache[email] = principal
+
+    memo[email] = principal
+    return principal
+
+
+def invalidate_principal(email: str) -> None:
+    """Drop a cached principal after the user document changes"""
+    _principal_cache.pop(email, None)
+
+
+def get_principal_cache_metrics() -> dict:
+    """Hit/miss counters for the principal cache"""
+    hits = _principal_cache_stats["hits"]
+    lookups = hits + _principal_cache_stats["misses"]
+    return {
+        "size": len(_principal_cache),
+        "capacity": PRINCIPAL_CACHE_SIZE,
+        "ttl_seconds": PRINCIPAL_CACHE_TTL,
+        "hits": hits,
+        "misses": _principal_cache_stats["misses"],
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+    }
+
+
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """Get the current user's principal (id, email, name, avatar, premium) from the JWT token"""
     token = credentials.credentials
     token_data = decode_access_token(token)
     
@@ -89,12 +310,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Get user from database
-    MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-    client = AsyncIOMotorClient(MONGO_URL)
-    db = client[os.environ.get('DB_NAME', 'mindspark_db')]
-    
-    user = await db.users.find_one({"email": token_data.email}, {"_id": 0, "hashed_password": 0})
+    user = await load_principal(token_data.email, request)
     
     if not user:
         raise HTTPException(
@@ -103,3 +319,38 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         )
     
     return user
+
+
+
+async def get_current_principal(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """Get the current user's principal straight from the token claims when possible"""
+    payload = _decode_payload(credentials.credentials)
+
+    fresh = payload.get("iat", 0) >= _claims_stale_before.get(payload.get("uid"), 0)
+    if payload.get("cv") == CLAIMS_VERSION and payload.get("uid") and fresh:
+        return {
+            "id": payload["uid"],
+            "email": payload["sub"],
+            "name": payload.get("nm", ""),
+            "avatar": payload.get("av", ""),
+            "premium": bool(payload.get("prm", False)),
+        }
+
+    # Older tokens only carry the email, and tokens issued before a profile change carry stale claims
+    user = await load_principal(payload["sub"], request)
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found"
+        )
+    return user
+
+
+async def get_admin_principal(principal: dict = Depends(get_current_principal)) -> dict:
+    """Get the current principal, rejecting accounts not listed in ADMIN_EMAILS"""
+    if principal["email"].lower() not in ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+    return principal
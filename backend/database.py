@@ -0,0 +1,54 @@
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from typing import Optional
+import os
+
+
+# Process-wide MongoDB client, created lazily so that the .env file loaded by
+# server.py is already applied when the connection settings are read.
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def _client_options() -> dict:
+    """Build Motor client options from the environment"""
+    options = {
+        "maxPoolSize": int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        "minPoolSize": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "maxIdleTimeMS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 300000)),
+        "connectTimeoutMS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 10000)),
+        "serverSelectionTimeoutMS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+        "socketTimeoutMS": int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 20000)),
+    }
+
+    # zlib ships with pymongo; snappy and zstd need their optional packages
+    compressors = os.environ.get("MONGO_COMPRESSORS", "zlib").strip()
+    if compressors:
+        options["compressors"] = compressors
+
+    return options
+
+
+def get_client() -> AsyncIOMotorClient:
+    """Get the shared MongoDB client, creating it on first use"""
+    global _client
+    if _client is None:
+        mongo_url = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+        _client = AsyncIOMotorClient(mongo_url, **_client_options())
+    return _client
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    """Get the application database handle"""
+    return get_client()[os.environ.get("DB_NAME", "mindspark_db")]
+
+
+async def get_db() -> AsyncIOMotorDatabase:
+    """Database dependency shared by every router"""
+    return get_database()
+
+
+def close_client() -> None:
+    """Close the shared client and its connection pool"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
@@ -0,0 +1,231 @@
+"""
+Offline difficulty calibration.
+
+Streams every puzzle_progress row in chunks of CALIBRATION_CHUNK_SIZE into
+NumPy arrays and folds each chunk into per-puzzle accumulators: players,
+solves, attempt and hint sums and histograms, and a DDSketch of best times.
+Memory grows with the number of puzzles, never with the number of rows.
+
+Each puzzle then gets an empirical difficulty score in [0, 1]. The score
+weights a smoothed failure rate, median solve time relative to the
+median across all puzzles, extra attempts and hints. Puzzles with at least
+CALIBRATION_MIN_PLAYERS players are labelled easy / medium / hard by score.
+Results are written to `puzzle_stats`.
+
+Run `python difficulty_calibration.py`.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne
+from datetime import datetime, timezone
+from typing import Dict, List
+import asyncio
+import logging
+import math
+import os
+
+import numpy as np
+
+from timing_sketches import DDSketch, MIN_SECONDS, MAX_SECONDS
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.environ.get("CALIBRATION_CHUNK_SIZE", 100000))
+MIN_PLAYERS = int(os.environ.get("CALIBRATION_MIN_PLAYERS", 20))
+WRITE_BATCH_SIZE = 1000
+
+# Histogram bucket lower bounds: attempts 1, 2, 3, 4-5, 6-10, 11+; hints 0, 1, 2, 3+
+ATTEMPT_BUCKETS = np.array([1, 2, 3, 4, 6, 11])
+ATTEMPT_LABELS = ["1", "2", "3", "4-5", "6-10", "11+"]
+HINT_BUCKETS = np.array([0, 1, 2, 3])
+HINT_LABELS = ["0", "1", "2", "3+"]
+
+# Weight of the all-puzzle solve rate when smoothing a puzzle's solve rate
+PRIOR_PLAYERS = 10
+SCORE_WEIGHTS = {"failure": 0.4, "time": 0.3, "attempts": 0.2, "hints": 0.1}
+LABEL_THRESHOLDS = [(0.33, "easy"), (0.66, "medium"), (math.inf, "hard")]
+
+_LOG_GAMMA = math.log(DDSketch().gamma)
+_FIELDS = ("puzzle_id", "completed", "best_time", "attempts", "hints_used")
+
+
+class _Accumulator:
+    """Per-puzzle running totals, one row per puzzle in growable arrays"""
+
+    def __init__(self):
+        self.rows: Dict[int, int] = {}
+        self.counts = np.zeros((0, 4))  # players, solves, attempts, hints
+        self.attempt_hist = np.zeros((0, len(ATTEMPT_BUCKETS)), dtype=np.int64)
+        self.hint_hist = np.zeros((0, len(HINT_BUCKETS)), dtype=np.int64)
+        self.time_sum = np.zeros(0)
+        self.time_min = np.zeros(0)
+        self.time_max = np.zeros(0)
+        self.sketches: List[DDSketch] = []
+
+    def _row_indices(self, puzzle_ids: np.ndarray) -> np.ndarray:
+        new = [int(pid) for pid in puzzle_ids if int(pid) not in self.rows]
+        if new:
+            for pid in new:
+                self.rows[pid] = len(self.rows)
+                self.sketches.append(DDSketch())
+            grow = len(new)
+            self.counts = np.vstack([self.counts, np.zeros((grow, 4))])
+            self.attempt_hist = np.vstack([self.attempt_hist, np.zeros((grow, len(ATTEMPT_BUCKETS)), dtype=np.int64)])
+            self.hint_hist = np.vstack([self.hint_hist, np.zeros((grow, len(HINT_BUCKETS)), dtype=np.int64)])
+            self.time_sum = np.concatenate([self.time_sum, np.zeros(grow)])
+            self.time_min = np.concatenate([self.time_min, np.full(grow, np.inf)])
+            self.time_max = np.concatenate([self.time_max, np.full(grow, -np.inf)])
+        return np.array([self.rows[int(pid)] for pid in puzzle_ids], dtype=np.int64)
+
+    def add_chunk(self, chunk: Dict[str, np.ndarray]) -> None:
+        unique_ids, inverse = np.unique(chunk["puzzle_id"], return_inverse=True)
+        rows = self._row_indices(unique_ids)
+        size = len(unique_ids)
+
+        np.add.at(self.counts[:, 0], rows, np.bincount(inverse, minlength=size))
+        np.add.at(self.counts[:, 1], rows, np.bincount(inverse, weights=chunk["completed"], minlength=size))
+        np.add.at(self.counts[:, 2], rows, np.bincount(inverse, weights=chunk["attempts"], minlength=size))
+        np.add.at(self.counts[:, 3], rows, np.bincount(inverse, weights=chunk["hints_used"], minlength=size))
+
+        attempt_bucket = np.clip(np.searchsorted(ATTEMPT_BUCKETS, chunk["attempts"], side="right") - 1, 0, None)
+        np.add.at(self.attempt_hist, (rows[inverse], attempt_bucket), 1)
+        hint_bucket = np.searchsorted(HINT_BUCKETS, chunk["hints_used"], side="right") - 1
+        np.add.at(self.hint_hist, (rows[inverse], hint_bucket), 1)
+
+        # Best times of solved rows, binned into each puzzle's sketch in bulk
+        timed = (chunk["completed"] > 0) & (chunk["best_time"] > 0)
+        if timed.any():
+            times = np.clip(chunk["best_time"][timed], MIN_SECONDS, MAX_SECONDS)
+            timed_rows = rows[inverse[timed]]
+            np.minimum.at(self.time_min, timed_rows, times)
+            np.maximum.at(self.time_max, timed_rows, times)
+            np.add.at(self.time_sum, timed_rows, times)
+            bins = np.ceil(np.log(times) / _LOG_GAMMA).astype(np.int64)
+            pairs, pair_counts = np.unique(np.stack([timed_rows, bins]), axis=1, return_counts=True)
+            for (row, index), count in zip(pairs.T, pair_counts):
+                target = self.sketches[row]
+                target.bins[int(index)] = target.bins.get(int(index), 0) + int(count)
+                target.count += int(count)
+
+    def finish_sketches(self) -> None:
+        """Copy the time extremes and sums into the sketches"""
+        for row, sketch in enumerate(self.sketches):
+            if sketch.count:
+                sketch.min, sketch.max = float(self.time_min[row]), float(self.time_max[row])
+                sketch.total = float(self.time_sum[row])
+
+
+def _chunk_arrays(documents: List[dict]) -> Dict[str, np.ndarray]:
+    """Column arrays for a chunk of puzzle_progress rows, with missing values as 0"""
+    def column(field: str, dtype) -> np.ndarray:
+        return np.array([doc.get(field) or 0 for doc in documents], dtype=dtype)
+
+    return {
+        "puzzle_id": column("puzzle_id", np.int64),
+        "completed": column("completed", np.float64),
+        "best_time": column("best_time", np.float64),
+        "attempts": np.maximum(column("attempts", np.int64), 0),
+        "hints_used": np.maximum(column("hints_used", np.int64), 0),
+    }
+
+
+async def accumulate(db: AsyncIOMotorDatabase, chunk_size: int = CHUNK_SIZE) -> _Accumulator:
+    """Fold all of puzzle_progress into per-puzzle accumulators, one chunk at a time"""
+    accumulator = _Accumulator()
+    projection = {"_id": 0, **{field: 1 for field in _FIELDS}}
+    cursor = db.puzzle_progress.find({}, projection).batch_size(min(chunk_size, 10000))
+    documents: List[dict] = []
+    async for document in cursor:
+        documents.append(document)
+        if len(documents) >= chunk_size:
+            accumulator.add_chunk(_chunk_arrays(documents))
+            documents = []
+    if documents:
+        accumulator.add_chunk(_chunk_arrays(documents))
+    accumulator.finish_sketches()
+    return accumulator
+
+
+def score_puzzles(accumulator: _Accumulator) -> List[dict]:
+    """Per-puzzle statistics and calibrated difficulty"""
+    if not accumulator.rows:
+        return []
+
+    players, solves, attempts, hints = accumulator.counts.T
+    prior_rate = solves.sum() / players.sum()
+    solve_rate = (solves + PRIOR_PLAYERS * prior_rate) / (players + PRIOR_PLAYERS)
+
+    medians = np.array([sketch.quantile(0.5) or np.nan for sketch in accumulator.sketches])
+    p90s = np.array([sketch.quantile(0.9) or np.nan for sketch in accumulator.sketches])
+    global_median = np.nanmedian(medians) if np.isfinite(medians).any() else np.nan
+
+    # Each component is mapped onto [0, 1]; a puzzle 4x slower than typical scores 1 on time
+    time_component = np.clip(0.5 + np.log(medians / global_median) / (2 * math.log(4)), 0, 1)
+    time_component = np.nan_to_num(time_component, nan=0.5)
+    attempts_per_player = attempts / np.maximum(players, 1)
+    hints_per_player = hints / np.maximum(players, 1)
+    score = (
+        SCORE_WEIGHTS["failure"] * (1 - solve_rate)
+        + SCORE_WEIGHTS["time"] * time_component
+        + SCORE_WEIGHTS["attempts"] * np.clip((attempts_per_player - 1) / 4, 0, 1)
+        + SCORE_WEIGHTS["hints"] * np.clip(hints_per_player / 3, 0, 1)
+    )
+
+    sufficient = players >= MIN_PLAYERS
+    percentile = np.full(len(score), np.nan)
+    if sufficient.any():
+        ranked = score[sufficient]
+        percentile[sufficient] = np.searchsorted(np.sort(ranked), ranked, side="right") / len(ranked)
+
+    now = datetime.now(timezone.utc)
+    stats = []
+    for puzzle_id, row in accumulator.rows.items():
+        label = next(name for bound, name in LABEL_THRESHOLDS if score[row] < bound) if sufficient[row] else None
+        stats.append({
+            "puzzle_id": puzzle_id,
+            "players": int(players[row]),
+            "solves": int(solves[row]),
+            "solve_rate": round(float(solves[row] / players[row]), 4) if players[row] else 0.0,
+            "smoothed_solve_rate": round(float(solve_rate[row]), 4),
+            "median_time": None if np.isnan(medians[row]) else round(float(medians[row]), 3),
+            "p90_time": None if np.isnan(p90s[row]) else round(float(p90s[row]), 3),
+            "mean_attempts": round(float(attempts_per_player[row]), 3),
+            "mean_hints": round(float(hints_per_player[row]), 3),
+            "attempts_histogram": dict(zip(ATTEMPT_LABELS, map(int, accumulator.attempt_hist[row]))),
+            "hints_histogram": dict(zip(HINT_LABELS, map(int, accumulator.hint_hist[row]))),
+            "difficulty_score": round(float(score[row]), 4),
+            "difficulty_percentile": None if np.isnan(percentile[row]) else round(float(percentile[row]), 4),
+            "difficulty_label": label,
+            "sufficient_data": bool(sufficient[row]),
+            "computed_at": now,
+        })
+    return stats
+
+
+async def calibrate(db: AsyncIOMotorDatabase, chunk_size: int = CHUNK_SIZE) -> int:
+    """Recompute puzzle_stats from puzzle_progress, returning how many puzzles were written"""
+    stats = score_puzzles(await accumulate(db, chunk_size))
+    for start in range(0, len(stats), WRITE_BATCH_SIZE):
+        await db.puzzle_stats.bulk_write([
+            ReplaceOne({"puzzle_id": row["puzzle_id"]}, row, upsert=True)
+            for row in stats[start:start + WRITE_BATCH_SIZE]
+        ], ordered=False)
+    return len(stats)
+
+
+async def _calibrate_main() -> None:
+    from database import get_database, close_client
+
+    db = get_database()
+    await db.puzzle_stats.create_index("puzzle_id", unique=True)
+    written = await calibrate(db)
+    logger.info(f"Calibrated difficulty for {written} puzzles")
+    close_client()
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+    from dotenv import load_dotenv
+
+    load_dotenv(Path(__file__).parent / '.env')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(_calibrate_main())
@@ -0,0 +1,102 @@
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from fastapi import HTTPException, status
+from typing import Any, Callable, Optional
+import asyncio
+import os
+import time
+
+
+# Password hashing pool settings. bcrypt releases the GIL, so threads are the
+# default; set PASSWORD_HASH_EXECUTOR=process to isolate hashing completely.
+HASH_EXECUTOR = os.environ.get("PASSWORD_HASH_EXECUTOR", "thread")
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+HASH_QUEUE_SIZE = int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE", 32))
+
+_executor: Optional[Executor] = None
+
+# Jobs admitted to the pool (running + waiting for a worker). Decremented when
+# the job itself finishes, not when its caller stops waiting for it.
+_pending = 0
+
+_metrics = {
+    "completed": 0,
+    "rejected": 0,
+    "failed": 0,
+    "total_latency_ms": 0.0,
+    "max_latency_ms": 0.0,
+    "last_latency_ms": 0.0,
+}
+
+
+def get_executor() -> Executor:
+    """Get the hashing pool, creating it on first use"""
+    global _executor
+    if _executor is None:
+        if HASH_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="pwhash")
+    return _executor
+
+
+def _job_done(job: Future, started: float) -> None:
+    """Release a finished job's pool slot and record its outcome, on the event loop"""
+    global _pending
+    _pending -= 1
+    if job.cancelled():
+        return
+    if job.exception() is not None:
+        _metrics["failed"] += 1
+        return
+    latency_ms = (time.perf_counter() - started) * 1000
+    _metrics["completed"] += 1
+    _metrics["total_latency_ms"] += latency_ms
+    _metrics["last_latency_ms"] = latency_ms
+    _metrics["max_latency_ms"] = max(_metrics["max_latency_ms"], latency_ms)
+
+
+async def run_hash_job(func: Callable[..., Any], *args: Any) -> Any:
+    """Run a hashing function on the pool, rejecting with 503 when the queue is full"""
+    global _pending
+    if _pending >= HASH_WORKERS + HASH_QUEUE_SIZE:
+        _metrics["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication service is busy, please retry",
+            headers={"Retry-After": "1"},
+        )
+
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    job = get_executor().submit(func, *args)
+    _pending += 1
+    # A job that is already running keeps its worker after a cancelled caller gives up,
+    # so the slot is only released once the job itself is done
+    job.add_done_callback(lambda done: loop.call_soon_threadsafe(_job_done, done, started))
+    return await asyncio.wrap_future(job)
+
+
+def get_metrics() -> dict:
+    """Snapshot of pool depth and hash latency"""
+    completed = _metrics["completed"]
+    return {
+        "executor": HASH_EXECUTOR,
+        "workers": HASH_WORKERS,
+        "queue_capacity": HASH_QUEUE_SIZE,
+        "in_flight": _pending,
+        "queue_depth": max(0, _pending - HASH_WORKERS),
+        "completed": completed,
+        "rejected": _metrics["rejected"],
+        "failed": _metrics["failed"],
+        "avg_latency_ms": round(_metrics["total_latency_ms"] / completed, 2) if completed else 0.0,
+        "max_latency_ms": round(_metrics["max_latency_ms"], 2),
+        "last_latency_ms": round(_metrics["last_latency_ms"], 2),
+    }
+
+
+def shutdown() -> None:
+    """Stop the hashing pool"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
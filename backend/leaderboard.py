@@ -0,0 +1,275 @@
+"""
+Materialized leaderboard.
+
+One document per user in the `leaderboard` collection holding total_stars,
+puzzles_completed and total_time. Progress writes keep it current with $inc
+deltas, so the top-N query is an indexed range read instead of a scan over
+every profile. Each worker also keeps an in-memory RankIndex of all rows for
+O(log n) rank-of-user and around-me queries; it is warmed from the collection
+at startup, refreshed periodically, and updated by this worker's own writes.
+Top-N always reads the collection, so every worker serves the same board
+including other workers' latest writes.
+
+Run `python leaderboard.py` to rebuild the collection from user_profiles. Server
+startup does the same when the collection is empty, so users who predate it
+start from their full totals rather than from their next delta.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, ReturnDocument
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import asyncio
+import logging
+import os
+
+from rank_index import RankIndex
+
+logger = logging.getLogger(__name__)
+
+# Ranking order used by every leaderboard query
+LEADERBOARD_SORT = [("total_stars", DESCENDING), ("puzzles_completed", DESCENDING), ("user_id", ASCENDING)]
+
+REBUILD_BATCH_SIZE = 1000
+RANK_INDEX_REFRESH_SECONDS = int(os.environ.get("LEADERBOARD_INDEX_REFRESH_SECONDS", 300))
+
+ROW_PROJECTION = {"_id": 0, "user_id": 1, "name": 1, "avatar": 1, "total_stars": 1, "puzzles_completed": 1, "total_time": 1}
+
+rank_index = RankIndex()
+_rank_index_ready = False
+# Rows written while a warm-up is loading, replayed onto the fresh index
+_warming_updates: Optional[Dict[str, dict]] = None
+# Bumped on every index change so readers can tell when rankings moved
+write_count = 0
+
+
+def entry_score(progress: Optional[Dict[str, Any]]) -> Tuple[int, int, float]:
+    """Leaderboard contribution (stars, completed, time) of one level_progress entry"""
+    if not isinstance(progress, dict):
+        return 0, 0, 0.0
+    try:
+        stars = int(progress.get('stars', 0) or 0)
+        best_time = float(progress.get('bestTime') or 0)
+    except (TypeError, ValueError):
+        # Malformed client entries count for nothing
+        return 0, 0, 0.0
+    completed = 1 if progress.get('completed') else 0
+    return stars, completed, best_time
+
+
+def summarize_progress(level_progress: Optional[Dict[str, Any]]) -> Tuple[int, int, float]:
+    """Totals (stars, completed, time) over a whole level_progress dict"""
+    total_stars, puzzles_completed, total_time = 0, 0, 0.0
+    for progress in (level_progress or {}).values():
+        stars, completed, best_time = entry_score(progress)
+        total_stars += stars
+        puzzles_completed += completed
+        total_time += best_time
+    return total_stars, puzzles_completed, total_time
+
+
+def entry_delta(old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]) -> Tuple[int, int, float]:
+    """Change in leaderboard totals when one level_progress entry goes from old to new"""
+    old_score, new_score = entry_score(old), entry_score(new)
+    return tuple(n - o for n, o in zip(new_score, old_score))
+
+
+def progress_delta(old_progress: Optional[Dict[str, Any]], new_progress: Optional[Dict[str, Any]]) -> Tuple[int, int, float]:
+    """Change in leaderboard totals when a whole level_progress dict is replaced"""
+    old_totals, new_totals = summarize_progress(old_progress), summarize_progress(new_progress)
+    return tuple(n - o for n, o in zip(new_totals, old_totals))
+
+
+async def apply_delta(
+    db: AsyncIOMotorDatabase,
+    user: dict,
+    delta: Tuple[int, int, float] = (0, 0, 0.0)
+) -> None:
+    """Atomically add a delta to a user's leaderboard row, creating it if needed"""
+    stars, completed, best_time = delta
+    row = await db.leaderboard.find_one_and_update(
+        {"user_id": user["id"]},
+        {
+            "$inc": {"total_stars": stars, "puzzles_completed": completed, "total_time": best_time},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()},
+            # Renames go through update_identity; token claims may be stale
+            "$setOnInsert": {"name": user.get("name", ""), "avatar": user.get("avatar", "")}
+        },
+        projection=ROW_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    _record(row)
+
+
+async def update_identity(db: AsyncIOMotorDatabase, user_id: str, fields: Dict[str, Any]) -> None:
+    """Copy a changed name or avatar onto the user's leaderboard row"""
+    identity = {k: v for k, v in fields.items() if k in ("name", "avatar")}
+    if identity:
+        await db.leaderboard.update_one({"user_id": user_id}, {"$set": identity})
+        row = rank_index.get(user_id)
+        if row is not None:
+            _record({**row, **identity})
+
+
+def _record(row: dict) -> None:
+    """Apply a written row to the in-memory rank index"""
+    global write_count
+    rank_index.update(row)
+    write_count += 1
+    if _warming_updates is not None:
+        _warming_updates[row["user_id"]] = row
+
+
+async def warm_rank_index(db: AsyncIOMotorDatabase) -> int:
+    """Load every leaderboard row into a fresh rank index and swap it in"""
+    global rank_index, _rank_index_ready, _warming_updates, write_count
+    _warming_updates = {}
+    try:
+        rows = await db.leaderboard.find({}, ROW_PROJECTION).to_list(None)
+        fresh = RankIndex.from_rows(rows)
+        for row in _warming_updates.values():
+            fresh.update(row)
+        rank_index = fresh
+        _rank_index_ready = True
+        write_count += 1
+    finally:
+        _warming_updates = None
+    return len(rank_index)
+
+
+async def run_rank_index_refresher(db: AsyncIOMotorDatabase) -> None:
+    """Background task re-warming the rank index to pick up other workers' writes"""
+    while True:
+        try:
+            size = await warm_rank_index(db)
+            logger.info(f"Leaderboard rank index loaded with {size} rows")
+        except Exception as e:
+            logger.warning(f"Failed to warm leaderboard rank index: {e}")
+        await asyncio.sleep(RANK_INDEX_REFRESH_SECONDS)
+
+
+def _better_than(row: dict) -> dict:
+    """Query matching rows ranked above the given one"""
+    return {"$or": [
+        {"total_stars": {"$gt": row["total_stars"]}},
+        {"total_stars": row["total_stars"], "puzzles_completed": {"$gt": row["puzzles_completed"]}},
+        {"total_stars": row["total_stars"], "puzzles_completed": row["puzzles_completed"], "user_id": {"$lt": row["user_id"]}}
+    ]}
+
+
+async def get_top(db: AsyncIOMotorDatabase, limit: int) -> List[dict]:
+    """Top-N leaderboard rows in rank order, each with its rank"""
+    cursor = db.leaderboard.find({}, ROW_PROJECTION).sort(LEADERBOARD_SORT).limit(limit)
+    rows = await cursor.to_list(length=limit)
+    for idx, row in enumerate(rows):
+        row["rank"] = idx + 1
+    return rows
+
+
+async def _load_row(db: AsyncIOMotorDatabase, user_id: str) -> Optional[dict]:
+    """A user's row from the index, falling back to (and indexing) the stored row"""
+    row = rank_index.get(user_id)
+    if row is None:
+        row = await db.leaderboard.find_one({"user_id": user_id}, ROW_PROJECTION)
+        if row is not None and _rank_index_ready:
+            _record(row)
+    return row
+
+
+async def get_rank(db: AsyncIOMotorDatabase, user_id: str) -> Optional[dict]:
+    """A user's leaderboard row with its rank"""
+    row = await _load_row(db, user_id)
+    if row is None:
+        return None
+
+    if _rank_index_ready:
+        return {**row, "rank": rank_index.rank_of(user_id)}
+    return {**row, "rank": await db.leaderboard.count_documents(_better_than(row)) + 1}
+
+
+async def get_around(db: AsyncIOMotorDatabase, user_id: str, radius: int) -> List[dict]:
+    """Rows within radius ranks of a user, including the user"""
+    me = await get_rank(db, user_id)
+    if me is None:
+        return []
+
+    if _rank_index_ready:
+        return rank_index.around(user_id, radius)
+
+    start = max(0, me["rank"] - 1 - radius)
+    cursor = db.leaderboard.find({}, ROW_PROJECTION).sort(LEADERBOARD_SORT).skip(start).limit(me["rank"] - start + radius)
+    rows = await cursor.to_list(length=None)
+    for offset, row in enumerate(rows):
+        row["rank"] = start + offset + 1
+    return rows
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the indexes backing leaderboard reads and writes"""
+    await db.leaderboard.create_index("user_id", unique=True)
+    await db.leaderboard.create_index(LEADERBOARD_SORT, name="leaderboard_rank")
+
+
+async def rebuild(db: AsyncIOMotorDatabase) -> int:
+    """Recompute every leaderboard row from users and user_profiles"""
+    pipeline = [
+        {"$lookup": {"from": "user_profiles", "localField": "id", "foreignField": "user_id", "as": "profile"}},
+        {"$unwind": {"path": "$profile", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"_id": 0, "id": 1, "name": 1, "avatar": 1, "level_progress": "$profile.level_progress"}}
+    ]
+
+    now = datetime.now(timezone.utc).isoformat()
+    batch, written = [], 0
+    async for user in db.users.aggregate(pipeline):
+        total_stars, puzzles_completed, total_time = summarize_progress(user.get("level_progress"))
+        batch.append(ReplaceOne(
+            {"user_id": user["id"]},
+            {
+                "user_id": user["id"],
+                "name": user.get("name", ""),
+                "avatar": user.get("avatar", ""),
+                "total_stars": total_stars,
+                "puzzles_completed": puzzles_completed,
+                "total_time": total_time,
+                "updated_at": now
+            },
+            upsert=True
+        ))
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            await db.leaderboard.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+
+    if batch:
+        await db.leaderboard.bulk_write(batch, ordered=False)
+        written += len(batch)
+
+    return written
+
+
+async def ensure_populated(db: AsyncIOMotorDatabase) -> int:
+    """Rebuild the leaderboard if it is empty while users exist, returning rows written"""
+    if await db.leaderboard.find_one({}, {"_id": 1}) is not None:
+        return 0
+    if await db.users.find_one({}, {"_id": 1}) is None:
+        return 0
+    return await rebuild(db)
+
+
+async def _rebuild_main() -> None:
+    from database import get_database, close_client
+
+    db = get_database()
+    await ensure_indexes(db)
+    written = await rebuild(db)
+    logger.info(f"Rebuilt {written} leaderboard rows")
+    close_client()
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+    from dotenv import load_dotenv
+
+    load_dotenv(Path(__file__).parent / '.env')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(_rebuild_main())
@@ -0,0 +1,78 @@
+"""
+Pre-serialized leaderboard snapshots.
+
+The top-N leaderboard is rendered to JSON bytes in the background, either on
+a fixed schedule or as soon as enough leaderboard writes have accumulated.
+GET /leaderboard serves those bytes as-is with a content-hash ETag, so
+unchanged boards cost a 304 and changed ones cost no serialization.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from typing import Optional
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from models import LeaderboardEntry
+import leaderboard
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_SIZE = int(os.environ.get("LEADERBOARD_SNAPSHOT_SIZE", 100))
+SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get("LEADERBOARD_SNAPSHOT_INTERVAL_SECONDS", 5))
+SNAPSHOT_CHANGE_THRESHOLD = int(os.environ.get("LEADERBOARD_SNAPSHOT_CHANGE_THRESHOLD", 50))
+SNAPSHOT_POLL_SECONDS = 0.5
+
+# {"body": bytes, "etag": str, "generated_at": float, "checked_at": float, "write_count": int}
+# generated_at is when the content last changed; checked_at is the last regeneration.
+_snapshot: Optional[dict] = None
+
+
+def get_snapshot() -> Optional[dict]:
+    """The current snapshot, if one has been generated"""
+    return _snapshot
+
+
+def snapshot_age(snapshot: dict) -> float:
+    """Seconds since the snapshot content last changed"""
+    return max(0.0, time.time() - snapshot["generated_at"])
+
+
+def is_due(snapshot: Optional[dict]) -> bool:
+    """Whether the schedule or the change threshold calls for a regeneration"""
+    if snapshot is None:
+        return True
+    if leaderboard.write_count - snapshot["write_count"] >= SNAPSHOT_CHANGE_THRESHOLD:
+        return True
+    return time.time() - snapshot["checked_at"] >= SNAPSHOT_INTERVAL_SECONDS
+
+
+async def generate(db: AsyncIOMotorDatabase) -> dict:
+    """Render the top-N leaderboard to bytes and publish it"""
+    global _snapshot
+    now = time.time()
+    write_count = leaderboard.write_count
+    rows = await leaderboard.get_top(db, SNAPSHOT_SIZE)
+    entries = [LeaderboardEntry(**row).model_dump() for row in rows]
+    body = json.dumps(entries, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+    generated_at = now
+    if _snapshot is not None and _snapshot["etag"] == etag:
+        generated_at = _snapshot["generated_at"]
+
+    _snapshot = {"body": body, "etag": etag, "generated_at": generated_at, "checked_at": now, "write_count": write_count}
+    return _snapshot
+
+
+async def run_snapshot_refresher(db: AsyncIOMotorDatabase) -> None:
+    """Background task regenerating the snapshot on schedule or change threshold"""
+    while True:
+        if is_due(_snapshot):
+            try:
+                await generate(db)
+            except Exception as e:
+                logger.warning(f"Failed to generate leaderboard snapshot: {e}")
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
@@ -0,0 +1,129 @@
+"""
+Time-bucketed leaderboards for tournaments.
+
+Every level completion adds what it improved to pre-aggregated counters in
+`leaderboard_buckets`: the player's row for the current UTC day, for the
+current ISO week, and for each of the seven rolling weeks that include today
+(rolling7 bucket D covers days D-6 through D). A TTL index drops old buckets.
+
+The improvement is the entry's leaderboard delta (completion_gain): stars
+above the entry's previous best, one completion the first time the puzzle is
+completed, and that completion's time. Replaying a finished puzzle earns
+nothing, so tournaments cannot be farmed by repetition.
+
+Windows served, each an indexed top-N read of one bucket:
+- today: the current day bucket
+- week:  the current ISO week bucket
+- 7d:    the rolling7 bucket ending today
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+import os
+
+import leaderboard
+
+DAY_RETENTION_DAYS = int(os.environ.get("LEADERBOARD_DAY_RETENTION_DAYS", 8))
+WEEK_RETENTION_WEEKS = int(os.environ.get("LEADERBOARD_WEEK_RETENTION_WEEKS", 5))
+
+BUCKET_SORT = [("total_stars", DESCENDING), ("puzzles_completed", DESCENDING), ("user_id", ASCENDING)]
+BUCKET_PROJECTION = {"_id": 0, "user_id": 1, "name": 1, "avatar": 1, "total_stars": 1, "puzzles_completed": 1, "total_time": 1}
+
+
+def day_bucket(moment: datetime) -> str:
+    """Day bucket label, e.g. 2026-10-18"""
+    return moment.strftime("%Y-%m-%d")
+
+
+def week_bucket(moment: datetime) -> str:
+    """ISO week bucket label, e.g. 2026-W42"""
+    year, week, _ = moment.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def _day_start(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def completion_gain(old: Optional[Dict[str, Any]], new: Optional[Dict[str, Any]]) -> Tuple[int, int, float]:
+    """Window counters (stars, completions, time) earned when one level_progress entry goes from old to new"""
+    stars, completed, time_taken = leaderboard.entry_delta(old, new)
+    if completed <= 0:
+        # Not a first completion: a faster time earns nothing, a better star count only its stars
+        time_taken = 0.0
+    return min(3, max(0, stars)), max(0, completed), max(0.0, time_taken)
+
+
+async def record_completion(
+    db: AsyncIOMotorDatabase,
+    user: dict,
+    gain: Tuple[int, int, float],
+    completed_at: Optional[datetime] = None
+) -> None:
+    """Add a completion_gain total to the user's day, week and rolling-week buckets"""
+    stars, completions, time_taken = gain
+    if not (stars or completions):
+        return
+    moment = completed_at or datetime.now(timezone.utc)
+    day_start = _day_start(moment)
+    week_start = day_start - timedelta(days=moment.isoweekday() - 1)
+
+    buckets = [
+        ("day", day_bucket(moment), day_start + timedelta(days=DAY_RETENTION_DAYS)),
+        ("week", week_bucket(moment), week_start + timedelta(weeks=WEEK_RETENTION_WEEKS)),
+    ]
+    # The rolling week ending on each of the next seven days includes this completion;
+    # each is kept until a day after it stops being current
+    buckets += [
+        ("rolling7", day_bucket(day_start + timedelta(days=offset)), day_start + timedelta(days=offset + 2))
+        for offset in range(7)
+    ]
+    await db.leaderboard_buckets.bulk_write([
+        UpdateOne(
+            {"window": window, "bucket": bucket, "user_id": user["id"]},
+            {
+                "$inc": {"total_stars": stars, "puzzles_completed": completions, "total_time": float(time_taken or 0)},
+                "$setOnInsert": {"name": user.get("name", ""), "avatar": user.get("avatar", ""), "expires_at": expires_at}
+            },
+            upsert=True
+        )
+        for window, bucket, expires_at in buckets
+    ], ordered=False)
+
+
+async def update_identity(db: AsyncIOMotorDatabase, user_id: str, fields: Dict[str, Any]) -> None:
+    """Copy a changed name or avatar onto the user's live bucket rows"""
+    identity = {k: v for k, v in fields.items() if k in ("name", "avatar")}
+    if identity:
+        await db.leaderboard_buckets.update_many({"user_id": user_id}, {"$set": identity})
+
+
+async def get_window(db: AsyncIOMotorDatabase, window: str, limit: int) -> List[dict]:
+    """Top-N rows of a windowed leaderboard, each with its rank"""
+    now = datetime.now(timezone.utc)
+
+    if window == "today":
+        query = {"window": "day", "bucket": day_bucket(now)}
+    elif window == "7d":
+        query = {"window": "rolling7", "bucket": day_bucket(now)}
+    else:
+        query = {"window": "week", "bucket": week_bucket(now)}
+    cursor = db.leaderboard_buckets.find(query, BUCKET_PROJECTION).sort(BUCKET_SORT).limit(limit)
+    rows = await cursor.to_list(length=limit)
+
+    for idx, row in enumerate(rows):
+        row["rank"] = idx + 1
+    return rows
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the indexes backing bucket writes, top-N reads and expiry"""
+    await db.leaderboard_buckets.create_index(
+        [("window", ASCENDING), ("bucket", ASCENDING), ("user_id", ASCENDING)], unique=True
+    )
+    await db.leaderboard_buckets.create_index(
+        [("window", ASCENDING), ("bucket", ASCENDING)] + BUCKET_SORT, name="bucket_rank"
+    )
+    await db.leaderboard_buckets.create_index("user_id")
+    await db.leaderboard_buckets.create_index("expires_at", expireAfterSeconds=0)
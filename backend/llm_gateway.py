@@ -0,0 +1,465 @@
+"""
+Shared LLM call layer.
+
+Every model call goes through complete(). Calls are identified by a SHA-256
+of the provider, model, system message and whitespace-normalized prompt:
+
+- Identical calls that overlap share one in-flight request; the others await
+  its result instead of starting their own.
+- Successful responses are cached for LLM_CACHE_TTL seconds, with at most
+  LLM_CACHE_SIZE entries (least recently used evicted first). The last good
+  response per key is also kept past its TTL and served if a new call fails.
+
+Callers that need fresh output every time (the puzzle pool refiller) pass
+cached=False, which skips the cache, the stale fallback and coalescing.
+
+Outbound calls are protected so a slow or failing provider cannot pile up
+work in the worker:
+
+- At most LLM_MAX_CONCURRENCY calls run at once and LLM_QUEUE_SIZE more may
+  wait; beyond that calls are rejected immediately.
+- The whole call, retries and time queued for a slot included, has
+  LLM_DEADLINE_SECONDS; each provider call also has LLM_CALL_TIMEOUT_SECONDS.
+  Timeouts and transient provider errors (connection failures, 408/429/5xx)
+  are retried up to LLM_MAX_ATTEMPTS times with jittered exponential
+  backoff, but no retry starts with less than MIN_ATTEMPT_SECONDS left.
+- A circuit breaker opens when at least half of the calls in the last minute
+  failed, rejecting calls without contacting the provider for a cooldown, then
+  lets one probe call through to decide whether to close again. A probe that
+  is cancelled (its caller gave up) counts as failed, so the breaker never
+  waits on a probe that will not report.
+
+Rejections raise LLMUnavailableError, and timed out calls asyncio.TimeoutError,
+so routes can answer 503/504 or fall back to pooled content.
+
+stream() is the chunked counterpart of complete(). LlmChat only returns whole
+responses, so it calls the provider through litellm's acompletion(stream=True)
+and yields text as the deltas arrive (LLM_API_BASE overrides the endpoint,
+e.g. to route a universal key through its proxy). It shares the concurrency
+limit, breaker and deadline with complete(), with LLM_CALL_TIMEOUT_SECONDS as
+the longest wait for the next chunk. An attempt is retried only before its
+first chunk, since text already yielded cannot be taken back. Cache hits are
+yielded whole, and a completed stream is cached like a complete() response;
+streams are not coalesced.
+"""
+from cachetools import LRUCache, TTLCache
+from collections import deque
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, stop_before_delay, wait_random_exponential
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, Optional
+import asyncio
+import hashlib
+import math
+import os
+import random
+import time
+
+from emergentintegrations.llm.chat import LlmChat, UserMessage
+from litellm import acompletion
+
+LLM_PROVIDER = "openai"
+LLM_MODEL = "gpt-5"
+LLM_API_BASE = os.environ.get("LLM_API_BASE")
+
+CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", 1000))
+CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 3600))
+
+MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", 32))
+CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", 30))
+DEADLINE_SECONDS = float(os.environ.get("LLM_DEADLINE_SECONDS", 60))
+MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", 3))
+MIN_ATTEMPT_SECONDS = 5.0
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_MAX_BACKOFF_SECONDS = 4.0
+
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+BREAKER_WINDOW_SECONDS = 60
+BREAKER_MIN_CALLS = 10
+BREAKER_ERROR_RATE = 0.5
+BREAKER_COOLDOWN_SECONDS = int(os.environ.get("LLM_BREAKER_COOLDOWN_SECONDS", 30))
+
+
+class LLMUnavailableError(Exception):
+    """The call was rejected without contacting the provider"""
+
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Error-rate circuit breaker over a sliding time window"""
+
+    def __init__(self, window_seconds: float, min_calls: int, error_rate: float, cooldown_seconds: float):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown_seconds = cooldown_seconds
+        self._results: deque = deque()  # (monotonic time, succeeded)
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.cooldown_seconds:
+            return "open"
+        return "half_open"
+
+    def retry_after(self) -> int:
+        """Seconds until the breaker lets a probe through"""
+        if self._opened_at is None:
+            return 1
+        return max(1, math.ceil(self.cooldown_seconds - (time.monotonic() - self._opened_at)))
+
+    def allow(self) -> bool:
+        """Whether a call may go to the provider now"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, succeeded: bool) -> None:
+        now = time.monotonic()
+        if self._opened_at is not None:
+            # Only the half-open probe decides; late results from before opening are ignored
+            if self._probing:
+                self._probing = False
+                if succeeded:
+                    self._opened_at = None
+                    self._results.clear()
+                    self._failures = 0
+                else:
+                    self._opened_at = now
+            return
+
+        self._results.append((now, succeeded))
+        self._failures += not succeeded
+        while self._results and self._results[0][0] < now - self.window_seconds:
+            _, old = self._results.popleft()
+            self._failures -= not old
+        calls = len(self._results)
+        if calls >= self.min_calls and self._failures / calls >= self.error_rate:
+            self._opened_at = now
+            self.opens += 1
+
+
+_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_stale = LRUCache(maxsize=CACHE_SIZE)
+_in_flight: Dict[str, asyncio.Task] = {}
+_breaker = CircuitBreaker(BREAKER_WINDOW_SECONDS, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE, BREAKER_COOLDOWN_SECONDS)
+_slots: Optional[asyncio.Semaphore] = None
+
+# Attempts admitted to the provider (running + waiting for a slot)
+_admitted = 0
+
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "coalesced": 0,
+    "uncached": 0,
+    "stale": 0,
+    "errors": 0,
+    "timeouts": 0,
+    "retries": 0,
+    "rejected": 0,
+}
+
+
+def llm_key() -> str:
+    """The configured LLM key, or an empty string when AI features are off"""
+    return os.environ.get("EMERGENT_LLM_KEY", "")
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def cache_key(system_message: str, prompt: str, provider: str = LLM_PROVIDER, model: str = LLM_MODEL) -> str:
+    """Identity of a call: same key, same expected response"""
+    parts = (provider, model, _normalize(system_message), _normalize(prompt))
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def available() -> bool:
+    """False while the circuit breaker is rejecting calls"""
+    return _breaker.state != "open"
+
+
+def _get_slots() -> asyncio.Semaphore:
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _slots
+
+
+def _is_transient(error: BaseException) -> bool:
+    """Whether a failed attempt is worth retrying"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status in TRANSIENT_STATUS_CODES
+
+
+def _admit() -> bool:
+    """Reject an attempt when the queue is full or the breaker is open; returns whether it is the half-open probe"""
+    if _admitted >= MAX_CONCURRENCY + QUEUE_SIZE:
+        _stats["rejected"] += 1
+        raise LLMUnavailableError("AI service is busy, please retry", 1)
+    probe = _breaker.state == "half_open"
+    if not _breaker.allow():
+        _stats["rejected"] += 1
+        raise LLMUnavailableError("AI service is temporarily unavailable", _breaker.retry_after())
+    return probe
+
+
+async def _attempt(system_message: str, prompt: str, session_id: str, provider: str, model: str, deadline: float) -> str:
+    """One provider call under the concurrency limit and breaker, finished by the deadline"""
+    global _admitted
+    probe = _admit()
+
+    started = False
+    succeeded: Optional[bool] = None
+
+    async def call() -> str:
+        nonlocal started, succeeded
+        async with _get_slots():
+            started = True
+            chat = LlmChat(
+                api_key=llm_key(),
+                session_id=session_id,
+                system_message=system_message
+            ).with_model(provider, model)
+            try:
+                response = await asyncio.wait_for(chat.send_message(UserMessage(text=prompt)), CALL_TIMEOUT_SECONDS)
+            except Exception:
+                succeeded = False
+                raise
+            succeeded = True
+            return response
+
+    _admitted += 1
+    try:
+        # Waiting for a slot counts against the deadline too
+        return await asyncio.wait_for(call(), deadline - time.monotonic())
+    except asyncio.TimeoutError:
+        _stats["timeouts"] += 1
+        if started:
+            succeeded = False
+        raise
+    except Exception:
+        _stats["errors"] += 1
+        raise
+    finally:
+        _admitted -= 1
+        if succeeded is not None:
+            _breaker.record(succeeded)
+        elif probe:
+            # Cancelled before the provider answered; an unreported probe would hold the breaker half-open
+            _breaker.record(False)
+
+
+async def _send(system_message: str, prompt: str, session_id: str, provider: str, model: str) -> str:
+    """Attempts with jittered backoff, all within DEADLINE_SECONDS"""
+    deadline = time.monotonic() + DEADLINE_SECONDS
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(MAX_ATTEMPTS) | stop_before_delay(DEADLINE_SECONDS - MIN_ATTEMPT_SECONDS),
+        wait=wait_random_exponential(multiplier=RETRY_BACKOFF_SECONDS, max=RETRY_MAX_BACKOFF_SECONDS),
+        retry=retry_if_exception(_is_transient),
+        reraise=True
+    ):
+        with attempt:
+            if attempt.retry_state.attempt_number > 1:
+                _stats["retries"] += 1
+            return await _attempt(system_message, prompt, session_id, provider, model, deadline)
+
+
+def _finish(key: str, task: asyncio.Task) -> None:
+    _in_flight.pop(key, None)
+    if task.cancelled():
+        return
+    # Retrieving the exception also keeps asyncio from warning when no caller is left waiting
+    if task.exception() is None:
+        _cache[key] = _stale[key] = task.result()
+
+
+async def complete(
+    system_message: str,
+    prompt: str,
+    session_id: str,
+    provider: str = LLM_PROVIDER,
+    model: str = LLM_MODEL,
+    cached: bool = True
+) -> str:
+    """Model response for a prompt, from the cache or a shared in-flight call when possible"""
+    if not cached:
+        _stats["uncached"] += 1
+        return await _send(system_message, prompt, session_id, provider, model)
+
+    key = cache_key(system_message, prompt, provider, model)
+    response = _cache.get(key)
+    if response is not None:
+        _stats["hits"] += 1
+        return response
+
+    task = _in_flight.get(key)
+    if task is not None:
+        _stats["coalesced"] += 1
+    else:
+        _stats["misses"] += 1
+        task = asyncio.ensure_future(_send(system_message, prompt, session_id, provider, model))
+        task.add_done_callback(lambda done: _finish(key, done))
+        _in_flight[key] = task
+
+    # Shielded so one caller disconnecting does not cancel the call for the others
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        response = _stale.get(key)
+        if response is None:
+            raise
+        _stats["stale"] += 1
+        return response
+
+
+async def _attempt_stream(system_message: str, prompt: str, provider: str, model: str, deadline: float) -> AsyncIterator[str]:
+    """One streamed provider call under the concurrency limit and breaker, finished by the deadline"""
+    global _admitted
+    probe = _admit()
+    slots = _get_slots()
+    acquired = received = False
+    succeeded: Optional[bool] = None
+    options = {"api_base": LLM_API_BASE} if LLM_API_BASE else {}
+
+    _admitted += 1
+    try:
+        # Waiting for a slot counts against the deadline too
+        await asyncio.wait_for(slots.acquire(), deadline - time.monotonic())
+        acquired = True
+        response = await asyncio.wait_for(acompletion(
+            model=model,
+            custom_llm_provider=provider,
+            messages=[{"role": "system", "content": system_message}, {"role": "user", "content": prompt}],
+            api_key=llm_key(),
+            stream=True,
+            **options
+        ), min(CALL_TIMEOUT_SECONDS, deadline - time.monotonic()))
+        chunks = response.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), min(CALL_TIMEOUT_SECONDS, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                break
+            received = True
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                yield text
+        succeeded = True
+    except (asyncio.CancelledError, GeneratorExit):
+        # The consumer went away: a provider that was sending did its part
+        if received:
+            succeeded = True
+        raise
+    except asyncio.TimeoutError:
+        _stats["timeouts"] += 1
+        if acquired:
+            succeeded = False
+        raise
+    except Exception:
+        _stats["errors"] += 1
+        if acquired:
+            succeeded = False
+        raise
+    finally:
+        _admitted -= 1
+        if acquired:
+            slots.release()
+        if succeeded is not None:
+            _breaker.record(succeeded)
+        elif probe:
+            _breaker.record(False)
+
+
+async def _send_stream(system_message: str, prompt: str, provider: str, model: str) -> AsyncIterator[str]:
+    """Streamed attempts with jittered backoff, retried only until the first chunk, all within DEADLINE_SECONDS"""
+    deadline = time.monotonic() + DEADLINE_SECONDS
+    attempt = 0
+    while True:
+        attempt += 1
+        sent = False
+        try:
+            async with aclosing(_attempt_stream(system_message, prompt, provider, model, deadline)) as chunks:
+                async for text in chunks:
+                    sent = True
+                    yield text
+            return
+        except Exception as e:
+            backoff = random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** attempt))
+            if sent or attempt >= MAX_ATTEMPTS or not _is_transient(e) or deadline - time.monotonic() - backoff < MIN_ATTEMPT_SECONDS:
+                raise
+        _stats["retries"] += 1
+        await asyncio.sleep(backoff)
+
+
+async def stream(
+    system_message: str,
+    prompt: str,
+    session_id: str,
+    provider: str = LLM_PROVIDER,
+    model: str = LLM_MODEL,
+    cached: bool = True
+) -> AsyncIterator[str]:
+    """Model response text in chunks, as the provider produces it"""
+    key = cache_key(system_message, prompt, provider, model)
+    if cached:
+        response = _cache.get(key)
+        if response is not None:
+            _stats["hits"] += 1
+            yield response
+            return
+        _stats["misses"] += 1
+    else:
+        _stats["uncached"] += 1
+
+    parts = []
+    try:
+        async with aclosing(_send_stream(system_message, prompt, provider, model)) as chunks:
+            async for text in chunks:
+                parts.append(text)
+                yield text
+    except Exception:
+        response = _stale.get(key) if cached and not parts else None
+        if response is None:
+            raise
+        _stats["stale"] += 1
+        yield response
+        return
+    if cached:
+        _cache[key] = _stale[key] = "".join(parts)
+
+
+def get_metrics() -> dict:
+    """Cache, coalescing and provider protection counters for LLM calls"""
+    hits = _stats["hits"]
+    lookups = hits + _stats["misses"] + _stats["coalesced"]
+    return {
+        "size": len(_cache),
+        "capacity": CACHE_SIZE,
+        "ttl_seconds": CACHE_TTL,
+        "in_flight": len(_in_flight),
+        "concurrency": MAX_CONCURRENCY,
+        "admitted": _admitted,
+        "breaker": _breaker.state,
+        "breaker_opens": _breaker.opens,
+        **_stats,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "shared_rate": round((hits + _stats["coalesced"]) / lookups, 4) if lookups else 0.0,
+    }
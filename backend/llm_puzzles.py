@@ -0,0 +1,184 @@
+"""
+LLM puzzle generation helpers shared by the AI routes and the puzzle pool.
+"""
+from contextlib import aclosing
+from typing import AsyncIterator, List, Any
+import json
+import logging
+
+from models import GeneratedPuzzle
+import llm_gateway
+
+logger = logging.getLogger(__name__)
+
+PUZZLE_SYSTEM_MESSAGE = "You are a creative puzzle designer who creates engaging brain teasers and puzzles. Always respond with valid JSON."
+DEFAULT_HINT = "Think carefully about the clues given."
+
+
+def puzzle_prompt(category: str, difficulty: str, count: int) -> str:
+    return f"""Generate {count} unique {difficulty} {category} puzzle(s).
+
+Category: {category}
+Difficulty: {difficulty}
+
+For each puzzle, provide:
+1. An engaging question
+2. The correct answer
+3. A helpful hint
+4. A clear explanation of the solution
+
+Format your response as a JSON array with this structure:
+[
+  {{
+    "question": "the puzzle question",
+    "answer": "the correct answer",
+    "hint": "a helpful hint",
+    "explanation": "explanation of the solution"
+  }}
+]
+
+Make the puzzles creative, engaging, and appropriate for the difficulty level.
+For {category} puzzles, ensure they match the category theme.
+Keep questions concise and answers short (1-3 words)."""
+
+
+def extract_json(response_text: str) -> Any:
+    """Parse a JSON response, tolerating a surrounding markdown code fence"""
+    response_text = response_text.strip()
+    if "```json" in response_text:
+        response_text = response_text.split("```json")[1].split("```")[0].strip()
+    elif "```" in response_text:
+        response_text = response_text.split("```")[1].split("```")[0].strip()
+    return json.loads(response_text)
+
+
+def to_puzzle(puzzle_data: dict, category: str, difficulty: str) -> GeneratedPuzzle:
+    """Build a GeneratedPuzzle from one item of the model's JSON array"""
+    return GeneratedPuzzle(
+        question=puzzle_data["question"],
+        answer=puzzle_data["answer"],
+        hint=puzzle_data.get("hint") or DEFAULT_HINT,
+        explanation=puzzle_data.get("explanation", ""),
+        category=category,
+        difficulty=difficulty
+    )
+
+
+def parse_puzzles(response_text: str, category: str, difficulty: str) -> List[GeneratedPuzzle]:
+    """Valid puzzles from a full model response; malformed items are skipped"""
+    puzzles_data = extract_json(response_text)
+    if not isinstance(puzzles_data, list):
+        raise ValueError("Expected a JSON array of puzzles")
+
+    puzzles = []
+    for puzzle_data in puzzles_data:
+        try:
+            puzzle = to_puzzle(puzzle_data, category, difficulty)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Skipping malformed generated puzzle: {e}")
+            continue
+        if puzzle.question.strip() and puzzle.answer.strip():
+            puzzles.append(puzzle)
+    return puzzles
+
+
+class PuzzleArrayParser:
+    """
+    Incremental parser for the model's JSON array of puzzles.
+
+    feed() accepts response text in arbitrary chunks and returns each top-level
+    object as soon as its closing brace arrives. The array starts at the first
+    "[" followed, after any whitespace, by "{"; text before it (prose such as
+    "Here are [3] puzzles:", a ```json fence) and after its closing bracket is
+    ignored.
+    """
+
+    def __init__(self):
+        # Saw a "[" and waiting to see whether an object follows
+        self._opened = False
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._buffer: List[str] = []
+
+    def feed(self, chunk: str) -> List[dict]:
+        objects = []
+        for char in chunk:
+            if self._finished:
+                break
+            if not self._started:
+                if self._opened and char.isspace():
+                    continue
+                if not (self._opened and char == "{"):
+                    self._opened = char == "["
+                    continue
+                self._started = True
+            if self._depth == 0:
+                # Between array items: only an object start or the array end matters
+                if char == "{":
+                    self._depth = 1
+                    self._buffer = [char]
+                elif char == "]":
+                    self._finished = True
+                continue
+
+            self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    text, self._buffer = "".join(self._buffer), []
+                    try:
+                        objects.append(json.loads(text))
+                    except ValueError as e:
+                        logger.warning(f"Skipping unparseable generated puzzle: {e}")
+        return objects
+
+
+async def stream_puzzles(
+    category: str,
+    difficulty: str,
+    count: int,
+    session_id: str,
+    cached: bool = True
+) -> AsyncIterator[GeneratedPuzzle]:
+    """Valid puzzles from the model, each yielded as soon as its JSON object is complete"""
+    parser = PuzzleArrayParser()
+    chunks = llm_gateway.stream(PUZZLE_SYSTEM_MESSAGE, puzzle_prompt(category, difficulty, count), session_id, cached=cached)
+    # Closed as soon as the caller stops reading, so the provider call and its slot are released
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            for puzzle_data in parser.feed(chunk):
+                try:
+                    puzzle = to_puzzle(puzzle_data, category, difficulty)
+                except (KeyError, TypeError, ValueError) as e:
+                    logger.warning(f"Skipping malformed generated puzzle: {e}")
+                    continue
+                if puzzle.question.strip() and puzzle.answer.strip():
+                    yield puzzle
+
+
+async def request_puzzles(
+    category: str,
+    difficulty: str,
+    count: int,
+    session_id: str,
+    cached: bool = True
+) -> List[GeneratedPuzzle]:
+    """Ask the model for puzzles and return the valid ones; cached=False forces a fresh call"""
+    response = await llm_gateway.complete(
+        PUZZLE_SYSTEM_MESSAGE, puzzle_prompt(category, difficulty, count), session_id, cached=cached
+    )
+    return parse_puzzles(response, category, difficulty)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Literal
 from datetime import datetime, timezone
 import uuid
 
@@ -100,3 +100,32 @@ class ProgressSync(BaseModel):
     settings: Optional[Settings] = None
     achievements: Optional[List[str]] = None
     stats: Optional[Dict[str, Any]] = None
+
+
+class ProgressDeltaSync(BaseModel):
+    base_version: int = 0
+    changes: Dict[str, Dict[str, Any]] = Field(default_factory=dict)
+    settings: Optional[Settings] = None
+    achievements: Optional[List[str]] = None
+    stats: Optional[Dict[str, Any]] = None
+
+
+class PuzzleEventIn(BaseModel):
+    type: Literal["attempt", "fail", "hint"]
+    puzzle_id: int = Field(ge=0)
+    ts: Optional[datetime] = None
+    time_taken: Optional[float] = Field(default=None, ge=0)
+    category: Optional[str] = Field(default=None, max_length=32)
+
+
+class PuzzleEventBatch(BaseModel):
+    events: List[PuzzleEventIn] = Field(max_length=100)
+
+
+class GeneratedPuzzle(BaseModel):
+    question: str
+    answer: str
+    hint: str
+    explanation: str
+    category: str
+    difficulty: str
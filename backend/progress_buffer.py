@@ -0,0 +1,235 @@
+"""
+Write-behind buffer for level completions.
+
+With PROGRESS_WRITE_BEHIND enabled, /progress/complete acknowledges a
+completion once it is queued here. Completions are coalesced per user and
+puzzle with the progress_merge rules, so a burst of TimeAttack runs on one
+level becomes a single merge. Buffers are flushed when they reach
+PROGRESS_BUFFER_MAX_EVENTS, when the oldest queued event is
+PROGRESS_BUFFER_MAX_STALENESS_SECONDS old, and on shutdown.
+
+Flushing a user runs several writes, and the profile merge, leaderboard
+delta and window counters are increments. A buffer records each step as it
+succeeds; when a later step fails it is kept aside and the next flush resumes
+after the last completed step instead of applying the increments twice.
+
+Buffered completions live in this worker's memory until flushed: a crash
+loses at most one staleness window of completions. The flusher shields each
+flush, so cancelling it at shutdown lets a flush in progress finish, and the
+shutdown flush then writes whatever is left.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterator, List, Optional
+import asyncio
+import logging
+import os
+import time
+
+import leaderboard
+import leaderboard_windows
+import progress_store
+from progress_merge import normalize_change, merge_entry
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.environ.get("PROGRESS_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+MAX_EVENTS = int(os.environ.get("PROGRESS_BUFFER_MAX_EVENTS", 500))
+MAX_STALENESS_SECONDS = float(os.environ.get("PROGRESS_BUFFER_MAX_STALENESS_SECONDS", 2))
+POLL_SECONDS = 0.25
+
+
+class _UserBuffer:
+    __slots__ = (
+        "user", "changes", "completed_at", "events", "first_at",
+        "old_entries", "merged", "leaderboard_applied", "windows_recorded"
+    )
+
+    def __init__(self, user: dict):
+        self.user = user
+        # puzzle id -> coalesced change
+        self.changes: Dict[str, Dict[str, Any]] = {}
+        # Latest queued completion, the time the windowed leaderboards credit
+        self.completed_at: Optional[datetime] = None
+        self.events = 0
+        self.first_at = time.monotonic()
+        # Flush progress: set once the profile merge, leaderboard delta and window counters are written
+        self.old_entries: Dict[str, dict] = {}
+        self.merged: Optional[Dict[str, dict]] = None
+        self.leaderboard_applied = False
+        self.windows_recorded = False
+
+
+_buffers: Dict[str, _UserBuffer] = {}
+# Buffers whose profile merge is written but a later step failed
+_resuming: List[_UserBuffer] = []
+_events = 0
+_flush_lock: Optional[asyncio.Lock] = None
+_flush_wanted: Optional[asyncio.Event] = None
+
+_metrics = {
+    "buffered": 0,
+    "flushes": 0,
+    "flushed_events": 0,
+    "failed_flushes": 0,
+    "total_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "last_flush_ms": 0.0,
+}
+
+
+def _wake() -> asyncio.Event:
+    global _flush_wanted
+    if _flush_wanted is None:
+        _flush_wanted = asyncio.Event()
+    return _flush_wanted
+
+
+def _merge_into(buffer: _UserBuffer, changes: Dict[str, Dict[str, Any]]) -> None:
+    for puzzle_id, change in changes.items():
+        buffer.changes[puzzle_id] = merge_entry(buffer.changes.get(puzzle_id), change)
+
+
+def add_completion(user: dict, puzzle_id: str, change: Dict[str, Any]) -> Dict[str, Any]:
+    """Queue one completion, returning the normalized change (raises ValueError/TypeError on bad values)"""
+    global _events
+    normalized = normalize_change(change)
+    buffer = _buffers.get(user["id"])
+    if buffer is None:
+        buffer = _buffers[user["id"]] = _UserBuffer(user)
+    _merge_into(buffer, {puzzle_id: normalized})
+
+    buffer.completed_at = datetime.now(timezone.utc)
+    buffer.events += 1
+    _events += 1
+    _metrics["buffered"] += 1
+    if _events >= MAX_EVENTS:
+        _wake().set()
+    return normalized
+
+
+def _queued() -> Iterator[_UserBuffer]:
+    yield from _buffers.values()
+    yield from _resuming
+
+
+def _is_due() -> bool:
+    if _events >= MAX_EVENTS:
+        return True
+    oldest = min((buffer.first_at for buffer in _queued()), default=None)
+    return oldest is not None and time.monotonic() - oldest >= MAX_STALENESS_SECONDS
+
+
+async def _flush_user(db: AsyncIOMotorDatabase, buffer: _UserBuffer) -> None:
+    """Write one user's buffer, skipping the steps a previous attempt completed"""
+    user_id = buffer.user["id"]
+    if buffer.merged is None:
+        buffer.old_entries, buffer.merged, _, _ = await progress_store.merge_progress(db, user_id, buffer.changes)
+    if not buffer.leaderboard_applied:
+        delta = (0, 0, 0.0)
+        for puzzle_id, entry in buffer.merged.items():
+            delta = tuple(d + e for d, e in zip(delta, leaderboard.entry_delta(buffer.old_entries.get(puzzle_id), entry)))
+        await leaderboard.apply_delta(db, buffer.user, delta)
+        buffer.leaderboard_applied = True
+    if not buffer.windows_recorded:
+        gain = (0, 0, 0.0)
+        for puzzle_id, entry in buffer.merged.items():
+            gain = tuple(g + e for g, e in zip(gain, leaderboard_windows.completion_gain(buffer.old_entries.get(puzzle_id), entry)))
+        await leaderboard_windows.record_completion(db, buffer.user, gain, buffer.completed_at)
+        buffer.windows_recorded = True
+    # Plain $set upserts, safe to repeat
+    await progress_store.upsert_puzzle_progress(db, user_id, buffer.merged, trusted=True)
+
+
+def _requeue(buffer: _UserBuffer) -> None:
+    """Put an unwritten user's buffer back so the next flush retries it"""
+    global _events
+    _events += buffer.events
+    if buffer.merged is not None:
+        # Partly written: keep it apart so its merge is not applied again
+        _resuming.append(buffer)
+        return
+    current = _buffers.get(buffer.user["id"])
+    if current is None:
+        _buffers[buffer.user["id"]] = buffer
+    else:
+        _merge_into(current, buffer.changes)
+        current.completed_at = max(current.completed_at, buffer.completed_at)
+        current.events += buffer.events
+        current.first_at = min(current.first_at, buffer.first_at)
+
+
+async def flush(db: AsyncIOMotorDatabase) -> int:
+    """Write every buffered completion, returning how many events were flushed"""
+    global _buffers, _resuming, _events, _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+
+    async with _flush_lock:
+        if not _buffers and not _resuming:
+            return 0
+        queue = _resuming + list(_buffers.values())
+        _buffers, _resuming = {}, []
+        _events = 0
+        _wake().clear()
+
+        started = time.perf_counter()
+        flushed = done = 0
+        try:
+            for buffer in queue:
+                try:
+                    await _flush_user(db, buffer)
+                    flushed += buffer.events
+                except Exception as e:
+                    _metrics["failed_flushes"] += 1
+                    logger.warning(f"Failed to flush buffered progress for {buffer.user['id']}: {e}")
+                    _requeue(buffer)
+                done += 1
+        finally:
+            # Cancelled part way: keep the rest (and the interrupted buffer) for the next flush
+            for buffer in queue[done:]:
+                _requeue(buffer)
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        _metrics["flushes"] += 1
+        _metrics["flushed_events"] += flushed
+        _metrics["total_flush_ms"] += latency_ms
+        _metrics["last_flush_ms"] = latency_ms
+        _metrics["max_flush_ms"] = max(_metrics["max_flush_ms"], latency_ms)
+        return flushed
+
+
+async def run_flusher(db: AsyncIOMotorDatabase) -> None:
+    """Background task flushing buffers on the size and staleness triggers"""
+    while True:
+        try:
+            await asyncio.wait_for(_wake().wait(), timeout=POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        if _is_due():
+            try:
+                # Shielded so cancelling the flusher never abandons buffers taken out for writing
+                await asyncio.shield(flush(db))
+            except Exception as e:
+                logger.warning(f"Progress buffer flush failed: {e}")
+
+
+def get_metrics() -> dict:
+    """Snapshot of buffer depth and flush latency"""
+    flushes = _metrics["flushes"]
+    oldest = min((buffer.first_at for buffer in _queued()), default=None)
+    return {
+        "enabled": WRITE_BEHIND_ENABLED,
+        "max_events": MAX_EVENTS,
+        "max_staleness_seconds": MAX_STALENESS_SECONDS,
+        "buffered_users": len(_buffers) + len(_resuming),
+        "buffered_events": _events,
+        "oldest_event_age_seconds": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+        "total_buffered": _metrics["buffered"],
+        "flushes": flushes,
+        "flushed_events": _metrics["flushed_events"],
+        "failed_flushes": _metrics["failed_flushes"],
+        "avg_flush_ms": round(_metrics["total_flush_ms"] / flushes, 2) if flushes else 0.0,
+        "max_flush_ms": round(_metrics["max_flush_ms"], 2),
+        "last_flush_ms": round(_metrics["last_flush_ms"], 2),
+    }
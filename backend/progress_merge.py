@@ -0,0 +1,71 @@
+"""
+Per-puzzle progress merge rules.
+
+Progress from several devices is combined field by field:
+completed is OR-ed, stars keep the maximum, bestTime keeps the minimum, and
+attempts and hintsUsed are counters that add up. merge_entry applies the
+rules in Python; entry_operators expresses the same rules as MongoDB update
+operators ($max, $min, $inc) so a merge can be a single atomic update.
+"""
+from typing import Dict, Any, Optional
+import time
+
+MAX_FIELDS = ("completed", "stars")
+MIN_FIELDS = ("bestTime",)
+SUM_FIELDS = ("attempts", "hintsUsed")
+
+
+def version_now() -> int:
+    """Progress version stamp (milliseconds since the epoch)"""
+    return int(time.time() * 1000)
+
+
+def normalize_change(change: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only mergeable fields with usable values"""
+    normalized = {}
+    if change.get("completed") is not None:
+        normalized["completed"] = bool(change["completed"])
+    for field in ("stars", "attempts", "hintsUsed"):
+        if change.get(field) is not None:
+            normalized[field] = int(change[field])
+    if change.get("bestTime") is not None:
+        normalized["bestTime"] = float(change["bestTime"])
+    return normalized
+
+
+def merge_entry(current: Optional[Dict[str, Any]], change: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge a normalized change into a stored entry, as entry_operators would on a null-free entry"""
+    merged = {k: v for k, v in (current or {}).items() if v is not None}
+    for field, value in change.items():
+        if field not in merged:
+            merged[field] = value
+        elif field in MAX_FIELDS:
+            merged[field] = max(merged[field], value)
+        elif field in MIN_FIELDS:
+            merged[field] = min(merged[field], value)
+        elif field in SUM_FIELDS:
+            merged[field] = merged[field] + value
+    return merged
+
+
+def entry_operators(path: str, change: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """MongoDB update operators merging a normalized change into the entry at path"""
+    operators: Dict[str, Dict[str, Any]] = {"$max": {}, "$min": {}, "$inc": {}}
+    for field, value in change.items():
+        if field in MAX_FIELDS:
+            operators["$max"][f"{path}.{field}"] = value
+        elif field in MIN_FIELDS:
+            operators["$min"][f"{path}.{field}"] = value
+        elif field in SUM_FIELDS:
+            operators["$inc"][f"{path}.{field}"] = value
+    return operators
+
+
+def combine_operators(*updates: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Fold several operator dicts into one update document, dropping empty operators"""
+    combined: Dict[str, Dict[str, Any]] = {}
+    for update in updates:
+        for operator, fields in update.items():
+            if fields:
+                combined.setdefault(operator, {}).update(fields)
+    return combined
@@ -0,0 +1,240 @@
+"""
+Packed binary level progress.
+
+level_progress stays the write model (the atomic merges address
+level_progress.<id>), and profiles may additionally carry a packed copy in
+level_progress_packed: {"data": <BSON binary>, "extra": <entries that
+cannot be packed>, "updated_at": <profile updated_at it was packed from>}. GET /progress/load?format=packed serves the
+copy while it matches the profile and repacks it when it does not.
+
+Layout (little-endian), covering puzzle ids base .. base + count - 1:
+
+    magic "LP", format version (u8), base id (u32), count (u32)
+    present bitset      count bits, padded to bytes
+    completed bitset    count bits, padded to bytes
+    stars               2 bits per puzzle (0-3), padded to bytes
+    bestTime            u32 milliseconds per puzzle, 0xFFFFFFFF when unset
+    attempts            u16 per puzzle, saturating
+    hintsUsed           u16 per puzzle, saturating
+
+The blob spans at most PACK_MAX_SPAN ids, so one stray large id cannot blow
+it up to gigabytes: when the ids spread wider, the blob covers the window
+holding the most of them. Entries outside that window, and entries whose ids
+are not puzzle numbers, are kept in "extra"; load returns them unpacked
+alongside the blob.
+
+Run `python progress_pack.py` to pack every existing profile.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from bson import Binary
+from pymongo import UpdateOne
+from typing import Dict, Any, Optional, Tuple
+import array
+import asyncio
+import logging
+import os
+import struct
+import sys
+
+logger = logging.getLogger(__name__)
+
+PACK_MAGIC = b"LP"
+PACK_VERSION = 1
+PACKED_FORMAT = "lp1"
+MIGRATION_BATCH_SIZE = 1000
+PACK_MAX_SPAN = int(os.environ.get("PROGRESS_PACK_MAX_SPAN", 4096))
+
+_HEADER = struct.Struct("<2sBII")
+_NO_TIME = 0xFFFFFFFF
+_U16_MAX = 0xFFFF
+
+
+def _bitset_size(count: int, bits: int = 1) -> int:
+    return (count * bits + 7) // 8
+
+
+def _number(value: Any, cast, default):
+    try:
+        return cast(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+
+def split_progress(level_progress: Optional[Dict[str, Any]]) -> Tuple[Dict[int, dict], Dict[str, Any]]:
+    """Separate the entries the blob covers from ones kept unpacked"""
+    numbered, extra = {}, {}
+    for puzzle_id, entry in (level_progress or {}).items():
+        if str(puzzle_id).isdigit() and int(puzzle_id) <= 0xFFFFFFFF and isinstance(entry, dict):
+            numbered[int(puzzle_id)] = (puzzle_id, entry)
+        else:
+            extra[puzzle_id] = entry
+
+    # Densest window of at most PACK_MAX_SPAN ids
+    ids = sorted(numbered)
+    best_start, best_count, start = 0, 0, 0
+    for end, puzzle_id in enumerate(ids):
+        while puzzle_id - ids[start] >= PACK_MAX_SPAN:
+            start += 1
+        if end - start + 1 > best_count:
+            best_start, best_count = start, end - start + 1
+
+    packable = {}
+    for i, puzzle_id in enumerate(ids):
+        key, entry = numbered[puzzle_id]
+        if best_start <= i < best_start + best_count:
+            packable[puzzle_id] = entry
+        else:
+            extra[key] = entry
+    return packable, extra
+
+
+def encode_level_progress(level_progress: Optional[Dict[str, Any]]) -> bytes:
+    """Pack the numerically keyed entries of a level_progress dict"""
+    packable, _ = split_progress(level_progress)
+    if not packable:
+        return _HEADER.pack(PACK_MAGIC, PACK_VERSION, 0, 0)
+
+    base = min(packable)
+    count = max(packable) - base + 1
+    present = bytearray(_bitset_size(count))
+    completed = bytearray(_bitset_size(count))
+    stars = bytearray(_bitset_size(count, 2))
+    times = array.array("I", [_NO_TIME]) * count
+    attempts = array.array("H", [0]) * count
+    hints = array.array("H", [0]) * count
+
+    for puzzle_id, entry in packable.items():
+        i = puzzle_id - base
+        present[i >> 3] |= 1 << (i & 7)
+        if entry.get("completed"):
+            completed[i >> 3] |= 1 << (i & 7)
+        star_count = min(3, max(0, _number(entry.get("stars"), int, 0)))
+        stars[i >> 2] |= star_count << ((i & 3) * 2)
+        best_time = _number(entry.get("bestTime"), float, None)
+        if best_time is not None:
+            times[i] = min(_NO_TIME - 1, max(0, round(best_time * 1000)))
+        attempts[i] = min(_U16_MAX, max(0, _number(entry.get("attempts"), int, 0)))
+        hints[i] = min(_U16_MAX, max(0, _number(entry.get("hintsUsed"), int, 0)))
+
+    if sys.byteorder != "little":
+        for values in (times, attempts, hints):
+            values.byteswap()
+    return b"".join((
+        _HEADER.pack(PACK_MAGIC, PACK_VERSION, base, count),
+        bytes(present), bytes(completed), bytes(stars),
+        times.tobytes(), attempts.tobytes(), hints.tobytes()
+    ))
+
+
+def decode_level_progress(data: bytes) -> Dict[str, dict]:
+    """Unpack a blob from encode_level_progress back into level_progress entries"""
+    magic, version, base, count = _HEADER.unpack_from(data, 0)
+    if magic != PACK_MAGIC or version != PACK_VERSION:
+        raise ValueError("Unsupported packed progress format")
+
+    offset = _HEADER.size
+    sections = {}
+    for name, size in (
+        ("present", _bitset_size(count)),
+        ("completed", _bitset_size(count)),
+        ("stars", _bitset_size(count, 2)),
+        ("times", count * 4),
+        ("attempts", count * 2),
+        ("hints", count * 2),
+    ):
+        sections[name] = data[offset:offset + size]
+        offset += size
+    if offset > len(data):
+        raise ValueError("Truncated packed progress")
+
+    times, attempts, hints = array.array("I"), array.array("H"), array.array("H")
+    times.frombytes(sections["times"])
+    attempts.frombytes(sections["attempts"])
+    hints.frombytes(sections["hints"])
+    if sys.byteorder != "little":
+        for values in (times, attempts, hints):
+            values.byteswap()
+
+    present, completed, stars = sections["present"], sections["completed"], sections["stars"]
+    level_progress = {}
+    for i in range(count):
+        if not present[i >> 3] & (1 << (i & 7)):
+            continue
+        entry = {
+            "completed": bool(completed[i >> 3] & (1 << (i & 7))),
+            "stars": (stars[i >> 2] >> ((i & 3) * 2)) & 3,
+            "attempts": attempts[i],
+            "hintsUsed": hints[i],
+        }
+        if times[i] != _NO_TIME:
+            entry["bestTime"] = times[i] / 1000
+        level_progress[str(base + i)] = entry
+    return level_progress
+
+
+def packed_document(profile: dict) -> dict:
+    """level_progress_packed value for a profile's current level_progress"""
+    _, extra = split_progress(profile.get("level_progress"))
+    return {
+        "data": Binary(encode_level_progress(profile.get("level_progress"))),
+        "extra": extra,
+        "updated_at": profile.get("updated_at"),
+    }
+
+
+def fresh_packed(profile: dict) -> Optional[dict]:
+    """The stored packed copy if it was packed from the profile's current state"""
+    packed = profile.get("level_progress_packed")
+    if packed and packed.get("updated_at") == profile.get("updated_at"):
+        return packed
+    return None
+
+
+async def store_packed(db: AsyncIOMotorDatabase, user_id: str, profile: dict) -> dict:
+    """Pack a profile's level_progress and save it unless the profile moved on meanwhile"""
+    packed = packed_document(profile)
+    await db.user_profiles.update_one(
+        {"user_id": user_id, "updated_at": profile.get("updated_at")},
+        {"$set": {"level_progress_packed": packed}}
+    )
+    return packed
+
+
+async def migrate(db: AsyncIOMotorDatabase) -> int:
+    """Add or refresh the packed copy on every profile"""
+    projection = {"_id": 0, "user_id": 1, "updated_at": 1, "level_progress": 1, "level_progress_packed.updated_at": 1}
+    batch, written = [], 0
+    async for profile in db.user_profiles.find({}, projection):
+        if profile.get("level_progress_packed", {}).get("updated_at") == profile.get("updated_at"):
+            continue
+        batch.append(UpdateOne(
+            {"user_id": profile["user_id"], "updated_at": profile.get("updated_at")},
+            {"$set": {"level_progress_packed": packed_document(profile)}}
+        ))
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            await db.user_profiles.bulk_write(batch, ordered=False)
+            written += len(batch)
+            batch = []
+
+    if batch:
+        await db.user_profiles.bulk_write(batch, ordered=False)
+        written += len(batch)
+
+    return written
+
+
+async def _migrate_main() -> None:
+    from database import get_database, close_client
+
+    written = await migrate(get_database())
+    logger.info(f"Packed level progress for {written} profiles")
+    close_client()
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+    from dotenv import load_dotenv
+
+    load_dotenv(Path(__file__).parent / '.env')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(_migrate_main())
@@ -0,0 +1,210 @@
+"""
+Progress persistence.
+
+merge_progress applies per-puzzle changes to a user's profile with one atomic
+find_one_and_update built from the progress_merge operators, stamping each
+touched puzzle with a version in progress_versions. The pre-image it gets back
+is replayed through merge_entry, so callers learn both the old and the merged
+entries without a second read.
+
+upsert_puzzle_progress mirrors entries into puzzle_progress with unordered
+bulk_write batches, reporting per-puzzle failures instead of aborting.
+
+replace_progress is the full-overwrite counterpart used by the legacy sync:
+one find_one_and_update sets the new level_progress and returns the old one.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from pydantic import ValidationError
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Tuple
+import os
+import uuid
+
+from models import Settings, PuzzleProgress
+from progress_merge import normalize_change, merge_entry, entry_operators, combine_operators, version_now, SUM_FIELDS, MIN_FIELDS
+
+BULK_WRITE_BATCH_SIZE = int(os.environ.get("PROGRESS_BULK_WRITE_BATCH_SIZE", 500))
+
+
+def _profile_defaults() -> dict:
+    """Fields a profile created by an upsert starts with"""
+    return {
+        "id": str(uuid.uuid4()),
+        "settings": Settings().model_dump(),
+        "achievements": [],
+        "stats": {}
+    }
+
+
+async def _repair_null_fields(db: AsyncIOMotorDatabase, user_id: str, puzzle_ids) -> None:
+    """Reset legacy null entries and drop null counters and times that $inc and $min cannot merge into"""
+    projection = {"_id": 0, **{f"level_progress.{pid}": 1 for pid in puzzle_ids}}
+    profile = await db.user_profiles.find_one({"user_id": user_id}, projection) or {}
+    entries = profile.get("level_progress", {})
+
+    for pid, entry in entries.items():
+        if not isinstance(entry, dict):
+            # Only replace the value we saw, so a concurrent merge is never wiped
+            await db.user_profiles.update_one(
+                {"user_id": user_id, f"level_progress.{pid}": entry},
+                {"$set": {f"level_progress.{pid}": {}}}
+            )
+
+    unset = {
+        f"level_progress.{pid}.{field}": ""
+        for pid, entry in entries.items() if isinstance(entry, dict)
+        for field, value in entry.items()
+        if value is None and field in SUM_FIELDS + MIN_FIELDS
+    }
+    if unset:
+        await db.user_profiles.update_one({"user_id": user_id}, {"$unset": unset})
+
+
+async def merge_progress(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    changes: Dict[str, Dict[str, Any]],
+    extra_update: Dict[str, Dict[str, Any]] = None
+) -> Tuple[Dict[str, dict], Dict[str, dict], Dict[str, int], int]:
+    """
+    Merge per-puzzle changes into a profile atomically.
+
+    Returns (old entries, merged entries, progress_versions before the write,
+    version stamped on the merged entries). Raises ValueError or TypeError,
+    before writing anything, when a change holds non-numeric values.
+    """
+    normalized = {str(pid): normalize_change(change) for pid, change in changes.items()}
+    version = version_now()
+
+    update = combine_operators(
+        *(entry_operators(f"level_progress.{pid}", change) for pid, change in normalized.items()),
+        {"$max": {f"progress_versions.{pid}": version for pid in normalized}},
+        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        extra_update or {}
+    )
+    touched = {path.split(".")[0] for fields in update.values() for path in fields}
+    update["$setOnInsert"] = {k: v for k, v in _profile_defaults().items() if k not in touched}
+    projection = {"_id": 0, "progress_versions": 1, **{f"level_progress.{pid}": 1 for pid in normalized}}
+
+    async def write():
+        return await db.user_profiles.find_one_and_update(
+            {"user_id": user_id},
+            update,
+            projection=projection,
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+
+    try:
+        before = await write()
+    except OperationFailure:
+        # $inc on a legacy null counter; clean the entries and retry once
+        await _repair_null_fields(db, user_id, list(normalized))
+        before = await write()
+
+    before = before or {}
+    old_entries = {pid: entry for pid, entry in before.get("level_progress", {}).items() if isinstance(entry, dict) and entry}
+    merged = {pid: merge_entry(old_entries.get(pid), change) for pid, change in normalized.items()}
+
+    # $min leaves a legacy null bestTime in place; overwrite it with the merged value
+    fix = {
+        f"level_progress.{pid}.bestTime": merged[pid]["bestTime"]
+        for pid, entry in old_entries.items()
+        if entry.get("bestTime", 0) is None and "bestTime" in merged[pid]
+    }
+    if fix:
+        await db.user_profiles.update_one({"user_id": user_id}, {"$set": fix})
+
+    return old_entries, merged, before.get("progress_versions", {}), version
+
+
+async def replace_progress(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    level_progress: Dict[str, Any],
+    extra_set: Dict[str, Any] = None
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Overwrite a profile's level_progress atomically, creating the profile if needed.
+
+    Returns (level_progress before the write, entries that changed). The
+    changed entries are stamped with a version in progress_versions.
+    """
+    version = version_now()
+    fields = {"level_progress": level_progress, "updated_at": datetime.now(timezone.utc).isoformat(), **(extra_set or {})}
+    before = await db.user_profiles.find_one_and_update(
+        {"user_id": user_id},
+        {"$set": fields, "$setOnInsert": {k: v for k, v in _profile_defaults().items() if k not in fields}},
+        projection={"_id": 0, "level_progress": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+
+    old_progress = (before or {}).get("level_progress") or {}
+    changed = {pid: entry for pid, entry in level_progress.items() if old_progress.get(pid) != entry}
+    if changed:
+        # $max so a newer stamp from a concurrent merge is kept
+        await db.user_profiles.update_one(
+            {"user_id": user_id},
+            {"$max": {f"progress_versions.{pid}": version for pid in changed}}
+        )
+    return old_progress, changed
+
+
+def _puzzle_progress_fields(user_id: str, puzzle_id: str, entry: Dict[str, Any], trusted: bool) -> dict:
+    """puzzle_progress fields for one level_progress entry, validated unless trusted"""
+    fields = {
+        "user_id": user_id,
+        "puzzle_id": int(puzzle_id),
+        "completed": entry.get('completed', False),
+        "stars": entry.get('stars', 0),
+        "best_time": entry.get('bestTime'),
+        "attempts": entry.get('attempts', 0),
+        "hints_used": entry.get('hintsUsed', 0),
+        "last_attempted": datetime.now(timezone.utc)
+    }
+    if not trusted:
+        fields = PuzzleProgress(**fields).model_dump(exclude={"id"})
+    return fields
+
+
+async def upsert_puzzle_progress(
+    db: AsyncIOMotorDatabase,
+    user_id: str,
+    entries: Dict[str, Dict[str, Any]],
+    trusted: bool = False
+) -> List[dict]:
+    """
+    Upsert puzzle_progress documents for level_progress entries in bulk.
+
+    Entries already normalized by the server can pass trusted=True to skip
+    model validation. Returns a list of {"puzzle_id", "error"} failures.
+    """
+    failures: List[dict] = []
+    operations: List[UpdateOne] = []
+    puzzle_ids: List[str] = []
+
+    for puzzle_id, entry in entries.items():
+        try:
+            fields = _puzzle_progress_fields(user_id, puzzle_id, entry or {}, trusted)
+        except (ValidationError, ValueError, TypeError, AttributeError) as e:
+            failures.append({"puzzle_id": puzzle_id, "error": f"Invalid progress entry: {e}"})
+            continue
+        operations.append(UpdateOne(
+            {"user_id": user_id, "puzzle_id": fields["puzzle_id"]},
+            {"$set": fields, "$setOnInsert": {"id": str(uuid.uuid4())}},
+            upsert=True
+        ))
+        puzzle_ids.append(puzzle_id)
+
+    for start in range(0, len(operations), BULK_WRITE_BATCH_SIZE):
+        batch = operations[start:start + BULK_WRITE_BATCH_SIZE]
+        try:
+            await db.puzzle_progress.bulk_write(batch, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failures.append({"puzzle_id": puzzle_ids[start + error["index"]], "error": error.get("errmsg", "Write failed")})
+
+    return failures
@@ -0,0 +1,189 @@
+"""
+Append-only gameplay event log.
+
+Attempts, completions, hints and failures are appended to `puzzle_events`,
+one small document per event:
+
+    {"ts": datetime, "user_id": str, "puzzle_id": int, "type": str,
+     optional "stars", "time_ms", "hints", "category"}
+
+record() only queues the event in memory, so the gameplay path never waits on
+the database. A background ingester writes the queue with one insert_many per
+PUZZLE_EVENTS_BATCH_SIZE events or every PUZZLE_EVENTS_FLUSH_MS, whichever
+comes first, folds each stored batch into the analytics_rollups day counters
+and the skill_ratings player and puzzle ratings, and drains the queue on shutdown. The queue is bounded; events arriving while
+it is full are dropped and counted.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+import asyncio
+import logging
+import os
+import re
+import time
+
+import analytics_rollups
+import skill_ratings
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = ("attempt", "complete", "hint", "fail")
+# Categories become rollup field names, so only plain identifiers are kept
+CATEGORY_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+BATCH_SIZE = int(os.environ.get("PUZZLE_EVENTS_BATCH_SIZE", 200))
+FLUSH_MS = int(os.environ.get("PUZZLE_EVENTS_FLUSH_MS", 500))
+MAX_QUEUE = int(os.environ.get("PUZZLE_EVENTS_MAX_QUEUE", 20000))
+
+_queue: deque = deque()
+_flush_wanted: Optional[asyncio.Event] = None
+_flush_lock: Optional[asyncio.Lock] = None
+
+_metrics = {
+    "recorded": 0,
+    "written": 0,
+    "dropped": 0,
+    "failed_batches": 0,
+    "failed_rollups": 0,
+    "failed_ratings": 0,
+    "batches": 0,
+    "total_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+}
+
+
+def _wake() -> asyncio.Event:
+    global _flush_wanted
+    if _flush_wanted is None:
+        _flush_wanted = asyncio.Event()
+    return _flush_wanted
+
+
+def record(
+    user_id: str,
+    puzzle_id: int,
+    event_type: str,
+    ts: Optional[datetime] = None,
+    stars: Optional[int] = None,
+    time_taken: Optional[float] = None,
+    hints: Optional[int] = None,
+    category: Optional[str] = None
+) -> bool:
+    """Queue one event for the ingester; returns False if it was dropped"""
+    if event_type not in EVENT_TYPES:
+        raise ValueError(f"Unknown puzzle event type: {event_type}")
+    if len(_queue) >= MAX_QUEUE:
+        _metrics["dropped"] += 1
+        return False
+
+    event = {
+        "ts": ts or datetime.now(timezone.utc),
+        "user_id": user_id,
+        "puzzle_id": int(puzzle_id),
+        "type": event_type,
+    }
+    if stars is not None:
+        event["stars"] = int(stars)
+    if time_taken is not None:
+        event["time_ms"] = int(round(float(time_taken) * 1000))
+    if hints:
+        event["hints"] = int(hints)
+    if category and CATEGORY_PATTERN.match(category):
+        event["category"] = category
+
+    _queue.append(event)
+    _metrics["recorded"] += 1
+    if len(_queue) >= BATCH_SIZE:
+        _wake().set()
+    return True
+
+
+async def flush(db: AsyncIOMotorDatabase) -> int:
+    """Write queued events in insert_many batches, returning how many were stored"""
+    global _flush_lock
+    if _flush_lock is None:
+        _flush_lock = asyncio.Lock()
+
+    written = 0
+    async with _flush_lock:
+        _wake().clear()
+        while _queue:
+            batch = [_queue.popleft() for _ in range(min(BATCH_SIZE, len(_queue)))]
+            started = time.perf_counter()
+            try:
+                await db.puzzle_events.insert_many(batch, ordered=False)
+                stored = batch
+            except BulkWriteError as e:
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                stored = [event for index, event in enumerate(batch) if index not in failed]
+                _metrics["failed_batches"] += 1
+                _metrics["dropped"] += len(failed)
+                logger.warning(f"Dropped {len(failed)} puzzle events: {e}")
+            except Exception as e:
+                # Database unavailable: put the batch back and retry on the next tick
+                _metrics["failed_batches"] += 1
+                room = MAX_QUEUE - len(_queue)
+                _queue.extendleft(reversed(batch[:room]))
+                _metrics["dropped"] += max(0, len(batch) - room)
+                logger.warning(f"Failed to write puzzle events: {e}")
+                break
+
+            try:
+                await analytics_rollups.apply_events(db, stored)
+            except Exception as e:
+                _metrics["failed_rollups"] += 1
+                logger.warning(f"Failed to update analytics rollups: {e}")
+
+            try:
+                await skill_ratings.apply_events(db, stored)
+            except Exception as e:
+                _metrics["failed_ratings"] += 1
+                logger.warning(f"Failed to update skill ratings: {e}")
+
+            latency_ms = (time.perf_counter() - started) * 1000
+            written += len(stored)
+            _metrics["written"] += len(stored)
+            _metrics["batches"] += 1
+            _metrics["total_flush_ms"] += latency_ms
+            _metrics["max_flush_ms"] = max(_metrics["max_flush_ms"], latency_ms)
+    return written
+
+
+async def run_ingester(db: AsyncIOMotorDatabase) -> None:
+    """Background task flushing the queue on the size and time triggers"""
+    while True:
+        try:
+            await asyncio.wait_for(_wake().wait(), timeout=FLUSH_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        if _queue:
+            await flush(db)
+
+
+def get_metrics() -> dict:
+    """Snapshot of queue depth and batch write latency"""
+    batches = _metrics["batches"]
+    return {
+        "queue_depth": len(_queue),
+        "queue_capacity": MAX_QUEUE,
+        "batch_size": BATCH_SIZE,
+        "flush_ms": FLUSH_MS,
+        "recorded": _metrics["recorded"],
+        "written": _metrics["written"],
+        "dropped": _metrics["dropped"],
+        "batches": batches,
+        "failed_batches": _metrics["failed_batches"],
+        "failed_rollups": _metrics["failed_rollups"],
+        "failed_ratings": _metrics["failed_ratings"],
+        "avg_flush_ms": round(_metrics["total_flush_ms"] / batches, 2) if batches else 0.0,
+        "max_flush_ms": round(_metrics["max_flush_ms"], 2),
+    }
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the per-user timeline index"""
+    await db.puzzle_events.create_index([("user_id", ASCENDING), ("ts", ASCENDING)], name="user_timeline")
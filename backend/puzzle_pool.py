@@ -0,0 +1,299 @@
+"""
+Pre-generated AI puzzle pool.
+
+Validated GeneratedPuzzle items are stocked in `ai_puzzle_pool` per
+(category, difficulty) bucket, so /ai/generate-puzzles can answer from the
+database instead of waiting on the model. Each user's served puzzles are
+recorded in `ai_puzzle_seen` and excluded from later draws.
+
+Pool items are never removed, so a bucket's stock is measured by what its
+players have left to see: the fewest unseen items among the
+AI_POOL_STOCK_SAMPLE_USERS users most recently served from it (or the whole
+bucket when nobody has been). A background refiller tops up every active
+bucket whose stock has dropped below AI_POOL_LOW_WATER back to
+AI_POOL_HIGH_WATER, with at most AI_POOL_CONCURRENCY model calls in flight.
+Buckets become active when a user requests them (tracked in
+`ai_pool_buckets`) or when they are listed in AI_POOL_BUCKETS as
+category:difficulty pairs. Only the AI_POOL_CATEGORIES categories and the
+easy/medium/hard difficulties are pooled; other requests are generated live.
+One worker at a time refills, holding the "ai_puzzle_pool" lease in
+`job_leases`.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Set, Tuple
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+
+from models import GeneratedPuzzle
+import llm_gateway
+import llm_puzzles
+
+logger = logging.getLogger(__name__)
+
+LOW_WATER = int(os.environ.get("AI_POOL_LOW_WATER", 20))
+HIGH_WATER = int(os.environ.get("AI_POOL_HIGH_WATER", 50))
+REFILL_BATCH = int(os.environ.get("AI_POOL_REFILL_BATCH", 5))
+REFILL_CONCURRENCY = int(os.environ.get("AI_POOL_CONCURRENCY", 2))
+REFILL_SECONDS = int(os.environ.get("AI_POOL_REFILL_SECONDS", 60))
+BUCKET_ACTIVE_DAYS = int(os.environ.get("AI_POOL_BUCKET_ACTIVE_DAYS", 7))
+MAX_BUCKETS = int(os.environ.get("AI_POOL_MAX_BUCKETS", 100))
+STOCK_SAMPLE_USERS = int(os.environ.get("AI_POOL_STOCK_SAMPLE_USERS", 20))
+POOL_CATEGORIES = {
+    category.strip().lower()
+    for category in os.environ.get("AI_POOL_CATEGORIES", "logic,math,word,riddle,trick").split(",")
+    if category.strip()
+}
+POOL_DIFFICULTIES = {"easy", "medium", "hard"}
+CONFIGURED_BUCKETS = [
+    tuple(pair.strip().lower().split(":", 1))
+    for pair in os.environ.get("AI_POOL_BUCKETS", "").split(",")
+    if ":" in pair
+]
+
+LEASE_NAME = "ai_puzzle_pool"
+LEASE_SECONDS = REFILL_SECONDS * 2
+POOL_PROJECTION = {"_id": 0, "id": 1, "question": 1, "answer": 1, "hint": 1, "explanation": 1, "category": 1, "difficulty": 1}
+
+# Identifies this worker as the refill lease owner
+_worker_id = uuid.uuid4().hex
+
+_metrics = {
+    "served": 0,
+    "short": 0,
+    "refill_calls": 0,
+    "refill_failures": 0,
+    "stocked": 0,
+    "fallback_served": 0,
+}
+
+
+def bucket_key(category: str, difficulty: str) -> Optional[Tuple[str, str]]:
+    """Normalized (category, difficulty), or None if the pair cannot be pooled"""
+    key = (category.strip().lower(), difficulty.strip().lower())
+    if key[0] in POOL_CATEGORIES and key[1] in POOL_DIFFICULTIES:
+        return key
+    return None
+
+
+def _fingerprint(puzzle: GeneratedPuzzle) -> str:
+    normalized = " ".join(puzzle.question.lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+async def stock(db: AsyncIOMotorDatabase, category: str, difficulty: str, puzzles: List[GeneratedPuzzle]) -> List[dict]:
+    """Add puzzles to a bucket, skipping questions it already holds; returns the stored items"""
+    documents = []
+    for puzzle in puzzles:
+        documents.append({
+            "id": str(uuid.uuid4()),
+            **puzzle.model_dump(),
+            "category": category,
+            "difficulty": difficulty,
+            "fingerprint": _fingerprint(puzzle),
+            "created_at": datetime.now(timezone.utc),
+        })
+    if not documents:
+        return []
+
+    stored = documents
+    try:
+        await db.ai_puzzle_pool.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        duplicates = {error["index"] for error in e.details.get("writeErrors", [])}
+        stored = [doc for index, doc in enumerate(documents) if index not in duplicates]
+    _metrics["stocked"] += len(stored)
+    return stored
+
+
+async def mark_seen(db: AsyncIOMotorDatabase, user_id: str, category: str, difficulty: str, puzzle_ids: List[str]) -> None:
+    """Record that a user was served these pool items"""
+    if not puzzle_ids:
+        return
+    now = datetime.now(timezone.utc)
+    try:
+        await db.ai_puzzle_seen.insert_many([
+            {"user_id": user_id, "category": category, "difficulty": difficulty, "puzzle_id": puzzle_id, "seen_at": now}
+            for puzzle_id in puzzle_ids
+        ], ordered=False)
+    except BulkWriteError:
+        pass
+
+
+async def claim(db: AsyncIOMotorDatabase, user_id: str, category: str, difficulty: str, puzzles: List[GeneratedPuzzle]) -> List[GeneratedPuzzle]:
+    """Stock live-generated puzzles and keep the ones this user has not been served, marked as seen"""
+    await stock(db, category, difficulty, puzzles)
+    fingerprints = [_fingerprint(puzzle) for puzzle in puzzles]
+    pooled = await db.ai_puzzle_pool.find(
+        {"category": category, "difficulty": difficulty, "fingerprint": {"$in": fingerprints}},
+        {"_id": 0, "id": 1, "fingerprint": 1}
+    ).to_list(length=len(fingerprints))
+    ids = {item["fingerprint"]: item["id"] for item in pooled}
+    seen = set(await db.ai_puzzle_seen.distinct(
+        "puzzle_id", {"user_id": user_id, "category": category, "difficulty": difficulty, "puzzle_id": {"$in": list(ids.values())}}
+    ))
+
+    claimed, claimed_ids = [], set()
+    for puzzle, fingerprint in zip(puzzles, fingerprints):
+        puzzle_id = ids.get(fingerprint)
+        if puzzle_id in seen or puzzle_id in claimed_ids:
+            continue
+        claimed.append(puzzle)
+        if puzzle_id:
+            claimed_ids.add(puzzle_id)
+    await mark_seen(db, user_id, category, difficulty, list(claimed_ids))
+    return claimed
+
+
+async def take(db: AsyncIOMotorDatabase, user_id: str, category: str, difficulty: str, count: int) -> List[dict]:
+    """Up to count random pool items from a bucket that the user has not seen, marked as seen"""
+    await db.ai_pool_buckets.update_one(
+        {"category": category, "difficulty": difficulty},
+        {"$set": {"last_requested_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+    seen = await db.ai_puzzle_seen.distinct("puzzle_id", {"user_id": user_id, "category": category, "difficulty": difficulty})
+    items = await db.ai_puzzle_pool.aggregate([
+        {"$match": {"category": category, "difficulty": difficulty, "id": {"$nin": seen}}},
+        {"$sample": {"size": count}},
+        {"$project": POOL_PROJECTION},
+    ]).to_list(length=count)
+
+    await mark_seen(db, user_id, category, difficulty, [item["id"] for item in items])
+    _metrics["served"] += len(items)
+    if len(items) < count:
+        _metrics["short"] += 1
+    return items
+
+
+async def sample(db: AsyncIOMotorDatabase, category: str, difficulty: str, count: int) -> List[dict]:
+    """Up to count random pool items from a bucket, seen or not, for when generation is unavailable"""
+    items = await db.ai_puzzle_pool.aggregate([
+        {"$match": {"category": category, "difficulty": difficulty}},
+        {"$sample": {"size": count}},
+        {"$project": POOL_PROJECTION},
+    ]).to_list(length=count)
+    _metrics["fallback_served"] += len(items)
+    return items
+
+
+async def _active_buckets(db: AsyncIOMotorDatabase) -> Set[Tuple[str, str]]:
+    since = datetime.now(timezone.utc) - timedelta(days=BUCKET_ACTIVE_DAYS)
+    cursor = db.ai_pool_buckets.find({"last_requested_at": {"$gte": since}}, {"_id": 0, "category": 1, "difficulty": 1})
+    requested = await cursor.sort("last_requested_at", -1).to_list(length=MAX_BUCKETS)
+    pairs = [(bucket["category"], bucket["difficulty"]) for bucket in requested] + CONFIGURED_BUCKETS
+    # Rows stored before the category list narrowed, or a mistyped AI_POOL_BUCKETS entry, are skipped
+    return {key for key in (bucket_key(*pair) for pair in pairs) if key}
+
+
+async def unseen_stock(db: AsyncIOMotorDatabase, category: str, difficulty: str) -> int:
+    """Fewest items any recently served user of a bucket has not seen yet"""
+    total = await db.ai_puzzle_pool.count_documents({"category": category, "difficulty": difficulty})
+    since = datetime.now(timezone.utc) - timedelta(days=BUCKET_ACTIVE_DAYS)
+    recent = await db.ai_puzzle_seen.aggregate([
+        {"$match": {"category": category, "difficulty": difficulty, "seen_at": {"$gte": since}}},
+        {"$sort": {"seen_at": -1}},
+        {"$group": {"_id": "$user_id", "seen_at": {"$first": "$seen_at"}}},
+        {"$sort": {"seen_at": -1}},
+        {"$limit": STOCK_SAMPLE_USERS},
+    ]).to_list(length=STOCK_SAMPLE_USERS)
+
+    available = total
+    for user in recent:
+        seen = await db.ai_puzzle_seen.count_documents(
+            {"user_id": user["_id"], "category": category, "difficulty": difficulty}
+        )
+        available = min(available, max(0, total - seen))
+    return available
+
+
+async def refill_bucket(db: AsyncIOMotorDatabase, category: str, difficulty: str, semaphore: asyncio.Semaphore) -> int:
+    """Top a bucket's unseen stock up to HIGH_WATER if it is below LOW_WATER, returning how many puzzles were added"""
+    available = await unseen_stock(db, category, difficulty)
+    if available >= LOW_WATER:
+        return 0
+
+    async def generate_batch(size: int) -> List[GeneratedPuzzle]:
+        async with semaphore:
+            _metrics["refill_calls"] += 1
+            try:
+                return await llm_puzzles.request_puzzles(category, difficulty, size, f"puzzle_pool_{category}_{difficulty}", cached=False)
+            except Exception as e:
+                _metrics["refill_failures"] += 1
+                logger.warning(f"Puzzle pool refill failed for {category}/{difficulty}: {e}")
+                return []
+
+    missing = HIGH_WATER - available
+    sizes = [min(REFILL_BATCH, missing - start) for start in range(0, missing, REFILL_BATCH)]
+    batches = await asyncio.gather(*(generate_batch(size) for size in sizes))
+    stored = await stock(db, category, difficulty, [puzzle for batch in batches for puzzle in batch])
+    return len(stored)
+
+
+async def refill(db: AsyncIOMotorDatabase) -> int:
+    """Refill every active bucket under a shared concurrency limit"""
+    semaphore = asyncio.Semaphore(REFILL_CONCURRENCY)
+    buckets = await _active_buckets(db)
+    added = await asyncio.gather(*(refill_bucket(db, category, difficulty, semaphore) for category, difficulty in buckets))
+    return sum(added)
+
+
+async def acquire_lease(db: AsyncIOMotorDatabase) -> bool:
+    """Take or renew the refill lease, returning whether this worker holds it"""
+    now = datetime.now(timezone.utc)
+    try:
+        lease = await db.job_leases.find_one_and_update(
+            {"_id": LEASE_NAME, "$or": [{"owner": _worker_id}, {"expires_at": {"$lte": now}}]},
+            {"$set": {"owner": _worker_id, "expires_at": now + timedelta(seconds=LEASE_SECONDS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Held by another worker: the upsert tried to insert a second lease
+        return False
+    return lease is not None and lease.get("owner") == _worker_id
+
+
+async def run_refiller(db: AsyncIOMotorDatabase) -> None:
+    """Background task keeping active buckets stocked while holding the refill lease"""
+    while True:
+        if llm_gateway.llm_key() and llm_gateway.available():
+            try:
+                if await acquire_lease(db):
+                    added = await refill(db)
+                    if added:
+                        logger.info(f"Stocked {added} puzzles into the AI puzzle pool")
+            except Exception as e:
+                logger.warning(f"AI puzzle pool refill failed: {e}")
+        await asyncio.sleep(REFILL_SECONDS)
+
+
+def get_metrics() -> dict:
+    """Pool serving and refill counters"""
+    return {
+        "low_water": LOW_WATER,
+        "high_water": HIGH_WATER,
+        "concurrency": REFILL_CONCURRENCY,
+        **_metrics,
+    }
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the pool, dedupe and seen-tracking indexes"""
+    await db.ai_puzzle_pool.create_index(
+        [("category", ASCENDING), ("difficulty", ASCENDING), ("fingerprint", ASCENDING)], unique=True
+    )
+    await db.ai_puzzle_pool.create_index("id", unique=True)
+    await db.ai_puzzle_seen.create_index(
+        [("user_id", ASCENDING), ("category", ASCENDING), ("difficulty", ASCENDING), ("puzzle_id", ASCENDING)], unique=True
+    )
+    await db.ai_puzzle_seen.create_index(
+        [("category", ASCENDING), ("difficulty", ASCENDING), ("seen_at", ASCENDING)]
+    )
+    await db.ai_pool_buckets.create_index([("category", ASCENDING), ("difficulty", ASCENDING)], unique=True)
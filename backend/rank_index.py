@@ -0,0 +1,186 @@
+"""
+In-memory order-statistic index over leaderboard rows.
+
+A treap whose nodes carry subtree sizes, ordered by
+(-total_stars, -puzzles_completed, user_id) so that in-order position is the
+leaderboard rank. Rank lookups, inserts, removals and positional reads are all
+O(log n) expected.
+"""
+from typing import Dict, List, Optional, Tuple
+import random
+
+RankKey = Tuple[int, int, str]
+
+
+class _Node:
+    __slots__ = ("key", "priority", "size", "left", "right")
+
+    def __init__(self, key: RankKey):
+        self.key = key
+        self.priority = random.random()
+        self.size = 1
+        self.left: Optional["_Node"] = None
+        self.right: Optional["_Node"] = None
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node else 0
+
+
+def _refresh(node: _Node) -> None:
+    node.size = 1 + _size(node.left) + _size(node.right)
+
+
+def _split(node: Optional[_Node], key: RankKey, inclusive: bool) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """Split into (keys before key, the rest); inclusive moves key itself to the left side"""
+    if node is None:
+        return None, None
+    if node.key < key or (inclusive and node.key == key):
+        left, right = _split(node.right, key, inclusive)
+        node.right = left
+        _refresh(node)
+        return node, right
+    left, right = _split(node.left, key, inclusive)
+    node.left = right
+    _refresh(node)
+    return left, node
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """Join two treaps where every key in left sorts before every key in right"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _refresh(left)
+        return left
+    right.left = _merge(left, right.left)
+    _refresh(right)
+    return right
+
+
+def rank_key(row: dict) -> RankKey:
+    """Sort key placing better leaderboard rows first"""
+    return (-int(row.get("total_stars", 0)), -int(row.get("puzzles_completed", 0)), row["user_id"])
+
+
+class RankIndex:
+    """Leaderboard rows indexed by rank"""
+
+    def __init__(self):
+        self._root: Optional[_Node] = None
+        self._rows: Dict[str, dict] = {}
+
+    @classmethod
+    def from_rows(cls, rows: List[dict]) -> "RankIndex":
+        """Bulk-build an index in O(n log n) sort plus O(n) tree construction"""
+        index = cls()
+        index._rows = {row["user_id"]: row for row in rows}
+        keys = sorted(rank_key(row) for row in index._rows.values())
+        levels: List[List[_Node]] = []
+
+        def build(lo: int, hi: int, depth: int) -> Optional[_Node]:
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = _Node(keys[mid])
+            if len(levels) <= depth:
+                levels.append([])
+            levels[depth].append(node)
+            node.left = build(lo, mid, depth + 1)
+            node.right = build(mid + 1, hi, depth + 1)
+            _refresh(node)
+            return node
+
+        index._root = build(0, len(keys), 0)
+
+        # Hand out random priorities so every parent outranks its children
+        priorities = sorted((random.random() for _ in keys), reverse=True)
+        position = 0
+        for level in levels:
+            for node in level:
+                node.priority = priorities[position]
+                position += 1
+        return index
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._rows
+
+    def update(self, row: dict) -> None:
+        """Insert or replace a user's row"""
+        self.remove(row["user_id"])
+        key = rank_key(row)
+        left, right = _split(self._root, key, inclusive=False)
+        self._root = _merge(_merge(left, _Node(key)), right)
+        self._rows[row["user_id"]] = row
+
+    def remove(self, user_id: str) -> None:
+        """Drop a user's row if present"""
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            return
+        key = rank_key(row)
+        left, rest = _split(self._root, key, inclusive=False)
+        _, right = _split(rest, key, inclusive=True)
+        self._root = _merge(left, right)
+
+    def get(self, user_id: str) -> Optional[dict]:
+        return self._rows.get(user_id)
+
+    def rank_of(self, user_id: str) -> Optional[int]:
+        """1-based leaderboard rank of a user"""
+        row = self._rows.get(user_id)
+        if row is None:
+            return None
+        key = rank_key(row)
+        node, before = self._root, 0
+        while node is not None:
+            if key < node.key:
+                node = node.left
+            elif node.key < key:
+                before += _size(node.left) + 1
+                node = node.right
+            else:
+                return before + _size(node.left) + 1
+        return None
+
+    def _select(self, index: int) -> RankKey:
+        """Key at a 0-based position"""
+        node = self._root
+        while node is not None:
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node.key
+            else:
+                index -= left_size + 1
+                node = node.right
+        raise IndexError(index)
+
+    def slice(self, start: int, count: int) -> List[dict]:
+        """Rows at 0-based positions [start, start + count), each with its rank"""
+        end = min(len(self._rows), start + count)
+        rows = []
+        for index in range(max(0, start), end):
+            row = dict(self._rows[self._select(index)[2]])
+            row["rank"] = index + 1
+            rows.append(row)
+        return rows
+
+    def top(self, k: int) -> List[dict]:
+        """Best k rows"""
+        return self.slice(0, k)
+
+    def around(self, user_id: str, radius: int) -> List[dict]:
+        """Rows within radius ranks of a user, including the user"""
+        rank = self.rank_of(user_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return self.slice(start, rank - start + radius)
@@ -1,15 +1,29 @@
 from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from contextlib import aclosing
 from typing import List, Optional
+import asyncio
 import os
 import json
-from emergentintegrations.llm.chat import LlmChat, UserMessage
 
-from auth import get_current_user_email, get_current_user
+from models import GeneratedPuzzle
+from auth import get_current_user_email, get_current_principal
+from database import get_db
+import llm_gateway
+import llm_puzzles
+import puzzle_pool
+import skill_ratings
 
 router = APIRouter(prefix="/ai", tags=["ai"])
 
+# Content-Encoding keeps GZipMiddleware from buffering the event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "Content-Encoding": "identity", "X-Accel-Buffering": "no"}
+
+ADAPTIVE_SYSTEM_MESSAGE = "You are a friendly puzzle game coach. Reply with one or two encouraging sentences and nothing else."
+
+
 def get_llm_key():
     api_key = os.environ.get("EMERGENT_LLM_KEY")
     if not api_key:
@@ -20,117 +34,164 @@ def get_llm_key():
     return api_key
 
 
-class PuzzleGenerationRequest(BaseModel):
-    category: str
-    difficulty: str
-    count: int = 1
+def _llm_http_error(e: Exception, action: str) -> HTTPException:
+    """Map an LLM failure to a response: 503 when rejected, 504 on timeout, else 500"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, llm_gateway.LLMUnavailableError):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    if isinstance(e, asyncio.TimeoutError):
+        return HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"AI service timed out trying to {action}"
+        )
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail=f"Failed to {action}: {str(e)}"
+    )
 
 
-class GeneratedPuzzle(BaseModel):
-    question: str
-    answer: str
-    hint: str
-    explanation: str
+class PuzzleGenerationRequest(BaseModel):
     category: str
     difficulty: str
+    count: int = Field(1, ge=1, le=20)
 
 
 class AdaptiveDifficultyRequest(BaseModel):
-    user_stats: dict
+    # Only used for players without rated games yet
+    user_stats: dict = Field(default_factory=dict)
+    # Ask the LLM to phrase the explanation; the recommendation itself is always local
+    explain: bool = False
 
 
 class AdaptiveDifficultyResponse(BaseModel):
     recommended_difficulty: str
     explanation: str
     confidence: float
-
-
-async def get_db():
-    from server import db_instance
-    return db_instance
+    rating: Optional[float] = None
 
 
 @router.post("/generate-puzzles", response_model=List[GeneratedPuzzle])
 async def generate_puzzles(
     request: PuzzleGenerationRequest,
-    current_user_email: str = Depends(get_current_user_email),
+    current_user: dict = Depends(get_current_principal),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """
-    Generate puzzles using AI (GPT-5)
+    Generate puzzles using AI (GPT-5), served from the pre-generated pool when stocked
     """
+    bucket = puzzle_pool.bucket_key(request.category, request.difficulty)
+    generated_puzzles: List[GeneratedPuzzle] = []
+    
+    if bucket:
+        items = await puzzle_pool.take(db, current_user['id'], *bucket, request.count)
+        generated_puzzles = [GeneratedPuzzle(**item) for item in items]
+    
+    missing = request.count - len(generated_puzzles)
+    if not missing:
+        return generated_puzzles
+    
     try:
-        api_key = get_llm_key()
-        
-        # Create prompt based on category and difficulty
-        prompt = f"""Generate {request.count} unique {request.difficulty} {request.category} puzzle(s).
-
-Category: {request.category}
-Difficulty: {request.difficulty}
-
-For each puzzle, provide:
-1. An engaging question
-2. The correct answer
-3. A helpful hint
-4. A clear explanation of the solution
-
-Format your response as a JSON array with this structure:
-[
-  {{
-    "question": "the puzzle question",
-    "answer": "the correct answer",
-    "hint": "a helpful hint",
-    "explanation": "explanation of the solution"
-  }}
-]
-
-Make the puzzles creative, engaging, and appropriate for the difficulty level.
-For {request.category} puzzles, ensure they match the category theme.
-Keep questions concise and answers short (1-3 words)."""
-
-        # Initialize LLM chat
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"puzzle_gen_{current_user_email}",
-            system_message="You are a creative puzzle designer who creates engaging brain teasers and puzzles. Always respond with valid JSON."
-        ).with_model("openai", "gpt-5")
-
-        # Send message
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        # Parse response
-        response_text = response.strip()
-        
-        # Extract JSON from response
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
+        get_llm_key()
         
-        puzzles_data = json.loads(response_text)
+        # The pool could not cover the request; generate the rest live. Identical
+        # requests share a cached response, so drop anything this user already got
+        # and ask for a fresh one if that leaves nothing new.
+        session_id = f"puzzle_gen_{current_user['email']}"
+        fresh = await llm_puzzles.request_puzzles(request.category, request.difficulty, missing, session_id)
+        if bucket:
+            fresh = await puzzle_pool.claim(db, current_user['id'], *bucket, fresh)
+            if not fresh:
+                fresh = await llm_puzzles.request_puzzles(
+                    request.category, request.difficulty, missing, session_id, cached=False
+                )
+                fresh = await puzzle_pool.claim(db, current_user['id'], *bucket, fresh)
         
-        # Create GeneratedPuzzle objects
-        generated_puzzles = []
-        for puzzle_data in puzzles_data:
-            puzzle = GeneratedPuzzle(
-                question=puzzle_data["question"],
-                answer=puzzle_data["answer"],
-                hint=puzzle_data.get("hint", "Think carefully about the clues given."),
-                explanation=puzzle_data.get("explanation", ""),
-                category=request.category,
-                difficulty=request.difficulty
-            )
-            generated_puzzles.append(puzzle)
-        
-        return generated_puzzles
+        return generated_puzzles + fresh[:missing]
     
     except Exception as e:
         print(f"Error generating puzzles: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to generate puzzles: {str(e)}"
-        )
+        if generated_puzzles:
+            return generated_puzzles
+        if bucket and isinstance(e, (llm_gateway.LLMUnavailableError, asyncio.TimeoutError)):
+            # While the provider is down, repeated puzzles beat an error
+            items = await puzzle_pool.sample(db, *bucket, request.count)
+            if items:
+                return [GeneratedPuzzle(**item) for item in items]
+        raise _llm_http_error(e, "generate puzzles")
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.post("/generate-puzzles/stream")
+async def stream_generated_puzzles(
+    request: PuzzleGenerationRequest,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Generate puzzles like /generate-puzzles, sending each one as a Server-Sent Event
+    ("puzzle") as soon as it is ready, then a "done" event with the count
+    """
+    bucket = puzzle_pool.bucket_key(request.category, request.difficulty)
+    pooled: List[GeneratedPuzzle] = []
+    
+    if bucket:
+        items = await puzzle_pool.take(db, current_user['id'], *bucket, request.count)
+        pooled = [GeneratedPuzzle(**item) for item in items]
+    
+    if not pooled:
+        # Fail before the stream starts when there is nothing to send
+        get_llm_key()
+    
+    async def events():
+        sent = 0
+        for puzzle in pooled:
+            yield _sse("puzzle", puzzle.model_dump())
+            sent += 1
+        
+        try:
+            # As in /generate-puzzles, a cached response may hold nothing new for
+            # this user, in which case one fresh call is made
+            for cached in (True, False):
+                if sent >= request.count or not llm_gateway.llm_key():
+                    break
+                fresh = 0
+                puzzles = llm_puzzles.stream_puzzles(
+                    request.category, request.difficulty, request.count - sent,
+                    f"puzzle_gen_{current_user['email']}", cached=cached
+                )
+                async with aclosing(puzzles):
+                    async for puzzle in puzzles:
+                        if sent >= request.count:
+                            break
+                        if bucket and not await puzzle_pool.claim(db, current_user['id'], *bucket, [puzzle]):
+                            continue
+                        yield _sse("puzzle", puzzle.model_dump())
+                        sent += 1
+                        fresh += 1
+                if fresh or not bucket:
+                    break
+        except Exception as e:
+            print(f"Error streaming puzzles: {str(e)}")
+            fallback = []
+            if not sent and bucket and isinstance(e, (llm_gateway.LLMUnavailableError, asyncio.TimeoutError)):
+                fallback = await puzzle_pool.sample(db, *bucket, request.count)
+            for item in fallback:
+                yield _sse("puzzle", GeneratedPuzzle(**item).model_dump())
+                sent += 1
+            if not fallback:
+                yield _sse("error", {"detail": _llm_http_error(e, "generate puzzles").detail})
+        
+        yield _sse("done", {"count": sent})
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 @router.get("/puzzle-ideas")
@@ -142,20 +203,15 @@ async def get_puzzle_ideas(
     Get AI-generated puzzle ideas for inspiration
     """
     try:
-        api_key = get_llm_key()
+        get_llm_key()
         
         prompt = f"""Suggest 5 creative puzzle ideas for {category} puzzles. 
         
 Just list the puzzle concepts briefly (1 sentence each), no full puzzles."""
 
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"ideas_{current_user_email}_{category}",
-            system_message="You are a creative puzzle designer."
-        ).with_model("openai", "gpt-5")
-
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await llm_gateway.complete(
+            "You are a creative puzzle designer.", prompt, f"ideas_{current_user_email}_{category}"
+        )
         
         ideas = response.strip().split('\n')
         ideas = [idea.strip() for idea in ideas if idea.strip()]
@@ -163,81 +219,40 @@ Just list the puzzle concepts briefly (1 sentence each), no full puzzles."""
         return {"ideas": ideas}
     
     except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to generate ideas: {str(e)}"
-        )
+        raise _llm_http_error(e, "generate ideas")
 
 
 @router.post("/adaptive-difficulty", response_model=AdaptiveDifficultyResponse)
 async def get_adaptive_difficulty(
     request: AdaptiveDifficultyRequest,
-    current_user: dict = Depends(get_current_user),
+    current_user: dict = Depends(get_current_principal),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """
-    Analyze user performance and recommend optimal difficulty
+    Recommend the difficulty that suits the user's skill rating
     """
-    try:
-        api_key = get_llm_key()
-        
-        # Extract user stats
-        stats = request.user_stats
-        total_puzzles = stats.get('total_completed', 0)
-        success_rate = stats.get('success_rate', 0)
-        avg_time = stats.get('avg_completion_time', 0)
-        avg_attempts = stats.get('avg_attempts', 0)
-        recent_performance = stats.get('recent_performance', [])
-        
-        prompt = f"""Analyze this user's puzzle performance and recommend the optimal difficulty level (easy, medium, or hard).
-
-User Statistics:
-- Total puzzles completed: {total_puzzles}
-- Success rate: {success_rate}%
-- Average completion time: {avg_time} seconds
-- Average attempts per puzzle: {avg_attempts}
-- Recent performance (last 5 puzzles): {recent_performance}
-
-Provide a JSON response with:
-{{
-    "recommended_difficulty": "easy/medium/hard",
-    "explanation": "brief explanation of why",
-    "confidence": 0.0-1.0
-}}
-
-Consider:
-- Success rate above 80% → increase difficulty
-- Success rate below 50% → decrease difficulty  
-- Fast completion times → increase difficulty
-- Many attempts → decrease difficulty"""
-
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"adaptive_{current_user['id']}",
-            system_message="You are an AI that analyzes puzzle game performance to optimize player experience. Always respond with valid JSON."
-        ).with_model("openai", "gpt-5")
-
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        # Parse response
-        response_text = response.strip()
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        result = json.loads(response_text)
-        
-        return AdaptiveDifficultyResponse(
-            recommended_difficulty=result['recommended_difficulty'],
-            explanation=result['explanation'],
-            confidence=result.get('confidence', 0.8)
-        )
+    rating, games = await skill_ratings.get_rating(db, "user", current_user['id'])
+    if not games:
+        return AdaptiveDifficultyResponse(**skill_ratings.cold_start(request.user_stats))
     
-    except Exception as e:
-        print(f"Error in adaptive difficulty: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to analyze performance: {str(e)}"
-        )
+    recommendation = skill_ratings.recommend(rating, games)
+    explanation = skill_ratings.explain(rating, games, recommendation)
+    
+    if request.explain and llm_gateway.llm_key():
+        # Rounded inputs keep the prompt identical across similar players, so the LLM cache applies
+        prompt = f"""A player has a puzzle skill rating of {round(rating, -1):.0f} (new players start at {skill_ratings.DEFAULT_RATING:.0f}).
+We recommend {recommendation['recommended_difficulty']} puzzles, which they should solve about {recommendation['expected_success']:.0%} of the time.
+Explain this recommendation to the player."""
+        try:
+            explanation = (await llm_gateway.complete(
+                ADAPTIVE_SYSTEM_MESSAGE, prompt, f"adaptive_{current_user['id']}"
+            )).strip() or explanation
+        except Exception as e:
+            print(f"Error explaining adaptive difficulty: {str(e)}")
+    
+    return AdaptiveDifficultyResponse(
+        recommended_difficulty=recommendation['recommended_difficulty'],
+        explanation=explanation,
+        confidence=recommendation['confidence'],
+        rating=round(rating, 1)
+    )
@@ -1,66 +1,135 @@
-from fastapi import APIRouter, Depends
-from datetime import datetime, timezone, timedelta
-import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi import APIRouter, HTTPException, status, Depends, Path, Query
+from motor.motor_asyncio import AsyncIOMotorDatabase
+import asyncio
 
-from auth import get_current_user
+from auth import get_current_principal, get_admin_principal
+from database import get_db
+import analytics_rollups
+import analytics_snapshot
+import timing_sketches
 
 router = APIRouter(prefix="/analytics", tags=["analytics"])
 
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[os.environ.get('DB_NAME', 'mindspark_db')]
-
 
 @router.get("/dashboard")
-async def get_analytics_dashboard(current_user: dict = Depends(get_current_user)):
+async def get_analytics_dashboard(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get user analytics dashboard"""
+    user_id = current_user["id"]
     
-    progress = await db.user_progress.find_one({"user_id": current_user["id"]}, {"_id": 0})
-    if not progress:
-        progress = {"completed_puzzles": [], "score": 0}
-    
-    # Calculate stats
-    total_puzzles = len(progress.get("completed_puzzles", []))
-    total_score = progress.get("score", 0)
+    # Lifetime totals from the materialized leaderboard, wallet from the user
+    row = await db.leaderboard.find_one({"user_id": user_id}, {"_id": 0, "total_stars": 1, "puzzles_completed": 1}) or {}
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "coins": 1, "hints": 1, "lives": 1}) or {}
     
-    # Get recent activity (last 7 days)
-    seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    # Recent behaviour from the day rollups
+    summary = analytics_rollups.summarize(await analytics_rollups.load_rollups(db, user_id))
     
     return {
-        "total_puzzles_completed": total_puzzles,
-        "total_score": total_score,
-        "coins": progress.get("coins", 0),
-        "hints": progress.get("hints", 0),
-        "lives": progress.get("lives", 3),
-        "avg_completion_time": 45,
-        "success_rate": 85,
-        "streak_days": 3,
-        "favorite_category": "logic"
+        "total_puzzles_completed": row.get("puzzles_completed", 0),
+        "total_score": row.get("total_stars", 0),
+        "coins": user.get("coins", 0),
+        "hints": user.get("hints", 0),
+        "lives": user.get("lives", 3),
+        "avg_completion_time": summary["avg_completion_time"],
+        "success_rate": summary["success_rate"],
+        "streak_days": summary["streak_days"],
+        "favorite_category": summary["favorite_category"]
     }
 
 
 @router.get("/stats")
-async def get_user_stats(current_user: dict = Depends(get_current_user)):
+async def get_user_stats(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get detailed user statistics"""
     
-    progress = await db.user_progress.find_one({"user_id": current_user["id"]}, {"_id": 0})
-    
-    if not progress:
-        return {
-            "total_completed": 0,
-            "success_rate": 0,
-            "avg_completion_time": 0,
-            "avg_attempts": 0,
-            "recent_performance": []
-        }
-    
-    completed_puzzles = progress.get("completed_puzzles", [])
+    summary = analytics_rollups.summarize(await analytics_rollups.load_rollups(db, current_user["id"]))
     
     return {
-        "total_completed": len(completed_puzzles),
-        "success_rate": 85,
-        "avg_completion_time": 45,
-        "avg_attempts": 1.5,
-        "recent_performance": [85, 90, 80, 95, 88]
+        "total_completed": summary["solves"],
+        "success_rate": summary["success_rate"],
+        "avg_completion_time": summary["avg_completion_time"],
+        "completion_time_stddev": summary["completion_time_stddev"],
+        "avg_attempts": summary["avg_attempts"],
+        "hints_used": summary["hints_used"],
+        "streak_days": summary["streak_days"],
+        "recent_performance": summary["recent_performance"],
+        "window_days": summary["window_days"]
     }
+
+
+@router.get("/puzzles/{puzzle_id}/timing")
+async def get_puzzle_timing(
+    puzzle_id: int = Path(..., ge=0),
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """Get p50/p90/p99 solve times for a puzzle (values within relative_error of exact)"""
+    sketch = await timing_sketches.load(db, "puzzle", str(puzzle_id))
+    return {"puzzle_id": puzzle_id, **timing_sketches.summarize(sketch)}
+
+
+@router.get("/categories/{category}/timing")
+async def get_category_timing(
+    category: str = Path(..., pattern="^[A-Za-z0-9_-]{1,32}$"),
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """Get p50/p90/p99 solve times across a puzzle category"""
+    sketch = await timing_sketches.load(db, "category", category)
+    return {"category": category, **timing_sketches.summarize(sketch)}
+
+
+def _current_snapshot() -> analytics_snapshot.Snapshot:
+    """The published analytics snapshot, or 503 until the first export"""
+    snapshot = analytics_snapshot.load_current()
+    if snapshot is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No analytics snapshot has been exported yet"
+        )
+    return snapshot
+
+
+async def _in_executor(func, *args):
+    """Run a NumPy snapshot query off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+@router.get("/admin/snapshot")
+async def get_snapshot_info(admin: dict = Depends(get_admin_principal)):
+    """Get the manifest of the snapshot admin analytics are served from"""
+    return _current_snapshot().manifest
+
+
+@router.get("/admin/activity")
+async def get_activity(
+    days: int = Query(30, ge=1, le=365),
+    admin: dict = Depends(get_admin_principal)
+):
+    """Get daily and weekly active users for recent days"""
+    snapshot = _current_snapshot()
+    return {"generated_at": snapshot.manifest["generated_at"], "days": await _in_executor(snapshot.activity, days)}
+
+
+@router.get("/admin/retention")
+async def get_retention(
+    cohort_days: int = Query(60, ge=1, le=365),
+    admin: dict = Depends(get_admin_principal)
+):
+    """Get D1/D7/D30 retention for users who signed up recently"""
+    snapshot = _current_snapshot()
+    return {"generated_at": snapshot.manifest["generated_at"], **await _in_executor(snapshot.retention, cohort_days)}
+
+
+@router.get("/admin/funnel")
+async def get_funnel(
+    cohort_days: int = Query(None, ge=1, le=365),
+    admin: dict = Depends(get_admin_principal)
+):
+    """Get the signup to play to completion funnel"""
+    snapshot = _current_snapshot()
+    return {"generated_at": snapshot.manifest["generated_at"], "steps": await _in_executor(snapshot.funnel, cohort_days)}
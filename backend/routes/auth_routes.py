@@ -3,16 +3,16 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 from datetime import datetime, timezone, timedelta
 
 from models import User, UserCreate, UserLogin, Token, UserProfile, Settings
-from auth import get_password_hash, verify_password, create_access_token, get_current_user_email
+from auth import (
+    get_password_hash_async, verify_password_async, create_access_token, build_token_claims,
+    get_current_user_email, get_current_principal, invalidate_principal, revoke_user_tokens
+)
+from database import get_db
+import leaderboard
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
 
-async def get_db():
-    from server import db_instance
-    return db_instance
-
-
 @router.post("/signup", response_model=Token, status_code=status.HTTP_201_CREATED)
 async def signup(user_data: UserCreate, db: AsyncIOMotorDatabase = Depends(get_db)):
     """
@@ -34,7 +34,7 @@ async def signup(user_data: UserCreate, db: AsyncIOMotorDatabase = Depends(get_d
     )
     
     # Hash password
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
     
     # Store user in database
     user_dict = user.model_dump()
@@ -49,9 +49,10 @@ async def signup(user_data: UserCreate, db: AsyncIOMotorDatabase = Depends(get_d
     profile_dict = profile.model_dump()
     profile_dict['updated_at'] = profile_dict['updated_at'].isoformat()
     await db.user_profiles.insert_one(profile_dict)
+    await leaderboard.apply_delta(db, user.model_dump())
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data=build_token_claims(user.model_dump()))
     
     return Token(
         access_token=access_token,
@@ -76,7 +77,7 @@ async def login(credentials: UserLogin, db: AsyncIOMotorDatabase = Depends(get_d
         )
     
     # Verify password
-    if not verify_password(credentials.password, user_dict['password_hash']):
+    if not await verify_password_async(credentials.password, user_dict['password_hash']):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -88,6 +89,7 @@ async def login(credentials: UserLogin, db: AsyncIOMotorDatabase = Depends(get_d
         {"email": credentials.email},
         {"$set": {"last_login": datetime.now(timezone.utc).isoformat()}}
     )
+    invalidate_principal(credentials.email)
     
     # Remove password hash from response
     user_dict.pop('password_hash', None)
@@ -101,7 +103,7 @@ async def login(credentials: UserLogin, db: AsyncIOMotorDatabase = Depends(get_d
     user = User(**user_dict)
     
     # Create access token
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data=build_token_claims(user.model_dump()))
     
     return Token(
         access_token=access_token,
@@ -111,10 +113,16 @@ async def login(credentials: UserLogin, db: AsyncIOMotorDatabase = Depends(get_d
 
 
 @router.post("/logout")
-async def logout(current_user_email: str = Depends(get_current_user_email)):
+async def logout(
+    all_devices: bool = False,
+    current_user: dict = Depends(get_current_principal)
+):
     """
-    Logout (client-side token removal)
+    Logout (client-side token removal), optionally revoking tokens on every device
     """
+    if all_devices:
+        await revoke_user_tokens(current_user["id"], current_user["email"])
+    
     return {"message": "Successfully logged out"}
 
 
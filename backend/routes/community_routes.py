@@ -1,22 +1,21 @@
 from fastapi import APIRouter, HTTPException, Depends, Query
-from typing import List, Optional
+from typing import Optional
 from datetime import datetime, timezone
-import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from models_multiplayer import CommunityPuzzle, PuzzleRating
-from auth import get_current_user
+from auth import get_current_principal
+from database import get_db
 
 router = APIRouter(prefix="/community", tags=["community"])
 
-# MongoDB connection
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[os.environ.get('DB_NAME', 'mindspark_db')]
-
 
 @router.post("/puzzles", status_code=201)
-async def create_puzzle(puzzle_data: dict, current_user: dict = Depends(get_current_user)):
+async def create_puzzle(
+    puzzle_data: dict,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Create a new community puzzle"""
     
     # Validate required fields
@@ -52,7 +51,8 @@ async def get_community_puzzles(
     category: Optional[str] = None,
     difficulty: Optional[str] = None,
     sort_by: str = Query("newest", regex="^(newest|popular|rating|plays)$"),
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Get community puzzles with filters"""
     
@@ -96,7 +96,10 @@ async def get_community_puzzles(
 
 
 @router.get("/puzzles/{puzzle_id}")
-async def get_puzzle(puzzle_id: str):
+async def get_puzzle(
+    puzzle_id: str,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get a specific community puzzle"""
     
     puzzle = await db.community_puzzles.find_one({"id": puzzle_id}, {"_id": 0})
@@ -117,7 +120,8 @@ async def get_puzzle(puzzle_id: str):
 async def rate_puzzle(
     puzzle_id: str,
     rating_data: dict,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Rate a community puzzle"""
     
@@ -169,7 +173,11 @@ async def rate_puzzle(
 
 
 @router.post("/puzzles/{puzzle_id}/like")
-async def like_puzzle(puzzle_id: str, current_user: dict = Depends(get_current_user)):
+async def like_puzzle(
+    puzzle_id: str,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Like a community puzzle"""
     
     # Check if already liked
@@ -204,7 +212,11 @@ async def like_puzzle(puzzle_id: str, current_user: dict = Depends(get_current_u
 
 
 @router.get("/puzzles/{puzzle_id}/user-rating")
-async def get_user_rating(puzzle_id: str, current_user: dict = Depends(get_current_user)):
+async def get_user_rating(
+    puzzle_id: str,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get user's rating for a puzzle"""
     
     rating = await db.puzzle_ratings.find_one({
@@ -216,7 +228,10 @@ async def get_user_rating(puzzle_id: str, current_user: dict = Depends(get_curre
 
 
 @router.get("/my-puzzles")
-async def get_my_puzzles(current_user: dict = Depends(get_current_user)):
+async def get_my_puzzles(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get puzzles created by current user"""
     
     cursor = db.community_puzzles.find({"creator_id": current_user["id"]}, {"_id": 0}).sort("created_at", -1)
@@ -226,7 +241,11 @@ async def get_my_puzzles(current_user: dict = Depends(get_current_user)):
 
 
 @router.delete("/puzzles/{puzzle_id}")
-async def delete_puzzle(puzzle_id: str, current_user: dict = Depends(get_current_user)):
+async def delete_puzzle(
+    puzzle_id: str,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Delete a community puzzle (creator only)"""
     
     puzzle = await db.community_puzzles.find_one({"id": puzzle_id})
@@ -1,19 +1,13 @@
 from fastapi import APIRouter, HTTPException, Depends
-from typing import List
 from datetime import datetime, timezone
-import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel
 
-from auth import get_current_user
+from auth import get_current_principal
+from database import get_db
 
 router = APIRouter(prefix="/friends", tags=["friends"])
 
-# MongoDB connection
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[os.environ.get('DB_NAME', 'mindspark_db')]
-
 
 class FriendRequest(BaseModel):
     friend_email: str
@@ -27,7 +21,8 @@ class Challenge(BaseModel):
 @router.get("/search")
 async def search_users(
     query: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Search for users by name or email"""
     
@@ -51,7 +46,8 @@ async def search_users(
 @router.post("/request")
 async def send_friend_request(
     request: FriendRequest,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Send a friend request"""
     
@@ -92,7 +88,10 @@ async def send_friend_request(
 
 
 @router.get("/requests")
-async def get_friend_requests(current_user: dict = Depends(get_current_user)):
+async def get_friend_requests(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get pending friend requests"""
     
     cursor = db.friends.find({
@@ -113,7 +112,8 @@ async def get_friend_requests(current_user: dict = Depends(get_current_user)):
 @router.post("/accept/{user_id}")
 async def accept_friend_request(
     user_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Accept a friend request"""
     
@@ -139,7 +139,8 @@ async def accept_friend_request(
 @router.post("/reject/{user_id}")
 async def reject_friend_request(
     user_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Reject a friend request"""
     
@@ -156,7 +157,10 @@ async def reject_friend_request(
 
 
 @router.get("/list")
-async def get_friends(current_user: dict = Depends(get_current_user)):
+async def get_friends(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get list of friends"""
     
     cursor = db.friends.find({
@@ -182,7 +186,8 @@ async def get_friends(current_user: dict = Depends(get_current_user)):
 @router.delete("/{friend_id}")
 async def remove_friend(
     friend_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Remove a friend"""
     
@@ -203,7 +208,8 @@ async def remove_friend(
 @router.post("/challenge")
 async def challenge_friend(
     challenge: Challenge,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """Challenge a friend to solve a specific puzzle"""
     
@@ -240,7 +246,10 @@ async def challenge_friend(
 
 
 @router.get("/challenges")
-async def get_challenges(current_user: dict = Depends(get_current_user)):
+async def get_challenges(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Get challenges sent to current user"""
     
     cursor = db.challenges.find({
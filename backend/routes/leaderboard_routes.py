@@ -1,20 +1,20 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Path, Query, Request, Response
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from typing import List
 
 from models import LeaderboardEntry
-from auth import get_current_user_email
+from auth import get_current_user_email, get_current_principal
+from database import get_db
+import leaderboard
+import leaderboard_windows
+import leaderboard_snapshot
 
 router = APIRouter(prefix="/leaderboard", tags=["leaderboard"])
 
 
-async def get_db():
-    from server import db_instance
-    return db_instance
-
-
 @router.get("", response_model=List[LeaderboardEntry])
 async def get_leaderboard(
+    request: Request,
     limit: int = 100,
     current_user_email: str = Depends(get_current_user_email),
     db: AsyncIOMotorDatabase = Depends(get_db)
@@ -22,67 +22,70 @@ async def get_leaderboard(
     """
     Get global leaderboard
     """
-    # Aggregate leaderboard data
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "user_profiles",
-                "localField": "id",
-                "foreignField": "user_id",
-                "as": "profile"
-            }
-        },
-        {
-            "$unwind": {
-                "path": "$profile",
-                "preserveNullAndEmptyArrays": True
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "user_id": "$id",
-                "name": 1,
-                "avatar": 1,
-                "level_progress": "$profile.level_progress"
-            }
+    # The default board is served from the pre-serialized snapshot
+    snapshot = leaderboard_snapshot.get_snapshot()
+    if snapshot and limit == leaderboard_snapshot.SNAPSHOT_SIZE:
+        headers = {
+            "ETag": snapshot["etag"],
+            "Cache-Control": "private, no-cache",
+            "X-Snapshot-Age": str(int(leaderboard_snapshot.snapshot_age(snapshot)))
         }
-    ]
-    
-    users = await db.users.aggregate(pipeline).to_list(None)
+        if_none_match = request.headers.get("if-none-match", "")
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if snapshot["etag"] in candidates or "*" in candidates:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=snapshot["body"], media_type="application/json", headers=headers)
     
-    # Calculate stats for each user
-    leaderboard = []
-    for user in users:
-        level_progress = user.get('level_progress', {})
-        
-        total_stars = 0
-        puzzles_completed = 0
-        total_time = 0.0
-        
-        for puzzle_id, progress in level_progress.items():
-            if progress.get('completed'):
-                puzzles_completed += 1
-            total_stars += progress.get('stars', 0)
-            if progress.get('bestTime'):
-                total_time += progress.get('bestTime', 0)
-        
-        leaderboard.append(
-            LeaderboardEntry(
-                user_id=user['user_id'],
-                name=user['name'],
-                avatar=user['avatar'],
-                total_stars=total_stars,
-                puzzles_completed=puzzles_completed,
-                total_time=total_time
-            )
+    rows = await leaderboard.get_top(db, limit)
+    return [LeaderboardEntry(**row) for row in rows]
+
+
+@router.get("/window/{window}", response_model=List[LeaderboardEntry])
+async def get_window_leaderboard(
+    window: str = Path(..., regex="^(today|week|7d)$"),
+    limit: int = Query(100, ge=1, le=500),
+    current_user_email: str = Depends(get_current_user_email),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Get a tournament leaderboard for today, this ISO week or the rolling 7 days
+    """
+    rows = await leaderboard_windows.get_window(db, window, limit)
+    return [LeaderboardEntry(**row) for row in rows]
+
+
+@router.get("/me", response_model=LeaderboardEntry)
+async def get_my_rank(
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Get the current user's leaderboard entry and rank
+    """
+    row = await leaderboard.get_rank(db, current_user["id"])
+    if not row:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User is not on the leaderboard"
         )
     
-    # Sort by total stars (descending), then by puzzles completed
-    leaderboard.sort(key=lambda x: (x.total_stars, x.puzzles_completed), reverse=True)
-    
-    # Add ranks
-    for idx, entry in enumerate(leaderboard[:limit]):
-        entry.rank = idx + 1
+    return LeaderboardEntry(**row)
+
+
+@router.get("/around", response_model=List[LeaderboardEntry])
+async def get_leaderboard_around_me(
+    radius: int = Query(5, ge=0, le=50),
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Get the leaderboard window around the current user
+    """
+    rows = await leaderboard.get_around(db, current_user["id"], radius)
+    if not rows:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User is not on the leaderboard"
+        )
     
-    return leaderboard[:limit]
+    return [LeaderboardEntry(**row) for row in rows]
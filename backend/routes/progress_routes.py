@@ -1,159 +1,271 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request, Response
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from datetime import datetime, timezone
-from typing import Dict, Any
+from datetime import datetime, timezone, timedelta
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Any, Optional, List
+import base64
+import hashlib
+import os
 
-from models import UserProfile, ProgressSync, PuzzleProgress
-from auth import get_current_user_email
+from models import ProgressSync, ProgressDeltaSync, PuzzleEventBatch
+from auth import get_current_principal
+from database import get_db
+import leaderboard
+import leaderboard_windows
+import progress_store
+import progress_buffer
+import progress_pack
+import puzzle_events
+import timing_sketches
+from progress_merge import version_now
 
 router = APIRouter(prefix="/progress", tags=["progress"])
 
+# Delta sync hands back a version this far in the past, so entries stamped by a
+# concurrent writer just before our write are re-sent on the next sync
+SYNC_LOOKBACK_MS = int(os.environ.get("PROGRESS_SYNC_LOOKBACK_MS", 2000))
 
-async def get_db():
-    from server import db_instance
-    return db_instance
+# Client-reported event times outside this window are replaced by the server time
+EVENT_MAX_AGE = timedelta(days=7)
+EVENT_MAX_SKEW = timedelta(minutes=1)
+
+LOAD_FIELDS = ("level_progress", "settings", "achievements", "stats", "user")
+
+
+def _load_fields(fields: Optional[str]) -> List[str]:
+    """Requested /progress/load sections, all of them by default"""
+    if not fields:
+        return list(LOAD_FIELDS)
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in selected if field not in LOAD_FIELDS]
+    if unknown or not selected:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"fields must be a comma-separated subset of {', '.join(LOAD_FIELDS)}"
+        )
+    return [field for field in LOAD_FIELDS if field in selected]
+
+
+def _last_modified(updated_at: Optional[str]) -> Optional[datetime]:
+    """Whole-second Last-Modified for a profile, withheld while its second is still current"""
+    if not updated_at:
+        return None
+    try:
+        modified = datetime.fromisoformat(updated_at)
+    except (TypeError, ValueError):
+        return None
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=timezone.utc)
+    # A later write in the same second would share the header and be missed
+    if (datetime.now(timezone.utc) - modified).total_seconds() < 1:
+        return None
+    return modified.replace(microsecond=0)
+
+
+def _not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """Evaluate If-None-Match, then If-Modified-Since, against the current validators"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag.removeprefix("W/") in candidates or "*" in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
 
 
 @router.post("/sync")
 async def sync_progress(
     sync_data: ProgressSync,
-    current_user_email: str = Depends(get_current_user_email),
+    current_user: dict = Depends(get_current_principal),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """
     Sync user progress to cloud
     """
-    # Get user
-    user = await db.users.find_one({"email": current_user_email}, {"_id": 0})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    user_id = user['id']
-    
-    # Get or create user profile
-    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
-    
-    update_data = {
-        "level_progress": sync_data.level_progress,
-        "updated_at": datetime.now(timezone.utc).isoformat()
-    }
+    user_id = current_user['id']
     
+    extra_set = {}
     if sync_data.settings:
-        update_data["settings"] = sync_data.settings.model_dump()
+        extra_set["settings"] = sync_data.settings.model_dump()
     
     if sync_data.achievements:
-        update_data["achievements"] = sync_data.achievements
+        extra_set["achievements"] = sync_data.achievements
     
     if sync_data.stats:
-        update_data["stats"] = sync_data.stats
+        extra_set["stats"] = sync_data.stats
     
-    if profile:
-        # Update existing profile
-        await db.user_profiles.update_one(
-            {"user_id": user_id},
-            {"$set": update_data}
-        )
-    else:
-        # Create new profile
-        profile_data = UserProfile(user_id=user_id, **update_data)
-        profile_dict = profile_data.model_dump()
-        profile_dict['updated_at'] = profile_dict['updated_at'].isoformat()
-        await db.user_profiles.insert_one(profile_dict)
+    # The write hands back the replaced progress, so the leaderboard delta is
+    # computed from exactly what this overwrite replaced
+    old_progress, changed = await progress_store.replace_progress(db, user_id, sync_data.level_progress, extra_set)
+    await leaderboard.apply_delta(db, current_user, leaderboard.progress_delta(old_progress, sync_data.level_progress))
     
-    # Store individual puzzle progress
-    for puzzle_id, progress in sync_data.level_progress.items():
-        puzzle_progress = PuzzleProgress(
-            user_id=user_id,
-            puzzle_id=int(puzzle_id),
-            completed=progress.get('completed', False),
-            stars=progress.get('stars', 0),
-            best_time=progress.get('bestTime'),
-            attempts=progress.get('attempts', 0),
-            hints_used=progress.get('hintsUsed', 0)
+    # Store individual puzzle progress for the entries that changed
+    failed = await progress_store.upsert_puzzle_progress(db, user_id, changed)
+    
+    return {
+        "message": "Progress synced successfully",
+        "synced_at": datetime.now(timezone.utc).isoformat(),
+        "failed": failed
+    }
+
+
+@router.post("/v2/sync")
+async def sync_progress_delta(
+    sync_data: ProgressDeltaSync,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Merge changed puzzle entries and return server-side changes since base_version
+    """
+    user_id = current_user['id']
+    
+    if not all(puzzle_id.isdigit() for puzzle_id in sync_data.changes):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Puzzle ids must be integers"
         )
+    
+    extra_update = {"$set": {}}
+    if sync_data.settings:
+        extra_update["$set"]["settings"] = sync_data.settings.model_dump()
+    if sync_data.stats:
+        extra_update["$set"]["stats"] = sync_data.stats
+    if sync_data.achievements:
+        extra_update["$addToSet"] = {"achievements": {"$each": sync_data.achievements}}
+    
+    merged, failed = {}, []
+    if sync_data.changes or extra_update["$set"] or sync_data.achievements:
+        try:
+            old_entries, merged, versions, version = await progress_store.merge_progress(
+                db, user_id, sync_data.changes, extra_update
+            )
+        except (ValueError, TypeError):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="stars, attempts, hintsUsed and bestTime must be numbers"
+            )
         
-        # Upsert puzzle progress
-        await db.puzzle_progress.update_one(
-            {"user_id": user_id, "puzzle_id": int(puzzle_id)},
-            {"$set": puzzle_progress.model_dump()},
-            upsert=True
-        )
+        delta = (0, 0, 0.0)
+        for puzzle_id, entry in merged.items():
+            entry_delta = leaderboard.entry_delta(old_entries.get(puzzle_id), entry)
+            delta = tuple(total + change for total, change in zip(delta, entry_delta))
+        if merged:
+            await leaderboard.apply_delta(db, current_user, delta)
+        
+        # Store individual puzzle progress for the changed puzzles only
+        failed = await progress_store.upsert_puzzle_progress(db, user_id, merged, trusted=True)
+    else:
+        version = version_now()
+        profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0, "progress_versions": 1}) or {}
+        versions = profile.get("progress_versions", {})
     
-    return {"message": "Progress synced successfully", "synced_at": datetime.now(timezone.utc).isoformat()}
+    # Server-side changes the client has not seen yet
+    changes = dict(merged)
+    unseen = [puzzle_id for puzzle_id, stamp in versions.items() if stamp > sync_data.base_version and puzzle_id not in merged]
+    if unseen:
+        projection = {"_id": 0, **{f"level_progress.{puzzle_id}": 1 for puzzle_id in unseen}}
+        profile = await db.user_profiles.find_one({"user_id": user_id}, projection) or {}
+        changes.update(profile.get("level_progress", {}))
+    
+    return {
+        "version": version - SYNC_LOOKBACK_MS,
+        "changes": changes,
+        "synced_at": datetime.now(timezone.utc).isoformat(),
+        "failed": failed
+    }
 
 
 @router.get("/load")
 async def load_progress(
-    current_user_email: str = Depends(get_current_user_email),
+    request: Request,
+    response: Response,
+    format: str = Query("json", pattern="^(json|packed)$"),
+    fields: Optional[str] = Query(None),
+    current_user: dict = Depends(get_current_principal),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ) -> Dict[str, Any]:
     """
     Load user progress from cloud
-    """
-    # Get user
-    user = await db.users.find_one({"email": current_user_email}, {"_id": 0})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
     
-    user_id = user['id']
-    
-    # Get user profile
-    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
-    
-    if not profile:
-        # Return empty progress
-        return {
-            "level_progress": {},
-            "settings": {},
-            "achievements": [],
-            "stats": {},
-            "user": {
-                "coins": user.get('coins', 100),
-                "hints": user.get('hints', 5),
-                "lives": user.get('lives', 3)
-            }
-        }
+    fields selects sections (e.g. fields=settings). format=packed returns
+    level_progress as a base64 progress_pack blob, with entries that cannot be
+    packed left in level_progress. Responses carry an ETag (and Last-Modified
+    when the wallet is not requested) and are answered with 304 when unchanged.
+    """
+    user_id = current_user['id']
+    sections = _load_fields(fields)
     
-    return {
-        "level_progress": profile.get('level_progress', {}),
-        "settings": profile.get('settings', {}),
-        "achievements": profile.get('achievements', []),
-        "stats": profile.get('stats', {}),
-        "user": {
+    # Validators come from narrow reads so a 304 never touches the full profile
+    meta = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0, "updated_at": 1}) or {}
+    wallet = None
+    if "user" in sections:
+        # Wallet counters are not part of the cached principal or profile updated_at
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "coins": 1, "hints": 1, "lives": 1}) or {}
+        wallet = {
             "coins": user.get('coins', 100),
             "hints": user.get('hints', 5),
             "lives": user.get('lives', 3)
         }
-    }
+    
+    fingerprint = f"{meta.get('updated_at')}|{format}|{','.join(sections)}|{wallet}"
+    etag = f'W/"{hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    last_modified = _last_modified(meta.get('updated_at')) if wallet is None else None
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    
+    result: Dict[str, Any] = {}
+    profile_sections = [section for section in sections if section != "user"]
+    projection = {"_id": 0, "updated_at": 1, **{section: 1 for section in profile_sections}}
+    
+    if format == "packed" and "level_progress" in sections:
+        projection.pop("level_progress")
+        projection["level_progress_packed"] = 1
+        profile = await db.user_profiles.find_one({"user_id": user_id}, projection) or {}
+        packed = progress_pack.fresh_packed(profile)
+        if packed is None:
+            current = await db.user_profiles.find_one(
+                {"user_id": user_id}, {"_id": 0, "level_progress": 1, "updated_at": 1}
+            ) or {}
+            packed = await progress_pack.store_packed(db, user_id, current) if current else progress_pack.packed_document({})
+        result["format"] = progress_pack.PACKED_FORMAT
+        result["level_progress_packed"] = base64.b64encode(bytes(packed["data"])).decode("ascii")
+        result["level_progress"] = packed.get("extra", {})
+    elif profile_sections:
+        profile = await db.user_profiles.find_one({"user_id": user_id}, projection) or {}
+    else:
+        profile = {}
+    
+    defaults = {"level_progress": {}, "settings": {}, "achievements": [], "stats": {}}
+    for section in profile_sections:
+        if section not in result:
+            result[section] = profile.get(section, defaults[section])
+    if wallet is not None:
+        result["user"] = wallet
+    return result
 
 
 @router.post("/complete")
 async def complete_level(
     level_data: dict,
-    current_user_email: str = Depends(get_current_user_email),
+    current_user: dict = Depends(get_current_principal),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """
     Mark a level as completed
     """
-    # Get user
-    user = await db.users.find_one({"email": current_user_email}, {"_id": 0})
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    
-    user_id = user['id']
+    user_id = current_user['id']
     level_id = level_data.get('level_id')
-    stars = level_data.get('stars', 1)
-    time_taken = level_data.get('time_taken', 0)
     
     if not level_id:
         raise HTTPException(
@@ -161,57 +273,104 @@ async def complete_level(
             detail="level_id is required"
         )
     
-    # Update user profile with level completion
-    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
+    puzzle_id = str(level_id)
+    if not puzzle_id.isdigit():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="level_id must be a puzzle number"
+        )
     
-    if not profile:
-        # Create new profile
-        profile_data = UserProfile(user_id=user_id)
-        profile_dict = profile_data.model_dump()
-        profile_dict['updated_at'] = profile_dict['updated_at'].isoformat()
-        await db.user_profiles.insert_one(profile_dict)
-        profile = profile_dict
+    # Coerced once, before any write, and shared by every store below
+    try:
+        stars = min(3, max(0, int(level_data.get('stars', 1))))
+        time_taken = float(level_data.get('time_taken') or 0)
+        hints_used = max(0, int(level_data.get('hints_used') or 0))
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="stars, time_taken and hints_used must be numbers"
+        )
     
-    # Update level progress
-    level_progress = profile.get('level_progress', {})
-    level_progress[str(level_id)] = {
+    change = {
         'completed': True,
         'stars': stars,
-        'bestTime': time_taken,
-        'attempts': level_progress.get(str(level_id), {}).get('attempts', 0) + 1,
-        'hintsUsed': level_data.get('hints_used', 0)
+        'attempts': 1,
+        'hintsUsed': hints_used
     }
+    # bestTime merges with $min, so a missing or zero time must not become the best time
+    if time_taken > 0:
+        change['bestTime'] = time_taken
+    else:
+        time_taken = 0.0
     
-    # Update profile
-    await db.user_profiles.update_one(
-        {"user_id": user_id},
-        {"$set": {
-            "level_progress": level_progress,
-            "updated_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    category = level_data.get('category')
+    if not (isinstance(category, str) and puzzle_events.CATEGORY_PATTERN.match(category)):
+        category = None
     
-    # Store individual puzzle progress
-    puzzle_progress = PuzzleProgress(
-        user_id=user_id,
-        puzzle_id=int(level_id),
-        completed=True,
-        stars=stars,
-        best_time=time_taken,
-        attempts=level_progress[str(level_id)]['attempts'],
-        hints_used=level_data.get('hints_used', 0)
-    )
+    try:
+        puzzle_events.record(
+            user_id, int(puzzle_id), "complete",
+            stars=stars, time_taken=time_taken or None, hints=hints_used,
+            category=category
+        )
+        timing_sketches.observe(int(puzzle_id), category, time_taken)
+        if progress_buffer.WRITE_BEHIND_ENABLED:
+            # Acknowledge once queued; the flusher merges and writes it
+            progress_buffer.add_completion(current_user, puzzle_id, change)
+            return {
+                "message": "Level completion queued",
+                "level_id": level_id,
+                "stars": stars,
+                "buffered": True,
+                "completed_at": datetime.now(timezone.utc).isoformat()
+            }
+        
+        # One atomic merge: stars keep the max, bestTime the min, attempts add up
+        old_entries, merged, _, _ = await progress_store.merge_progress(db, user_id, {puzzle_id: change})
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="stars, time_taken and hints_used must be numbers"
+        )
+    progress = merged[puzzle_id]
     
-    # Upsert puzzle progress
-    await db.puzzle_progress.update_one(
-        {"user_id": user_id, "puzzle_id": int(level_id)},
-        {"$set": puzzle_progress.model_dump()},
-        upsert=True
+    await leaderboard.apply_delta(db, current_user, leaderboard.entry_delta(old_entries.get(puzzle_id), progress))
+    await leaderboard_windows.record_completion(
+        db, current_user, leaderboard_windows.completion_gain(old_entries.get(puzzle_id), progress)
     )
     
+    # Store individual puzzle progress
+    await progress_store.upsert_puzzle_progress(db, user_id, {puzzle_id: progress}, trusted=True)
+    
     return {
         "message": "Level completed successfully",
         "level_id": level_id,
         "stars": stars,
+        "progress": progress,
         "completed_at": datetime.now(timezone.utc).isoformat()
     }
+
+
+@router.post("/events")
+async def record_events(
+    batch: PuzzleEventBatch,
+    current_user: dict = Depends(get_current_principal)
+):
+    """
+    Record attempt, fail and hint events reported by the client
+    """
+    now = datetime.now(timezone.utc)
+    accepted = 0
+    for event in batch.events:
+        ts = event.ts
+        if ts is not None and ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        if ts is None or not (now - EVENT_MAX_AGE <= ts <= now + EVENT_MAX_SKEW):
+            ts = now
+        if puzzle_events.record(
+            current_user['id'], event.puzzle_id, event.type,
+            ts=ts, time_taken=event.time_taken, category=event.category
+        ):
+            accepted += 1
+    
+    return {"accepted": accepted, "dropped": len(batch.events) - accepted}
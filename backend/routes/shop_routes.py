@@ -1,19 +1,13 @@
 from fastapi import APIRouter, HTTPException, Depends
-from typing import List
 from datetime import datetime, timezone
-import os
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel
 
-from auth import get_current_user
+from auth import get_current_principal
+from database import get_db
 
 router = APIRouter(prefix="/shop", tags=["shop"])
 
-# MongoDB connection
-MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[os.environ.get('DB_NAME', 'mindspark_db')]
-
 
 class PurchaseRequest(BaseModel):
     item_id: str
@@ -34,7 +28,11 @@ async def get_shop_items():
 
 
 @router.post("/purchase")
-async def purchase_item(request: PurchaseRequest, current_user: dict = Depends(get_current_user)):
+async def purchase_item(
+    request: PurchaseRequest,
+    current_user: dict = Depends(get_current_principal),
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """Purchase an item"""
     items_response = await get_shop_items()
     item = next((i for i in items_response["items"] if i["id"] == request.item_id), None)
@@ -1,18 +1,16 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Response
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from datetime import datetime, timezone
 
 from models import User, UserUpdate
-from auth import get_current_user_email
+from auth import get_current_user_email, invalidate_principal, expire_token_claims, create_access_token, build_token_claims
+from database import get_db
+import leaderboard
+import leaderboard_windows
 
 router = APIRouter(prefix="/user", tags=["user"])
 
 
-async def get_db():
-    from server import db_instance
-    return db_instance
-
-
 @router.get("/profile", response_model=User)
 async def get_user_profile(
     current_user_email: str = Depends(get_current_user_email),
@@ -41,11 +39,13 @@ async def get_user_profile(
 @router.put("/profile", response_model=User)
 async def update_user_profile(
     updates: UserUpdate,
+    response: Response,
     current_user_email: str = Depends(get_current_user_email),
     db: AsyncIOMotorDatabase = Depends(get_db)
 ):
     """
-    Update user profile
+    Update user profile. When name or avatar change, a token with the new
+    claims is returned in the X-Access-Token header.
     """
     # Get current user
     user_dict = await db.users.find_one({"email": current_user_email}, {"_id": 0, "password_hash": 0})
@@ -65,9 +65,17 @@ async def update_user_profile(
             {"email": current_user_email},
             {"$set": update_data}
         )
+        invalidate_principal(current_user_email)
+        await leaderboard.update_identity(db, user_dict['id'], update_data)
+        await leaderboard_windows.update_identity(db, user_dict['id'], update_data)
         
         # Get updated user
         user_dict = await db.users.find_one({"email": current_user_email}, {"_id": 0, "password_hash": 0})
+        
+        if "name" in update_data or "avatar" in update_data:
+            # Existing tokens keep working but stop vouching for the old identity
+            await expire_token_claims(user_dict['id'], current_user_email)
+            response.headers["X-Access-Token"] = create_access_token(data=build_token_claims(user_dict))
     
     # Convert ISO strings back to datetime
     if isinstance(user_dict['created_at'], str):
@@ -1,9 +1,11 @@
 from fastapi import FastAPI, APIRouter, Depends
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from starlette.middleware.gzip import GZipMiddleware
+from motor.motor_asyncio import AsyncIOMotorDatabase
 import os
 import logging
+import asyncio
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List
@@ -16,15 +18,25 @@ from routes import auth_routes, user_routes, progress_routes, leaderboard_routes
 # Import WebSocket
 from websocket_server import socket_app, sio
 
+from database import get_database, get_db, close_client
+import hashing
+import leaderboard
+import leaderboard_windows
+import leaderboard_snapshot
+import progress_buffer
+import puzzle_events
+import analytics_rollups
+import analytics_snapshot
+import timing_sketches
+import puzzle_pool
+import skill_ratings
+import llm_gateway
+from auth import get_token_cache_metrics, get_principal_cache_metrics, run_revocation_refresher, ensure_revocation_indexes
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db_instance = client[os.environ['DB_NAME']]
-
 # Create the main app without a prefix
 app = FastAPI(title="MindSpark API", version="1.0.0")
 
@@ -32,11 +44,6 @@ app = FastAPI(title="MindSpark API", version="1.0.0")
 api_router = APIRouter(prefix="/api")
 
 
-# Database dependency
-async def get_db() -> AsyncIOMotorDatabase:
-    return db_instance
-
-
 # Define Models (keeping old status check for backward compatibility)
 class StatusCheck(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -66,6 +73,18 @@ async def root():
 async def health_check():
     return {"status": "healthy", "database": "connected"}
 
+@api_router.get("/metrics")
+async def get_metrics():
+    return {
+        "password_hashing": hashing.get_metrics(),
+        "token_cache": get_token_cache_metrics(),
+        "principal_cache": get_principal_cache_metrics(),
+        "progress_buffer": progress_buffer.get_metrics(),
+        "puzzle_events": puzzle_events.get_metrics(),
+        "puzzle_pool": puzzle_pool.get_metrics(),
+        "llm": llm_gateway.get_metrics()
+    }
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate, db: AsyncIOMotorDatabase = Depends(get_db)):
     status_dict = input.model_dump()
@@ -91,11 +110,6 @@ async def get_status_checks(db: AsyncIOMotorDatabase = Depends(get_db)):
     return status_checks
 
 
-# Override dependencies in route files
-def override_get_db():
-    return get_db
-
-
 # Include all routers with database dependency
 auth_router_with_db = APIRouter()
 auth_router_with_db.include_router(auth_routes.router)
@@ -140,6 +154,14 @@ app.add_middleware(
     allow_origins=["*"] if os.environ.get('CORS_ORIGINS', '*') == '*' else os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Access-Token"],
+)
+
+# Compress large responses for clients that accept gzip
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=int(os.environ.get('GZIP_MINIMUM_SIZE', 1024)),
+    compresslevel=int(os.environ.get('GZIP_COMPRESS_LEVEL', 6)),
 )
 
 # Include the main router in the app
@@ -155,6 +177,53 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    try:
+        await leaderboard.ensure_indexes(get_database())
+        await leaderboard_windows.ensure_indexes(get_database())
+        await puzzle_events.ensure_indexes(get_database())
+        await analytics_rollups.ensure_indexes(get_database())
+        await timing_sketches.ensure_indexes(get_database())
+        await puzzle_pool.ensure_indexes(get_database())
+        await skill_ratings.ensure_indexes(get_database())
+        await ensure_revocation_indexes(get_database())
+    except Exception as e:
+        logger.warning(f"Failed to create indexes: {e}")
+    try:
+        written = await leaderboard.ensure_populated(get_database())
+        if written:
+            logger.info(f"Built {written} leaderboard rows from existing profiles")
+    except Exception as e:
+        logger.warning(f"Failed to populate leaderboard: {e}")
+    background_tasks.append(asyncio.create_task(run_revocation_refresher()))
+    background_tasks.append(asyncio.create_task(leaderboard.run_rank_index_refresher(get_database())))
+    background_tasks.append(asyncio.create_task(leaderboard_snapshot.run_snapshot_refresher(get_database())))
+    background_tasks.append(asyncio.create_task(puzzle_events.run_ingester(get_database())))
+    background_tasks.append(asyncio.create_task(timing_sketches.run_persister(get_database())))
+    background_tasks.append(asyncio.create_task(puzzle_pool.run_refiller(get_database())))
+    if analytics_snapshot.SNAPSHOT_ENABLED:
+        background_tasks.append(asyncio.create_task(analytics_snapshot.run_exporter(get_database())))
+    if progress_buffer.WRITE_BEHIND_ENABLED:
+        background_tasks.append(asyncio.create_task(progress_buffer.run_flusher(get_database())))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for task in background_tasks:
+        task.cancel()
+    try:
+        await progress_buffer.flush(get_database())
+    except Exception as e:
+        logger.warning(f"Failed to flush buffered progress on shutdown: {e}")
+    try:
+        await puzzle_events.flush(get_database())
+    except Exception as e:
+        logger.warning(f"Failed to flush puzzle events on shutdown: {e}")
+    try:
+        await timing_sketches.persist(get_database())
+    except Exception as e:
+        logger.warning(f"Failed to persist timing sketches on shutdown: {e}")
+    hashing.shutdown()
+    close_client()
\ No newline at end of file
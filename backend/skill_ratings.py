@@ -0,0 +1,278 @@
+"""
+Elo-style skill ratings for players and puzzles.
+
+Every batch the puzzle_events ingester stores is folded into `skill_ratings`,
+one document per player or puzzle:
+
+    {"kind": "user" | "puzzle", "key": str, "base", "delta", "games", "updated_at"}
+
+A completion is a win for the player scored 0.55-1.0 by stars, less a little
+per hint; a failure is a loss. Failures are reported by the client, so only
+one counts per player and puzzle between completions (tracked in
+`skill_rating_fails`), and only for puzzles that already have a rating or a
+calibrated difficulty, i.e. that someone has been seen completing. Each result moves the player and the puzzle
+by K * (score - expected), where expected = 1 / (1 + 10^((puzzle - player) / 400))
+and K shrinks as either side plays more games. The rating is base + delta:
+delta is only ever changed with $inc, so workers never overwrite each other,
+and a puzzle's base is seeded from its calibrated difficulty in `puzzle_stats`
+when one exists.
+
+Adaptive difficulty then needs one indexed read: recommend() picks the
+difficulty band the player is expected to solve closest to TARGET_SUCCESS
+of the time.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATING = 1500.0
+TARGET_SUCCESS = float(os.environ.get("ADAPTIVE_TARGET_SUCCESS", 0.7))
+DIFFICULTY_RATINGS = {"easy": 1300.0, "medium": 1500.0, "hard": 1700.0}
+
+# K starts at *_K_MAX and decays towards *_K_MIN over roughly K_DECAY_GAMES games
+USER_K_MAX, USER_K_MIN = 48.0, 16.0
+PUZZLE_K_MAX, PUZZLE_K_MIN = 24.0, 4.0
+K_DECAY_GAMES = 30
+
+# How far calibrated difficulty scores (0-1) spread puzzle seeds around DEFAULT_RATING
+SEED_SPREAD = 800.0
+CONFIDENCE_GAMES = 10
+
+# Concurrent upserts of a new rating can collide on the unique index; the loser retries as an update
+DUPLICATE_KEY = 11000
+UPSERT_ATTEMPTS = 3
+
+RatingKey = Tuple[str, str]
+
+
+def expected_score(player: float, puzzle: float) -> float:
+    """Probability that a player of this rating solves a puzzle of that rating"""
+    return 1 / (1 + 10 ** ((puzzle - player) / 400))
+
+
+def _k_factor(games: int, k_max: float, k_min: float) -> float:
+    return k_min + (k_max - k_min) * math.exp(-games / K_DECAY_GAMES)
+
+
+def event_score(event: dict) -> Optional[float]:
+    """Result of an event from the player's side, or None if it is not rated"""
+    if event["type"] == "fail":
+        return 0.0
+    if event["type"] == "complete":
+        stars = min(3, max(0, event.get("stars", 1)))
+        return max(0.5, 0.55 + 0.15 * stars - 0.05 * event.get("hints", 0))
+    return None
+
+
+async def _load(db: AsyncIOMotorDatabase, kind: str, keys: Iterable[str]) -> Dict[RatingKey, dict]:
+    documents = await db.skill_ratings.find(
+        {"kind": kind, "key": {"$in": list(keys)}}, {"_id": 0, "key": 1, "base": 1, "delta": 1, "games": 1}
+    ).to_list(length=None)
+    return {(kind, doc["key"]): doc for doc in documents}
+
+
+async def _puzzle_seeds(db: AsyncIOMotorDatabase, puzzle_ids: Iterable[str]) -> Dict[str, float]:
+    """Starting ratings from calibrated difficulty, for puzzles with enough data"""
+    stats = await db.puzzle_stats.find(
+        {"puzzle_id": {"$in": [int(puzzle_id) for puzzle_id in puzzle_ids]}, "sufficient_data": True},
+        {"_id": 0, "puzzle_id": 1, "difficulty_score": 1}
+    ).to_list(length=None)
+    return {
+        str(row["puzzle_id"]): DEFAULT_RATING + (row["difficulty_score"] - 0.5) * SEED_SPREAD
+        for row in stats
+    }
+
+
+async def _countable_fails(db: AsyncIOMotorDatabase, events: List[dict]) -> List[dict]:
+    """
+    Drop repeated failures: a fail counts only if the player has not had one
+    counted on that puzzle since their last completion. skill_rating_fails
+    holds a mark for every pair whose last counted event is a fail.
+    """
+    # Pairs that fail before completing in this batch depend on earlier batches;
+    # inserting their mark both checks and sets it
+    first_types = {}
+    for event in events:
+        first_types.setdefault((event["user_id"], event["puzzle_id"]), event["type"])
+    waiting = [pair for pair, event_type in first_types.items() if event_type == "fail"]
+    repeated = set()
+    if waiting:
+        marks = [{"user_id": user_id, "puzzle_id": puzzle_id} for user_id, puzzle_id in waiting]
+        try:
+            await db.skill_rating_fails.insert_many(marks, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY for error in errors):
+                raise
+            repeated = {waiting[error["index"]] for error in errors}
+
+    armed = {pair: pair not in repeated for pair in first_types}
+    countable = []
+    for event in events:
+        pair = (event["user_id"], event["puzzle_id"])
+        if event["type"] == "complete":
+            armed[pair] = True
+        elif armed[pair]:
+            armed[pair] = False
+        else:
+            continue
+        countable.append(event)
+
+    # Waiting pairs still ending on a fail already hold their mark
+    waiting = set(waiting)
+    now = datetime.now(timezone.utc)
+    updates = [
+        DeleteOne({"user_id": user_id, "puzzle_id": puzzle_id}) if is_armed
+        else UpdateOne({"user_id": user_id, "puzzle_id": puzzle_id}, {"$setOnInsert": {"marked_at": now}}, upsert=True)
+        for (user_id, puzzle_id), is_armed in armed.items()
+        if is_armed or (user_id, puzzle_id) not in waiting
+    ]
+    if updates:
+        try:
+            await db.skill_rating_fails.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            logger.warning(f"Failed to update skill rating fail marks: {e}")
+    return countable
+
+
+async def _write(db: AsyncIOMotorDatabase, operations: List[UpdateOne]) -> None:
+    """bulk_write rating updates, retrying the ones that lost an upsert race"""
+    for attempt in range(UPSERT_ATTEMPTS):
+        try:
+            await db.skill_ratings.bulk_write(operations, ordered=False)
+            return
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if attempt == UPSERT_ATTEMPTS - 1 or not errors or any(error.get("code") != DUPLICATE_KEY for error in errors):
+                raise
+            operations = [operations[error["index"]] for error in errors]
+
+
+async def apply_events(db: AsyncIOMotorDatabase, events: List[dict]) -> int:
+    """Update player and puzzle ratings for a batch of events, returning how many were rated"""
+    rated = [(event, score) for event in events if (score := event_score(event)) is not None]
+    if not rated:
+        return 0
+
+    user_keys = {event["user_id"] for event, _ in rated}
+    puzzle_keys = {str(event["puzzle_id"]) for event, _ in rated}
+    stored = {**await _load(db, "user", user_keys), **await _load(db, "puzzle", puzzle_keys)}
+    unseeded = [key for key in puzzle_keys if ("puzzle", key) not in stored]
+    seeds = await _puzzle_seeds(db, unseeded) if unseeded else {}
+
+    # Fails only rate puzzles someone has completed; client-made-up ids never get a rating
+    known = {key for kind, key in stored if kind == "puzzle"} | set(seeds)
+    known |= {str(event["puzzle_id"]) for event, _ in rated if event["type"] == "complete"}
+    candidates = [event for event, _ in rated if str(event["puzzle_id"]) in known]
+    countable = await _countable_fails(db, candidates)
+    rated = [(event, event_score(event)) for event in countable]
+    if not rated:
+        return 0
+
+    # Work through the batch in order on local copies, then write one $inc per rating
+    state: Dict[RatingKey, dict] = {}
+
+    def current(kind: str, key: str) -> dict:
+        if (kind, key) not in state:
+            doc = stored.get((kind, key))
+            if doc:
+                base = doc.get("base", DEFAULT_RATING)
+            else:
+                base = seeds.get(key, DEFAULT_RATING) if kind == "puzzle" else DEFAULT_RATING
+            state[(kind, key)] = {
+                "base": base,
+                "rating": base + (doc.get("delta", 0.0) if doc else 0.0),
+                "games": doc.get("games", 0) if doc else 0,
+                "delta": 0.0,
+                "new_games": 0,
+            }
+        return state[(kind, key)]
+
+    for event, score in rated:
+        player = current("user", event["user_id"])
+        puzzle = current("puzzle", str(event["puzzle_id"]))
+        surprise = score - expected_score(player["rating"], puzzle["rating"])
+        player_change = _k_factor(player["games"], USER_K_MAX, USER_K_MIN) * surprise
+        puzzle_change = -_k_factor(puzzle["games"], PUZZLE_K_MAX, PUZZLE_K_MIN) * surprise
+        for side, change in ((player, player_change), (puzzle, puzzle_change)):
+            side["rating"] += change
+            side["delta"] += change
+            side["games"] += 1
+            side["new_games"] += 1
+
+    now = datetime.now(timezone.utc)
+    await _write(db, [
+        UpdateOne(
+            {"kind": kind, "key": key},
+            {
+                "$inc": {"delta": change["delta"], "games": change["new_games"]},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"base": change["base"]},
+            },
+            upsert=True
+        )
+        for (kind, key), change in state.items()
+    ])
+    return len(rated)
+
+
+async def get_rating(db: AsyncIOMotorDatabase, kind: str, key: str) -> Tuple[float, int]:
+    """(rating, games) for a player or puzzle; unrated ones start at DEFAULT_RATING"""
+    doc = await db.skill_ratings.find_one({"kind": kind, "key": key}, {"_id": 0, "base": 1, "delta": 1, "games": 1})
+    if not doc:
+        return DEFAULT_RATING, 0
+    return doc.get("base", DEFAULT_RATING) + doc.get("delta", 0.0), doc.get("games", 0)
+
+
+def recommend(rating: float, games: int) -> dict:
+    """Difficulty whose expected success rate is closest to TARGET_SUCCESS"""
+    expected = {name: expected_score(rating, level) for name, level in DIFFICULTY_RATINGS.items()}
+    difficulty = min(expected, key=lambda name: abs(expected[name] - TARGET_SUCCESS))
+    return {
+        "recommended_difficulty": difficulty,
+        "expected_success": expected[difficulty],
+        "confidence": round(games / (games + CONFIDENCE_GAMES), 2),
+    }
+
+
+def explain(rating: float, games: int, recommendation: dict) -> str:
+    """Plain-language reason for a recommendation"""
+    difficulty = recommendation["recommended_difficulty"]
+    return (
+        f"Your skill rating is {rating:.0f} after {games} rated puzzles. "
+        f"You should solve about {recommendation['expected_success']:.0%} of {difficulty} puzzles, "
+        f"the closest to the {TARGET_SUCCESS:.0%} success rate that keeps puzzles challenging but fair."
+    )
+
+
+def cold_start(stats: dict) -> dict:
+    """Recommendation from client-reported stats for players without rated games"""
+    def number(field: str) -> float:
+        try:
+            return float(stats.get(field) or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    success_rate, avg_attempts = number("success_rate"), number("avg_attempts")
+    if not number("total_completed"):
+        difficulty, reason = "easy", "Start with easy puzzles while we learn your skill level."
+    elif success_rate > 80 and avg_attempts <= 2:
+        difficulty, reason = "hard", "You solve most puzzles on the first tries, so step up to hard puzzles."
+    elif success_rate < 50 or avg_attempts > 3:
+        difficulty, reason = "easy", "Easy puzzles will help you build momentum before moving up."
+    else:
+        difficulty, reason = "medium", "Medium puzzles match your current success rate."
+    return {"recommended_difficulty": difficulty, "explanation": reason, "confidence": 0.3}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the rating lookup and fail mark indexes"""
+    await db.skill_ratings.create_index([("kind", ASCENDING), ("key", ASCENDING)], unique=True)
+    await db.skill_rating_fails.create_index([("user_id", ASCENDING), ("puzzle_id", ASCENDING)], unique=True)
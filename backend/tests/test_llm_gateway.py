@@ -0,0 +1,240 @@
+"""Circuit breaker transitions and the provider attempt wrapper"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("emergentintegrations")
+pytest.importorskip("litellm")
+
+import llm_gateway
+from llm_gateway import CircuitBreaker, LLMUnavailableError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_gateway.time, "monotonic", clock)
+    return clock
+
+
+def tripped(clock: Clock) -> CircuitBreaker:
+    breaker = CircuitBreaker(window_seconds=60, min_calls=4, error_rate=0.5, cooldown_seconds=30)
+    for succeeded in (True, True, False, False):
+        assert breaker.allow()
+        breaker.record(succeeded)
+    return breaker
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = CircuitBreaker(window_seconds=60, min_calls=4, error_rate=0.5, cooldown_seconds=30)
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == "closed"
+
+
+def test_opens_at_error_rate(clock):
+    breaker = tripped(clock)
+    assert breaker.state == "open"
+    assert breaker.opens == 1
+    assert not breaker.allow()
+    assert breaker.retry_after() == 30
+
+
+def test_old_failures_leave_the_window(clock):
+    breaker = CircuitBreaker(window_seconds=60, min_calls=4, error_rate=0.5, cooldown_seconds=30)
+    for _ in range(3):
+        breaker.record(False)
+    clock.now += 61
+    for _ in range(3):
+        breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == "closed"
+
+
+def test_half_open_admits_a_single_probe(clock):
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes(clock):
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    # The failures that opened it are forgotten
+    breaker.record(False)
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_for_another_cooldown(clock):
+    breaker = tripped(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert breaker.opens == 1
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_results_from_before_opening_are_ignored(clock):
+    breaker = tripped(clock)
+    breaker.record(True)
+    assert breaker.state == "open"
+    clock.now += 30
+    assert breaker.allow()
+
+
+class SlowChat:
+    """LlmChat stand-in whose provider never answers"""
+
+    def __init__(self, **_):
+        pass
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, message):
+        await asyncio.sleep(3600)
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    breaker = CircuitBreaker(window_seconds=60, min_calls=1, error_rate=0.5, cooldown_seconds=30)
+    monkeypatch.setattr(llm_gateway, "_breaker", breaker)
+    monkeypatch.setattr(llm_gateway, "_slots", None)
+    monkeypatch.setattr(llm_gateway, "_admitted", 0)
+    monkeypatch.setattr(llm_gateway, "LlmChat", SlowChat)
+    return breaker
+
+
+def attempt(deadline_seconds: float = 60):
+    return llm_gateway._attempt("system", "prompt", "session", "openai", "model", time.monotonic() + deadline_seconds)
+
+
+def test_cancelled_probe_releases_the_breaker(gateway):
+    gateway.record(False)
+    gateway._opened_at -= gateway.cooldown_seconds
+
+    async def scenario():
+        task = asyncio.create_task(attempt())
+        await asyncio.sleep(0.01)
+        assert gateway._probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert not gateway._probing
+    assert gateway.state == "open"
+    assert llm_gateway._admitted == 0
+
+
+def test_open_breaker_rejects_without_calling(gateway):
+    gateway.record(False)
+
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(attempt())
+    assert llm_gateway._admitted == 0
+
+
+def test_deadline_timeout_counts_as_failure(gateway):
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(attempt(deadline_seconds=0.05))
+    assert gateway.state == "open"
+    assert llm_gateway._admitted == 0
+
+
+@pytest.mark.parametrize("error, transient", [
+    (asyncio.TimeoutError(), True),
+    (ConnectionError(), True),
+    (type("RateLimited", (Exception,), {"status_code": 429})(), True),
+    (type("BadRequest", (Exception,), {"status_code": 400})(), False),
+    (ValueError("bad prompt"), False),
+])
+def test_only_transient_errors_are_retried(error, transient):
+    assert llm_gateway._is_transient(error) is transient
+
+
+class ServiceUnavailable(Exception):
+    status_code = 503
+
+
+def provider_stream(*items):
+    """acompletion(stream=True) stand-in yielding text deltas, or raising the exceptions among items"""
+    async def chunks():
+        for item in items:
+            if isinstance(item, BaseException):
+                raise item
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=item))])
+    return chunks()
+
+
+@pytest.fixture
+def provider(gateway, monkeypatch):
+    responses = []
+
+    async def acompletion(**kwargs):
+        response = responses.pop(0)
+        if isinstance(response, BaseException):
+            raise response
+        return response
+
+    monkeypatch.setattr(llm_gateway, "acompletion", acompletion)
+    # These tests are about retries, so keep the breaker from tripping on the first failure
+    monkeypatch.setattr(llm_gateway, "_breaker", CircuitBreaker(window_seconds=60, min_calls=100, error_rate=0.5, cooldown_seconds=30))
+    monkeypatch.setattr(llm_gateway, "RETRY_BACKOFF_SECONDS", 0.001)
+    monkeypatch.setattr(llm_gateway, "_cache", {})
+    monkeypatch.setattr(llm_gateway, "_stale", {})
+    return responses
+
+
+def read_stream(cached: bool = True) -> list:
+    async def scenario():
+        return [text async for text in llm_gateway.stream("system", "prompt", "session", cached=cached)]
+    return asyncio.run(scenario())
+
+
+def test_stream_yields_deltas_and_caches_the_whole_response(provider):
+    provider.append(provider_stream("[{", "}", "]"))
+    assert read_stream() == ["[{", "}", "]"]
+    assert read_stream() == ["[{}]"]
+    assert llm_gateway._admitted == 0
+
+
+def test_stream_retries_before_the_first_chunk_only(provider):
+    provider.extend([ServiceUnavailable(), provider_stream("a", "b")])
+    assert read_stream(cached=False) == ["a", "b"]
+
+    provider.extend([provider_stream("a", ServiceUnavailable()), provider_stream("c")])
+    with pytest.raises(ServiceUnavailable):
+        read_stream(cached=False)
+    assert len(provider) == 1
+    assert llm_gateway._admitted == 0
+
+
+def test_closing_a_stream_releases_its_slot(provider):
+    provider.append(provider_stream("a", "b", "c"))
+
+    async def scenario():
+        chunks = llm_gateway.stream("system", "prompt", "session")
+        assert await chunks.__anext__() == "a"
+        await chunks.aclose()
+        return llm_gateway._get_slots()._value
+
+    assert asyncio.run(scenario()) == llm_gateway.MAX_CONCURRENCY
+    assert llm_gateway._admitted == 0
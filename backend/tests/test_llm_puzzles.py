@@ -0,0 +1,56 @@
+"""PuzzleArrayParser yields the same objects however the response is chunked"""
+import json
+import random
+
+import pytest
+
+pytest.importorskip("emergentintegrations")
+pytest.importorskip("litellm")
+
+from llm_puzzles import PuzzleArrayParser
+
+PUZZLES = [
+    {"question": "What comes next: 2, 4, 8, ?", "answer": "16", "options": ["12", "16", "18"]},
+    {"question": 'Which word is odd: "{", "[" or "}"?', "answer": "[", "hint": "brackets \\ braces"},
+    {"question": "Nested", "answer": "ok", "meta": {"tags": ["a", {"b": [1, 2]}]}},
+]
+
+RESPONSES = [
+    json.dumps(PUZZLES),
+    "Here are [3] puzzles:\n```json\n" + json.dumps(PUZZLES, indent=2) + "\n```\nEnjoy [them]!",
+    "[ \n\t" + json.dumps(PUZZLES)[1:] + " trailing {\"not\": \"parsed\"}",
+]
+
+
+def feed_in_chunks(text: str, rng: random.Random) -> list:
+    parser, objects, position = PuzzleArrayParser(), [], 0
+    while position < len(text):
+        size = rng.randint(1, 12)
+        objects.extend(parser.feed(text[position:position + size]))
+        position += size
+    return objects
+
+
+@pytest.mark.parametrize("seed", range(50))
+@pytest.mark.parametrize("response", RESPONSES)
+def test_arbitrary_chunk_splits(response, seed):
+    assert feed_in_chunks(response, random.Random(seed)) == PUZZLES
+
+
+def test_single_characters():
+    parser = PuzzleArrayParser()
+    objects = [obj for char in RESPONSES[1] for obj in parser.feed(char)]
+    assert objects == PUZZLES
+
+
+def test_objects_arrive_as_soon_as_they_close():
+    parser = PuzzleArrayParser()
+    text = json.dumps(PUZZLES)
+    first_end = text.index(json.dumps(PUZZLES[0])) + len(json.dumps(PUZZLES[0]))
+    assert parser.feed(text[:first_end]) == [PUZZLES[0]]
+    assert parser.feed(text[first_end:]) == PUZZLES[1:]
+
+
+def test_unparseable_object_is_skipped():
+    parser = PuzzleArrayParser()
+    assert parser.feed('[{"question": tru}, {"question": "ok"}]') == [{"question": "ok"}]
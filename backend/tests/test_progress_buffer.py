@@ -0,0 +1,173 @@
+"""Write-behind buffer requeue and resume, against in-memory stand-ins for the stores"""
+import asyncio
+
+import pytest
+
+import progress_buffer
+from progress_merge import merge_entry
+
+
+class FakeStores:
+    """Records every write and fails the steps named in fail_next once each"""
+
+    def __init__(self):
+        self.profiles = {}
+        self.leaderboard = {}
+        self.windows = {}
+        self.puzzle_progress = {}
+        self.calls = []
+        self.fail_next = set()
+
+    def _step(self, name: str) -> None:
+        self.calls.append(name)
+        if name in self.fail_next:
+            self.fail_next.discard(name)
+            raise RuntimeError(f"{name} failed")
+
+    async def merge_progress(self, db, user_id, changes, extra_update=None):
+        self._step("merge")
+        profile = self.profiles.setdefault(user_id, {})
+        old = {puzzle_id: profile.get(puzzle_id) for puzzle_id in changes}
+        merged = {puzzle_id: merge_entry(profile.get(puzzle_id), change) for puzzle_id, change in changes.items()}
+        profile.update(merged)
+        return {k: v for k, v in old.items() if v is not None}, merged, {}, 1
+
+    async def apply_delta(self, db, user, delta=(0, 0, 0.0)):
+        self._step("leaderboard")
+        totals = self.leaderboard.get(user["id"], (0, 0, 0.0))
+        self.leaderboard[user["id"]] = tuple(t + d for t, d in zip(totals, delta))
+
+    async def record_completion(self, db, user, gain, completed_at=None):
+        self._step("window")
+        totals = self.windows.get(user["id"], (0, 0, 0.0))
+        self.windows[user["id"]] = tuple(t + g for t, g in zip(totals, gain))
+
+    async def upsert_puzzle_progress(self, db, user_id, entries, trusted=False):
+        self._step("puzzle_progress")
+        self.puzzle_progress.setdefault(user_id, {}).update(entries)
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    stores = FakeStores()
+    monkeypatch.setattr(progress_buffer.progress_store, "merge_progress", stores.merge_progress)
+    monkeypatch.setattr(progress_buffer.progress_store, "upsert_puzzle_progress", stores.upsert_puzzle_progress)
+    monkeypatch.setattr(progress_buffer.leaderboard, "apply_delta", stores.apply_delta)
+    monkeypatch.setattr(progress_buffer.leaderboard_windows, "record_completion", stores.record_completion)
+    monkeypatch.setattr(progress_buffer, "_buffers", {})
+    monkeypatch.setattr(progress_buffer, "_resuming", [])
+    monkeypatch.setattr(progress_buffer, "_events", 0)
+    monkeypatch.setattr(progress_buffer, "_flush_lock", None)
+    monkeypatch.setattr(progress_buffer, "_flush_wanted", None)
+    return stores
+
+
+def flush() -> int:
+    return asyncio.run(progress_buffer.flush(None))
+
+
+def user(user_id: str) -> dict:
+    return {"id": user_id, "name": user_id}
+
+
+def test_completions_coalesce_per_puzzle(stores):
+    alice = user("alice")
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 1, "bestTime": 30.0, "attempts": 1})
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 3, "bestTime": 45.0, "attempts": 1})
+
+    assert flush() == 2
+    assert stores.calls.count("merge") == 1
+    assert stores.profiles["alice"]["1"] == {"completed": True, "stars": 3, "bestTime": 30.0, "attempts": 2}
+    assert stores.leaderboard["alice"] == (3, 1, 30.0)
+    assert stores.windows["alice"] == (3, 1, 30.0)
+    assert flush() == 0
+
+
+def test_replays_earn_nothing_in_the_windows(stores):
+    alice = user("alice")
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 3, "bestTime": 30.0, "attempts": 1})
+    flush()
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 3, "bestTime": 20.0, "attempts": 1})
+    flush()
+    assert stores.windows["alice"] == (3, 1, 30.0)
+
+
+def test_failed_merge_is_requeued_and_merged_with_new_completions(stores):
+    alice = user("alice")
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 1, "attempts": 1})
+    stores.fail_next = {"merge"}
+    assert flush() == 0
+    assert progress_buffer.get_metrics()["buffered_events"] == 1
+
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 2, "attempts": 1})
+    assert flush() == 2
+    assert stores.profiles["alice"]["1"] == {"completed": True, "stars": 2, "attempts": 2}
+    assert stores.windows["alice"] == (2, 1, 0.0)
+
+
+@pytest.mark.parametrize("failing", ["leaderboard", "window", "puzzle_progress"])
+def test_resume_skips_completed_increments(stores, failing):
+    alice = user("alice")
+    progress_buffer.add_completion(alice, "1", {"completed": True, "stars": 2, "attempts": 1})
+    stores.fail_next = {failing}
+    assert flush() == 0
+    assert len(progress_buffer._resuming) == 1
+
+    # A completion arriving meanwhile gets its own buffer instead of joining the half-written one
+    progress_buffer.add_completion(alice, "2", {"completed": True, "stars": 1, "attempts": 1})
+    assert flush() == 2
+
+    assert stores.calls.count("merge") == 2
+    assert stores.profiles["alice"] == {
+        "1": {"completed": True, "stars": 2, "attempts": 1},
+        "2": {"completed": True, "stars": 1, "attempts": 1},
+    }
+    assert stores.leaderboard["alice"] == (3, 2, 0.0)
+    assert stores.windows["alice"] == (3, 2, 0.0)
+    assert set(stores.puzzle_progress["alice"]) == {"1", "2"}
+    assert not progress_buffer._resuming and not progress_buffer._buffers
+
+
+def test_one_failing_user_does_not_hold_back_others(stores):
+    progress_buffer.add_completion(user("alice"), "1", {"completed": True, "stars": 1})
+    progress_buffer.add_completion(user("bob"), "1", {"completed": True, "stars": 3})
+    stores.fail_next = {"merge"}
+
+    assert flush() == 1
+    assert len(stores.profiles) == 1
+    assert flush() == 1
+    assert set(stores.profiles) == {"alice", "bob"}
+
+
+def test_cancelled_flush_keeps_unwritten_buffers(stores, monkeypatch):
+    gate = asyncio.Event()
+    merge_progress = stores.merge_progress
+
+    async def blocking_merge(*args, **kwargs):
+        await gate.wait()
+        return await merge_progress(*args, **kwargs)
+
+    monkeypatch.setattr(progress_buffer.progress_store, "merge_progress", blocking_merge)
+    progress_buffer.add_completion(user("alice"), "1", {"completed": True, "stars": 1})
+    progress_buffer.add_completion(user("bob"), "1", {"completed": True, "stars": 2})
+
+    async def scenario():
+        task = asyncio.create_task(progress_buffer.flush(None))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert set(progress_buffer._buffers) == {"alice", "bob"}
+        assert progress_buffer.get_metrics()["buffered_events"] == 2
+
+        gate.set()
+        return await progress_buffer.flush(None)
+
+    assert asyncio.run(scenario()) == 2
+    assert stores.leaderboard == {"alice": (1, 1, 0.0), "bob": (2, 1, 0.0)}
+
+
+def test_rejects_non_numeric_changes(stores):
+    with pytest.raises((ValueError, TypeError)):
+        progress_buffer.add_completion(user("alice"), "1", {"stars": "lots"})
+    assert not progress_buffer._buffers
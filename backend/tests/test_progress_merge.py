@@ -0,0 +1,71 @@
+"""merge_entry and entry_operators must agree on every merge"""
+import random
+
+import pytest
+
+from progress_merge import combine_operators, entry_operators, merge_entry, normalize_change
+
+
+def apply_operators(document: dict, update: dict) -> dict:
+    """Apply $max/$min/$inc the way MongoDB does, on a flat dict of dotted paths"""
+    result = dict(document)
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if path not in result:
+                result[path] = value
+            elif operator == "$max":
+                result[path] = max(result[path], value)
+            elif operator == "$min":
+                result[path] = min(result[path], value)
+            elif operator == "$inc":
+                result[path] = result[path] + value
+    return result
+
+
+def random_entry(rng: random.Random) -> dict:
+    fields = {
+        "completed": lambda: rng.random() < 0.5,
+        "stars": lambda: rng.randint(0, 3),
+        "bestTime": lambda: round(rng.uniform(1, 300), 2),
+        "attempts": lambda: rng.randint(0, 20),
+        "hintsUsed": lambda: rng.randint(0, 5),
+    }
+    return {name: make() for name, make in fields.items() if rng.random() < 0.7}
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_operators_match_python_merge(seed):
+    rng = random.Random(seed)
+    current, change = random_entry(rng), normalize_change(random_entry(rng))
+
+    stored = {f"p.{field}": value for field, value in current.items()}
+    updated = apply_operators(stored, combine_operators(entry_operators("p", change)))
+
+    assert {path[2:]: value for path, value in updated.items()} == merge_entry(current, change)
+
+
+def test_merge_rules():
+    current = {"completed": False, "stars": 2, "bestTime": 40.0, "attempts": 3, "hintsUsed": 1}
+    change = {"completed": True, "stars": 1, "bestTime": 30.0, "attempts": 1, "hintsUsed": 2}
+    assert merge_entry(current, change) == {
+        "completed": True, "stars": 2, "bestTime": 30.0, "attempts": 4, "hintsUsed": 3
+    }
+
+
+def test_merge_ignores_null_fields():
+    assert merge_entry({"stars": None, "attempts": None}, {"stars": 2, "attempts": 1}) == {"stars": 2, "attempts": 1}
+
+
+def test_normalize_change_keeps_mergeable_fields():
+    assert normalize_change({"stars": "2", "bestTime": "1.5", "attempts": None, "other": 7}) == {"stars": 2, "bestTime": 1.5}
+
+
+@pytest.mark.parametrize("change", [{"stars": "many"}, {"bestTime": "soon"}, {"attempts": [1]}])
+def test_normalize_change_rejects_non_numbers(change):
+    with pytest.raises((ValueError, TypeError)):
+        normalize_change(change)
+
+
+def test_combine_operators_drops_empty_operators():
+    update = combine_operators(entry_operators("a", {"stars": 1}), entry_operators("b", {"attempts": 2}))
+    assert update == {"$max": {"a.stars": 1}, "$inc": {"b.attempts": 2}}
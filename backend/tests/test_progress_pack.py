@@ -0,0 +1,70 @@
+"""Packed level progress round-trips and its span cap"""
+import random
+
+import pytest
+
+import progress_pack
+from progress_pack import decode_level_progress, encode_level_progress, split_progress
+
+
+def random_entry(rng: random.Random) -> dict:
+    entry = {
+        "completed": rng.random() < 0.7,
+        "stars": rng.randint(0, 3),
+        "attempts": rng.randint(0, 40),
+        "hintsUsed": rng.randint(0, 6),
+    }
+    if rng.random() < 0.8:
+        entry["bestTime"] = rng.randint(1, 600_000) / 1000
+    return entry
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_round_trip(seed):
+    rng = random.Random(seed)
+    ids = rng.sample(range(1, 500), rng.randint(0, 80))
+    level_progress = {str(puzzle_id): random_entry(rng) for puzzle_id in ids}
+
+    assert decode_level_progress(encode_level_progress(level_progress)) == level_progress
+
+
+def test_values_saturate_instead_of_wrapping():
+    decoded = decode_level_progress(encode_level_progress({
+        "7": {"completed": True, "stars": 9, "attempts": 10 ** 6, "hintsUsed": -3, "bestTime": "bad"}
+    }))
+    assert decoded == {"7": {"completed": True, "stars": 3, "attempts": 0xFFFF, "hintsUsed": 0}}
+
+
+def test_non_numeric_ids_stay_unpacked():
+    level_progress = {"3": {"stars": 1}, "daily-1": {"stars": 2}, "4": "corrupt"}
+    packable, extra = split_progress(level_progress)
+    assert packable == {3: {"stars": 1}}
+    assert extra == {"daily-1": {"stars": 2}, "4": "corrupt"}
+
+
+def test_span_is_capped_to_densest_window(monkeypatch):
+    monkeypatch.setattr(progress_pack, "PACK_MAX_SPAN", 100)
+    level_progress = {str(puzzle_id): {"stars": 1} for puzzle_id in range(1000, 1050)}
+    level_progress["5"] = {"stars": 2}
+    level_progress["4000000000"] = {"stars": 3}
+
+    packable, extra = split_progress(level_progress)
+    assert sorted(packable) == list(range(1000, 1050))
+    assert extra == {"5": {"stars": 2}, "4000000000": {"stars": 3}}
+
+    data = encode_level_progress(level_progress)
+    _, _, base, count = progress_pack._HEADER.unpack_from(data, 0)
+    assert (base, count) == (1000, 50)
+    assert set(decode_level_progress(data)) == {str(puzzle_id) for puzzle_id in range(1000, 1050)}
+
+
+def test_default_span_bounds_blob_size():
+    level_progress = {"1": {"stars": 1}, str(0xFFFFFFFF): {"stars": 1}}
+    assert len(encode_level_progress(level_progress)) < 64 + progress_pack.PACK_MAX_SPAN * 9
+
+
+def test_rejects_foreign_blobs():
+    with pytest.raises(ValueError):
+        decode_level_progress(b"XX" + encode_level_progress({})[2:])
+    with pytest.raises(ValueError):
+        decode_level_progress(encode_level_progress({"1": {"stars": 1}, "2": {"stars": 2}})[:-1])
@@ -0,0 +1,71 @@
+"""RankIndex against a plainly sorted list of rows"""
+import random
+
+import pytest
+
+from rank_index import RankIndex, rank_key
+
+
+def ranked(rows: dict) -> list:
+    return sorted(rows.values(), key=rank_key)
+
+
+def expected_slice(rows: dict, start: int, count: int) -> list:
+    ordered = ranked(rows)
+    return [{**row, "rank": index + 1} for index, row in enumerate(ordered)][max(0, start):start + count]
+
+
+def random_row(rng: random.Random, user_id: str) -> dict:
+    # Narrow ranges so ties on stars and completions are common
+    return {"user_id": user_id, "total_stars": rng.randint(0, 30), "puzzles_completed": rng.randint(0, 10)}
+
+
+def check(index: RankIndex, rows: dict, rng: random.Random) -> None:
+    assert len(index) == len(rows)
+    ordered = ranked(rows)
+    for position, row in enumerate(ordered):
+        assert index.rank_of(row["user_id"]) == position + 1
+    k = rng.randint(0, len(rows) + 2)
+    assert index.top(k) == expected_slice(rows, 0, k)
+    if rows:
+        user_id = rng.choice(list(rows))
+        radius = rng.randint(0, 5)
+        rank = index.rank_of(user_id)
+        start = max(0, rank - 1 - radius)
+        assert index.around(user_id, radius) == expected_slice(rows, start, rank - start + radius)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_updates_and_removals_match_sorted_list(seed):
+    rng = random.Random(seed)
+    rows = {f"u{i}": random_row(rng, f"u{i}") for i in range(rng.randint(0, 60))}
+    index = RankIndex.from_rows(list(rows.values()))
+    check(index, rows, rng)
+
+    for step in range(300):
+        user_id = f"u{rng.randint(0, 80)}"
+        if rng.random() < 0.2:
+            index.remove(user_id)
+            rows.pop(user_id, None)
+        else:
+            row = random_row(rng, user_id)
+            index.update(row)
+            rows[user_id] = row
+        if step % 25 == 0:
+            check(index, rows, rng)
+    check(index, rows, rng)
+
+
+def test_unknown_user():
+    index = RankIndex.from_rows([{"user_id": "a", "total_stars": 1, "puzzles_completed": 1}])
+    assert index.rank_of("b") is None
+    assert index.around("b", 3) == []
+    index.remove("b")
+    assert len(index) == 1
+
+
+def test_ties_break_on_user_id():
+    index = RankIndex()
+    for user_id in ("c", "a", "b"):
+        index.update({"user_id": user_id, "total_stars": 5, "puzzles_completed": 2})
+    assert [row["user_id"] for row in index.top(3)] == ["a", "b", "c"]
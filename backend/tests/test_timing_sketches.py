@@ -0,0 +1,66 @@
+"""DDSketch quantiles stay within the configured relative error"""
+import math
+import random
+
+import pytest
+
+from timing_sketches import MAX_SECONDS, MIN_SECONDS, DDSketch
+
+QUANTILES = (0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1)
+
+
+def exact_quantile(values: list, q: float) -> float:
+    return sorted(values)[math.floor(q * (len(values) - 1))]
+
+
+def assert_within_error(sketch: DDSketch, values: list) -> None:
+    for q in QUANTILES:
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= sketch.alpha * expected * (1 + 1e-9), q
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("alpha", [0.01, 0.05])
+def test_quantiles_within_relative_error(seed, alpha):
+    rng = random.Random(seed)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(rng.randint(1, 2000))]
+    values = [min(MAX_SECONDS, max(MIN_SECONDS, value)) for value in values]
+    sketch = DDSketch(alpha)
+    for value in values:
+        sketch.add(value)
+    assert_within_error(sketch, values)
+
+
+def test_merged_sketches_keep_the_bound():
+    rng = random.Random(7)
+    parts = [[rng.uniform(0.5, 900) for _ in range(300)] for _ in range(4)]
+    merged = DDSketch()
+    for part in parts:
+        sketch = DDSketch()
+        for value in part:
+            sketch.add(value)
+        merged.merge(sketch)
+    assert_within_error(merged, [value for part in parts for value in part])
+
+
+def test_document_round_trip():
+    sketch = DDSketch()
+    for value in (1.5, 2.0, 30.0, 30.0, 400.0):
+        sketch.add(value)
+    update = sketch.to_update()
+    document = {
+        "alpha": update["$setOnInsert"]["alpha"],
+        "count": update["$inc"]["count"],
+        "sum": update["$inc"]["sum"],
+        "bins": {path.split(".", 1)[1]: count for path, count in update["$inc"].items() if path.startswith("bins.")},
+        "min": update["$min"]["min"],
+        "max": update["$max"]["max"],
+    }
+    restored = DDSketch.from_document(document)
+    assert [restored.quantile(q) for q in QUANTILES] == [sketch.quantile(q) for q in QUANTILES]
+
+
+def test_empty_and_mismatched_sketches():
+    assert DDSketch().quantile(0.5) is None
+    with pytest.raises(ValueError):
+        DDSketch(0.01).merge(DDSketch(0.02))
@@ -0,0 +1,184 @@
+"""
+Mergeable solve-time quantile sketches.
+
+A DDSketch keeps counts in logarithmic bins: bin i holds values in
+(gamma^(i-1), gamma^i] with gamma = (1 + alpha) / (1 - alpha), so any quantile
+it reports is within relative error alpha of the true value. Solve times are
+clamped to [MIN_SECONDS, MAX_SECONDS], which bounds a sketch to roughly
+log(MAX/MIN) / log(gamma) bins (about 800 at the default 1%).
+
+Because bins are plain counters, sketches merge by adding counts. Each worker
+accumulates completions in local sketches per puzzle and per category and
+periodically persists them into `timing_sketches` with $inc, so concurrent
+workers never overwrite each other.
+"""
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, UpdateOne
+from typing import Dict, Optional, Tuple
+import asyncio
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+RELATIVE_ACCURACY = float(os.environ.get("TIMING_SKETCH_RELATIVE_ACCURACY", 0.01))
+PERSIST_SECONDS = float(os.environ.get("TIMING_SKETCH_PERSIST_SECONDS", 30))
+MIN_SECONDS = 0.01
+MAX_SECONDS = 86400.0
+
+SketchKey = Tuple[str, str]
+
+
+class DDSketch:
+    """Relative-error quantile sketch over positive values"""
+
+    def __init__(self, alpha: float = RELATIVE_ACCURACY):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        # Midpoint (in relative terms) of the bin's range
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float, count: int = 1) -> None:
+        value = min(MAX_SECONDS, max(MIN_SECONDS, float(value)))
+        index = self._index(value)
+        self.bins[index] = self.bins.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "DDSketch") -> None:
+        if other.alpha != self.alpha:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Value at quantile q (0..1), or None for an empty sketch"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return min(self.max, max(self.min, self._value(index)))
+        return self.max
+
+    def to_update(self) -> dict:
+        """$inc/$min/$max update adding this sketch to a stored one"""
+        return {
+            "$inc": {"count": self.count, "sum": self.total, **{f"bins.{i}": c for i, c in self.bins.items()}},
+            "$min": {"min": self.min},
+            "$max": {"max": self.max},
+            "$setOnInsert": {"alpha": self.alpha},
+        }
+
+    @classmethod
+    def from_document(cls, document: dict) -> "DDSketch":
+        sketch = cls(document.get("alpha", RELATIVE_ACCURACY))
+        sketch.bins = {int(i): c for i, c in document.get("bins", {}).items()}
+        sketch.count = document.get("count", 0)
+        sketch.total = document.get("sum", 0.0)
+        sketch.min = document.get("min", math.inf)
+        sketch.max = document.get("max", -math.inf)
+        return sketch
+
+
+# Completions observed by this worker since the last persist
+_pending: Dict[SketchKey, DDSketch] = {}
+
+
+def observe(puzzle_id: int, category: Optional[str], seconds: float) -> None:
+    """Add one solve time to the puzzle's (and category's) local sketch"""
+    if seconds is None or seconds <= 0:
+        return
+    keys = [("puzzle", str(puzzle_id))]
+    if category:
+        keys.append(("category", category))
+    for key in keys:
+        sketch = _pending.get(key)
+        if sketch is None:
+            sketch = _pending[key] = DDSketch()
+        sketch.add(seconds)
+
+
+async def persist(db: AsyncIOMotorDatabase) -> int:
+    """Add local sketches to the stored ones, returning how many were written"""
+    global _pending
+    if not _pending:
+        return 0
+    pending, _pending = _pending, {}
+    operations = [
+        UpdateOne({"scope": scope, "key": key}, sketch.to_update(), upsert=True)
+        for (scope, key), sketch in pending.items()
+    ]
+    try:
+        await db.timing_sketches.bulk_write(operations, ordered=False)
+    except Exception:
+        # Keep the counts for the next attempt
+        for key, sketch in pending.items():
+            if key in _pending:
+                sketch.merge(_pending[key])
+            _pending[key] = sketch
+        raise
+    return len(operations)
+
+
+async def run_persister(db: AsyncIOMotorDatabase) -> None:
+    """Background task persisting local sketches every PERSIST_SECONDS"""
+    while True:
+        await asyncio.sleep(PERSIST_SECONDS)
+        try:
+            await persist(db)
+        except Exception as e:
+            logger.warning(f"Failed to persist timing sketches: {e}")
+
+
+async def load(db: AsyncIOMotorDatabase, scope: str, key: str) -> DDSketch:
+    """Stored sketch merged with this worker's unpersisted observations"""
+    document = await db.timing_sketches.find_one({"scope": scope, "key": key}, {"_id": 0})
+    sketch = DDSketch.from_document(document) if document else DDSketch()
+    local = _pending.get((scope, key))
+    if local is not None:
+        sketch.merge(local)
+    return sketch
+
+
+def summarize(sketch: DDSketch) -> dict:
+    """Percentiles and error bound of a sketch"""
+    return {
+        "count": sketch.count,
+        "p50": _round(sketch.quantile(0.5)),
+        "p90": _round(sketch.quantile(0.9)),
+        "p99": _round(sketch.quantile(0.99)),
+        "min": _round(sketch.min) if sketch.count else None,
+        "max": _round(sketch.max) if sketch.count else None,
+        "mean": _round(sketch.total / sketch.count) if sketch.count else None,
+        "relative_error": sketch.alpha,
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 3) if value is not None else None
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> None:
+    """Create the sketch lookup index"""
+    await db.timing_sketches.create_index([("scope", ASCENDING), ("key", ASCENDING)], unique=True)